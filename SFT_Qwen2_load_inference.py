@@ -1,41 +1,86 @@
+
+import os
+import sys
 import torch
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, TextStreamer
-from peft import LoraConfig, get_peft_model, PeftModel
-from datasets import load_dataset, Dataset
+from transformers import (Qwen2VLForConditionalGeneration, AutoModelForCausalLM, AutoProcessor, TextStreamer,
+                          StoppingCriteria, StoppingCriteriaList)
+from peft import PeftModel
+from datasets import load_dataset
 
 # Model ID
 model_id = "Qwen/Qwen2-VL-2B-Instruct"  # Switched to 2B for lower memory usage
+lora_path = "lora_model_8k"  # "lora_model_1k" "lora_model_5k"
 
-# Check hardware availability
-device = "cuda" if torch.cuda.is_available() else "mps"
-print(f"Using device: {device}")
+system_message="You are a helpful assistant who can analyze the given images in detail and answer the question appropriately."
 
-# Load processor
-processor = AutoProcessor.from_pretrained(
-    model_id,
-    trust_remote_code=True,  # Required for Qwen models
-    # max_length=128  # Limit token length for memory efficiency
-)
+# The answer budgets and stopping rules are the backend's own, so offline evaluation
+# measures the stopping behaviour that is served
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), "chart_qa_extension", "backend"))
+from answer_control import AnswerControl  # noqa: E402
 
-# Load model with 4-bit quantization for memory efficiency
-model = Qwen2VLForConditionalGeneration.from_pretrained(
-    model_id,
-    device_map=None,
-    torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,  # Fallback to float32 for CPU
 
-).to(device)
+def get_device():
+    # Check hardware availability
+    if torch.cuda.is_available():
+        return "cuda"
+    elif torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
 
-# Load and merge LoRA
-model = PeftModel.from_pretrained(model, "lora_model_8k") #"lora_model_1k" "lora_model_5k"
-merged_model = model.merge_and_unload()
 
-merged_model = merged_model.to(device)
-merged_model.eval()  # Set to evaluation mode
+def load_model(lora_path=lora_path, model_path=None, device=None):
+    """Load the processor and the merged fine-tuned model, returns (model, processor, device)
 
-# Get data
-# Function to convert dataset samples to conversation format
-system_message="You are a helpful assistant who can analyze the given images in detail and answer the question appropriately."
+    model_path points to a merged model written by chart_qa_extension/backend/bake_model.py
+    and skips the LoRA merge.
+    """
+    device = device or get_device()
+    print(f"Using device: {device}")
+    torch_dtype = torch.bfloat16 if device == "cuda" else torch.float32  # Fallback to float32 for CPU
+
+    # CPU threads (defaults to all cores)
+    if device == "cpu" and os.environ.get("CHARTQA_NUM_THREADS"):
+        torch.set_num_threads(int(os.environ["CHARTQA_NUM_THREADS"]))
+
+    # Load processor
+    processor = AutoProcessor.from_pretrained(
+        model_path or model_id,
+        trust_remote_code=True,  # Required for Qwen models
+        # max_length=128  # Limit token length for memory efficiency
+    )
+    # Left padding so every row of a batch ends at the generation prompt
+    processor.tokenizer.padding_side = "left"
+
+    if model_path:
+        merged_model = Qwen2VLForConditionalGeneration.from_pretrained(
+            model_path,
+            torch_dtype=torch_dtype,
+            device_map={"": device},
+            low_cpu_mem_usage=True,
+        )
+    else:
+        model = Qwen2VLForConditionalGeneration.from_pretrained(
+            model_id,
+            device_map=None,
+            torch_dtype=torch_dtype,
+        ).to(device)
+
+        # Load and merge LoRA
+        model = PeftModel.from_pretrained(model, lora_path)
+        merged_model = model.merge_and_unload()
+
+    merged_model = merged_model.to(device)
+    merged_model.eval()  # Set to evaluation mode
+
+    # On CPU, int8 dynamic quantization of the linear layers (set CHARTQA_QUANTIZE=none to keep float32)
+    if device == "cpu" and os.environ.get("CHARTQA_QUANTIZE", "int8") == "int8":
+        merged_model = torch.ao.quantization.quantize_dynamic(merged_model, {torch.nn.Linear}, dtype=torch.qint8)
+        print("Quantized linear layers to int8")
+
+    return merged_model, processor, device
 
+
+# Function to convert dataset samples to conversation format
 def convert_to_conversation(sample):
     conversation = [
         { "role": "user",
@@ -51,55 +96,197 @@ def convert_to_conversation(sample):
     ]
     return { "messages" : conversation }
 
-dataset = load_dataset("HuggingFaceM4/ChartQA", split="train", streaming=True) #.select(range(n_samples))
-# Take only first `n_samples`
-dataset = dataset.take(5)
-
-converted_dataset = [convert_to_conversation(sample) for sample in dataset]
 
-
-def model_inference(img,user_q):
+def build_prompt(processor, user_q):
     msg = [
       {
         "role": "user",
         "content": [
-          {"type": "text", "text": "You are a helpful assistant who can analyze the given images in detail and answer the question appropriately."},
-          {"type": "image", "image": img},
+          {"type": "text", "text": system_message},
+          {"type": "image"},
           {"type": "text", "text": user_q}
         ]
       }
     ]
-    
+
     # Apply chat template to format the messages
-    text = processor.apply_chat_template(
+    return processor.apply_chat_template(
         msg,
         tokenize=False,
         add_generation_prompt=True  # Add the assistant prompt for generation
     )
-    
-    inputs = processor(
-        image,
-        text,
-        add_special_tokens = False,
-        return_tensors = "pt",
-    ).to(device)
-    
+
+
+def prepare_inputs(processor, images, questions):
+    """Preprocess a batch of images + questions into padded model inputs (CPU tensors)"""
+    texts = [build_prompt(processor, user_q) for user_q in questions]
+    return processor(
+        images=[img.convert("RGB") for img in images],
+        text=texts,
+        padding=True,
+        add_special_tokens=False,
+        return_tensors="pt",
+    )
+
+
+@torch.no_grad()
+def generate_answers(model, processor, inputs, device, max_new_tokens=128, questions=None, **generate_kwargs):
+    """Generate one answer per row of prepared inputs (greedy unless generate_kwargs say otherwise)
+
+    With the questions of the rows, each row stops as soon as it holds a complete
+    short answer or has used the budget of its question type.
+    """
+    generate_kwargs.setdefault("do_sample", False)
+    inputs = inputs.to(device)
+    prompt_length = inputs["input_ids"].shape[1]
+    if questions is not None:
+        max_new_tokens = max(answer_budgets_for(questions, max_new_tokens))
+        generate_kwargs["stopping_criteria"] = StoppingCriteriaList([
+            AnswerStoppingCriteria(processor.tokenizer, prompt_length, questions, max_new_tokens)])
+    outputs = model.generate(**inputs, max_new_tokens=max_new_tokens, use_cache=True, **generate_kwargs)
+    # Decode only the newly generated tokens
+    answers = processor.batch_decode(outputs[:, prompt_length:], skip_special_tokens=True)
+    if questions is None:
+        return [answer.strip() for answer in answers]
+    return [AnswerControl(question, max_new_tokens).finalize(answer) for answer, question in zip(answers, questions)]
+
+
+def answer_budgets_for(questions, max_new_tokens):
+    """Per-question token budgets, capped at max_new_tokens"""
+    return [AnswerControl(question, max_new_tokens).max_new_tokens for question in questions]
+
+
+class AnswerStoppingCriteria(StoppingCriteria):
+    """Ends each row once it holds a complete short answer or has used its question's budget"""
+
+    def __init__(self, tokenizer, prompt_length, questions, max_new_tokens):
+        self.tokenizer = tokenizer
+        self.prompt_length = prompt_length
+        self.controls = [AnswerControl(question, max_new_tokens) for question in questions]
+
+    def __call__(self, input_ids, scores, **kwargs):
+        done = []
+        for row, tokens in enumerate(input_ids[:, self.prompt_length:]):
+            text = self.tokenizer.decode(tokens, skip_special_tokens=True)
+            control = self.controls[row]
+            done.append(len(tokens) >= control.max_new_tokens or control.is_complete(text))
+        return torch.tensor(done, dtype=torch.bool, device=input_ids.device)
+
+
+# Inputs of the fine-tuned model that assisted generation also hands to the draft model
+VISION_INPUTS = ("pixel_values", "image_grid_thw")
+
+
+def load_draft_model(draft_model_id, device):
+    """Small causal LM that shares the tokenizer (e.g. Qwen/Qwen2-0.5B-Instruct), for assisted generation
+
+    Transformers passes the fine-tuned model's inputs, pixels included, on to
+    the draft's generate. A text-only draft cannot take the vision inputs, so
+    they are dropped there: it drafts from the prompt tokens alone, with the
+    image's placeholder tokens left in.
+    """
+    torch_dtype = torch.bfloat16 if device == "cuda" else torch.float32
+    draft_model = AutoModelForCausalLM.from_pretrained(draft_model_id, torch_dtype=torch_dtype).to(device)
+    if not hasattr(draft_model, "visual"):
+        generate = draft_model.generate
+
+        def text_only_generate(*args, **kwargs):
+            for key in VISION_INPUTS:
+                kwargs.pop(key, None)
+            return generate(*args, **kwargs)
+
+        draft_model.generate = text_only_generate
+    return draft_model.eval()
+
+
+@torch.no_grad()
+def speculative_generate_answers(model, processor, inputs, device, max_new_tokens=128, questions=None,
+                                 prompt_lookup_tokens=None, draft_model=None, stats=None, **generate_kwargs):
+    """generate_answers with prompt-lookup or draft-model decoding
+
+    Transformers verifies every drafted token with the fine-tuned model, so the
+    answers follow its own distribution. Assisted generation handles one sequence
+    at a time, so the rows are generated one by one. stats, if given, accumulates
+    generated tokens and forward passes of the fine-tuned model; tokens per
+    forward above 1 is the share of drafts that was accepted.
+    """
+    generate_kwargs.setdefault("do_sample", False)
+    if prompt_lookup_tokens:
+        generate_kwargs["prompt_lookup_num_tokens"] = prompt_lookup_tokens
+    if draft_model is not None:
+        generate_kwargs["assistant_model"] = draft_model
+
+    forwards = [0]
+    hook = model.register_forward_pre_hook(lambda module, args: forwards.__setitem__(0, forwards[0] + 1))
+    answers = []
+    try:
+        # Rows share one pixel_values tensor, image_grid_thw says how many patches belong to each
+        patch_counts = inputs["image_grid_thw"].prod(-1).tolist()
+        patch_offsets = [sum(patch_counts[:row]) for row in range(len(patch_counts))]
+        for row in range(inputs["input_ids"].shape[0]):
+            keep = inputs["attention_mask"][row].bool()  # drop the batch's left padding
+            row_inputs = {
+                "input_ids": inputs["input_ids"][row][keep][None].to(device),
+                "attention_mask": inputs["attention_mask"][row][keep][None].to(device),
+                "pixel_values": inputs["pixel_values"][patch_offsets[row]:patch_offsets[row] + patch_counts[row]].to(device),
+                "image_grid_thw": inputs["image_grid_thw"][row:row + 1].to(device),
+            }
+            row_max_new_tokens = max_new_tokens
+            if questions is not None:
+                row_max_new_tokens = answer_budgets_for([questions[row]], max_new_tokens)[0]
+                generate_kwargs["stopping_criteria"] = StoppingCriteriaList([AnswerStoppingCriteria(
+                    processor.tokenizer, row_inputs["input_ids"].shape[1], [questions[row]], row_max_new_tokens)])
+            outputs = model.generate(**row_inputs, max_new_tokens=row_max_new_tokens, use_cache=True, **generate_kwargs)
+            new_tokens = outputs[0, row_inputs["input_ids"].shape[1]:]
+            if stats is not None:
+                stats["tokens"] = stats.get("tokens", 0) + len(new_tokens)
+            answer = processor.decode(new_tokens, skip_special_tokens=True)
+            if questions is not None:
+                answers.append(AnswerControl(questions[row], max_new_tokens).finalize(answer))
+            else:
+                answers.append(answer.strip())
+    finally:
+        hook.remove()
+
+    if stats is not None:
+        stats["forwards"] = stats.get("forwards", 0) + forwards[0]
+        stats["tokens_per_forward"] = round(stats["tokens"] / stats["forwards"], 3) if stats["forwards"] else None
+    return answers
+
+
+def model_inference(model, processor, device, img, user_q):
+    inputs = prepare_inputs(processor, [img], [user_q]).to(device)
+
+    # Greedy, stopping once the short answer is complete
     text_streamer = TextStreamer(processor.tokenizer, skip_prompt = True)
-    _ = model.generate(**inputs, streamer = text_streamer, max_new_tokens = 128,
-                       use_cache = True, temperature = 1.5, min_p = 0.1)
-    
+    max_new_tokens = answer_budgets_for([user_q], 128)[0]
+    stopping_criteria = StoppingCriteriaList([
+        AnswerStoppingCriteria(processor.tokenizer, inputs["input_ids"].shape[1], [user_q], max_new_tokens)])
+    _ = model.generate(**inputs, streamer = text_streamer, max_new_tokens = max_new_tokens,
+                       use_cache = True, do_sample = False, stopping_criteria = stopping_criteria)
+
+
+if __name__ == "__main__":
+    merged_model, processor, device = load_model()
+
+    # Get data
+    dataset = load_dataset("HuggingFaceM4/ChartQA", split="train", streaming=True) #.select(range(n_samples))
+    # Take only first `n_samples`
+    dataset = dataset.take(5)
+
+    converted_dataset = [convert_to_conversation(sample) for sample in dataset]
 
-# inference on a sample
-from matplotlib import pyplot as plt
+    # inference on a sample
+    from matplotlib import pyplot as plt
 
-n_example = 1
+    n_example = 1
 
-image = converted_dataset[n_example]['messages'][0]['content'][1]['image']
-user_query = converted_dataset[n_example]['messages'][0]['content'][2]['text']
+    image = converted_dataset[n_example]['messages'][0]['content'][1]['image']
+    user_query = converted_dataset[n_example]['messages'][0]['content'][2]['text']
 
-#show image and User query
-# image.show()
-plt.imshow(image)
-print(f"User Query: {user_query}")
+    #show image and User query
+    # image.show()
+    plt.imshow(image)
+    print(f"User Query: {user_query}")
 
-model_inference(image,user_query)
\ No newline at end of file
+    model_inference(merged_model, processor, device, image, user_query)
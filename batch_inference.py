@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+"""
+Bulk inference with the fine-tuned Qwen2-VL chart QA model
+Streams a dataset split or a local image folder, answers it in batches while the
+next batches are preprocessed on a background thread, and writes answers
+incrementally to JSONL or Parquet. Re-running with the same output resumes
+after the last answer that was written.
+
+Examples:
+    python batch_inference.py --split test --output answers_test.jsonl
+    python batch_inference.py --image-dir charts/ --question "What is the highest value?" --output answers.parquet
+"""
+
+import argparse
+import glob
+import json
+import os
+import queue
+import threading
+import time
+from functools import partial
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".webp", ".bmp", ".gif")
+
+
+def iter_dataset(name, split, start=0, num_shards=1, shard_index=0):
+    """Yield (id, image, question, label) from a streamed Hugging Face dataset split
+
+    With num_shards > 1 only ids equal to shard_index modulo num_shards are
+    yielded; the other samples are skipped before their image is decoded.
+    """
+    from datasets import Image as ImageFeature, load_dataset
+
+    dataset = load_dataset(name, split=split, streaming=True)
+    if start:
+        dataset = dataset.skip(start)
+    image_feature = None
+    if num_shards > 1:
+        # Images stay encoded bytes until a sample is known to belong to this shard
+        image_feature = ImageFeature()
+        dataset = dataset.cast_column("image", ImageFeature(decode=False))
+    for index, sample in enumerate(dataset, start):
+        if image_feature is None:
+            image = sample["image"]
+        elif index % num_shards == shard_index:
+            image = image_feature.decode_example(sample["image"])
+        else:
+            continue
+        yield index, image, sample["query"], sample.get("label")
+
+
+def iter_image_dir(image_dir, question, start=0):
+    """Yield (id, image, question, None) for every image below image_dir, in sorted order"""
+    from PIL import Image
+
+    paths = sorted(
+        path for path in glob.glob(os.path.join(image_dir, "**", "*"), recursive=True)
+        if path.lower().endswith(IMAGE_EXTENSIONS)
+    )
+    for path in paths[start:]:
+        with Image.open(path) as image:
+            image.load()
+        yield os.path.relpath(path, image_dir), image, question, None
+
+
+class JsonlWriter:
+    """Appends one JSON line per answer; the file itself is the checkpoint"""
+
+    def __init__(self, path):
+        self.path = path
+        self.completed = self._recover()
+        self.file = open(path, "a", encoding="utf-8")
+
+    def _recover(self):
+        """Count complete lines and drop a partial last line left by a crash"""
+        if not os.path.exists(self.path):
+            return 0
+        count = 0
+        valid_bytes = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                count += 1
+                valid_bytes += len(line)
+        if valid_bytes != os.path.getsize(self.path):
+            with open(self.path, "r+b") as f:
+                f.truncate(valid_bytes)
+        return count
+
+    def write(self, records):
+        for record in records:
+            self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.completed += len(records)
+
+    def close(self):
+        self.file.close()
+
+
+class ParquetWriter:
+    """Writes answers as numbered Parquet part files; finished parts are the checkpoint
+
+    Answers not yet in a part are lost on a crash and answered again on resume,
+    so parts are kept small: at most rows_per_file answers are at risk.
+    """
+
+    def __init__(self, path, rows_per_file=256):
+        import pyarrow.parquet as pq
+
+        self.pq = pq
+        self.path = path
+        self.rows_per_file = rows_per_file
+        self.rows = []
+        os.makedirs(path, exist_ok=True)
+        # Parts are renamed into place only once complete, so a crash leaves at most a
+        # stray temporary file, and resume counts the renamed parts alone
+        for stray in glob.glob(os.path.join(path, "part-*.parquet.tmp")):
+            os.remove(stray)
+        self.parts = sorted(glob.glob(os.path.join(path, "part-*.parquet")))
+        self.completed = sum(pq.ParquetFile(part).metadata.num_rows for part in self.parts)
+
+    def write(self, records):
+        self.rows.extend(records)
+        if len(self.rows) >= self.rows_per_file:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+        import pyarrow as pa
+
+        part = os.path.join(self.path, f"part-{len(self.parts):05d}.parquet")
+        self.pq.write_table(pa.Table.from_pylist(self.rows), part + ".tmp")
+        os.replace(part + ".tmp", part)
+        self.parts.append(part)
+        self.completed += len(self.rows)
+        self.rows = []
+
+    def close(self):
+        self.flush()
+
+
+def open_writer(output, rows_per_file):
+    """Pick the writer from the output name: *.jsonl or a Parquet directory (*.parquet)"""
+    if output.endswith(".jsonl"):
+        return JsonlWriter(output)
+    if output.endswith(".parquet"):
+        return ParquetWriter(output, rows_per_file)
+    raise ValueError("--output must end with .jsonl or .parquet")
+
+
+def prefetch_batches(samples, processor, batch_size, depth, prepare=None):
+    """Group samples into batches and preprocess them on a background thread
+
+    At most depth batches wait in the buffer, so memory stays bounded when the
+    model is the bottleneck. prepare(batch) builds the model inputs of a batch
+    (by default from the images and questions of its samples).
+    """
+    if prepare is None:
+        from SFT_Qwen2_load_inference import prepare_inputs
+
+        prepare = lambda batch: prepare_inputs(processor, [s[1] for s in batch], [s[2] for s in batch])
+
+    buffer = queue.Queue(maxsize=depth)
+    done = object()
+
+    def produce():
+        try:
+            batch = []
+            for sample in samples:
+                batch.append(sample)
+                if len(batch) == batch_size:
+                    buffer.put((batch, prepare(batch)))
+                    batch = []
+            if batch:
+                buffer.put((batch, prepare(batch)))
+            buffer.put(done)
+        except Exception as e:
+            buffer.put(e)
+
+    threading.Thread(target=produce, name="prefetch", daemon=True).start()
+    while True:
+        item = buffer.get()
+        if item is done:
+            return
+        if isinstance(item, Exception):
+            raise item
+        yield item
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Batched, resumable chart QA inference")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--dataset", default="HuggingFaceM4/ChartQA", help="Hugging Face dataset to stream")
+    source.add_argument("--image-dir", help="Answer every image in this folder instead of a dataset")
+    parser.add_argument("--split", default="test", help="Dataset split to stream")
+    parser.add_argument("--question", help="Question asked about every image of --image-dir")
+    parser.add_argument("--output", required=True, help="answers.jsonl, or answers.parquet (a directory of parts)")
+    parser.add_argument("--lora", default="lora_model_8k", help="LoRA adapter merged into the base model")
+    parser.add_argument("--model-path", help="Baked model directory (skips the LoRA merge)")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--prefetch", type=int, default=4, help="Preprocessed batches buffered ahead of the model")
+    parser.add_argument("--limit", type=int, help="Stop after this many samples in total")
+    parser.add_argument("--prompt-lookup", type=int,
+                        help="Speculative decoding with this many tokens drafted from the prompt text")
+    parser.add_argument("--draft-model", help="Speculative decoding with this small draft model (shares the tokenizer)")
+    parser.add_argument("--rows-per-file", type=int, default=256,
+                        help="Rows per Parquet part file, the most answers a crash can lose")
+    args = parser.parse_args()
+
+    if args.image_dir and not args.question:
+        parser.error("--image-dir needs --question")
+
+    writer = open_writer(args.output, args.rows_per_file)
+    start = writer.completed
+    if start:
+        print(f"Resuming after {start} answers already in {args.output}")
+    if args.limit is not None and start >= args.limit:
+        print("Nothing left to do")
+        return
+
+    from SFT_Qwen2_load_inference import load_model, load_draft_model, generate_answers, speculative_generate_answers
+
+    model, processor, device = load_model(lora_path=args.lora, model_path=args.model_path)
+
+    # Speculative decoding: drafts from the prompt text or a small draft model, verified by the model
+    speculative = {}
+    if args.prompt_lookup or args.draft_model:
+        draft_model = load_draft_model(args.draft_model, device) if args.draft_model else None
+        generate = partial(speculative_generate_answers, prompt_lookup_tokens=args.prompt_lookup,
+                           draft_model=draft_model, stats=speculative)
+    else:
+        generate = generate_answers
+
+    if args.image_dir:
+        samples = iter_image_dir(args.image_dir, args.question, start)
+    else:
+        samples = iter_dataset(args.dataset, args.split, start)
+    if args.limit is not None:
+        samples = (sample for _, sample in zip(range(args.limit - start), samples))
+
+    started_at = time.monotonic()
+    answered = 0
+    try:
+        for batch, inputs in prefetch_batches(samples, processor, args.batch_size, args.prefetch):
+            # Greedy decoding: bulk scoring should be reproducible; rows stop at a complete short answer
+            questions = [question for _, _, question, _ in batch]
+            answers = generate(model, processor, inputs, device, args.max_new_tokens, questions=questions, do_sample=False)
+            writer.write([
+                {"id": sample_id, "question": question, "answer": answer, "label": label}
+                for (sample_id, _, question, label), answer in zip(batch, answers)
+            ])
+            answered += len(batch)
+            elapsed = time.monotonic() - started_at
+            print(f"{start + answered} answered ({answered / elapsed:.2f} samples/s)", flush=True)
+    finally:
+        writer.close()
+
+    print(f"Done: {writer.completed} answers in {args.output}")
+    if speculative:
+        print(f"Speculative decoding: {speculative['tokens_per_forward']} tokens per model forward")
+
+
+if __name__ == "__main__":
+    main()
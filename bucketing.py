@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Token-budget bucketing of samples by sequence length and visual-token count
+Only keys and lengths pass through here, so batches can be planned without
+torch or the samples themselves; chartqa_loader.py turns them into batches.
+"""
+
+import math
+import random
+
+
+def bucket_key(tokens, visual_tokens, ratio):
+    """Samples within a factor ratio of each other in both counts share a bucket"""
+    return int(math.log(max(tokens, 1), ratio)), int(math.log(visual_tokens + 1, ratio))
+
+
+def bucket_batches(entries, max_tokens, max_visual_tokens=None, max_batch_size=None, shuffle_buffer=1024,
+                   bucket_ratio=1.25, seed=0):
+    """Group (key, tokens, visual_tokens) entries into lists of keys within the budgets
+
+    A sample longer than max_tokens on its own becomes a batch of one.
+    """
+    rng = random.Random(seed)
+    buckets = {}  # bucket key -> [keys, longest, visual tokens]
+
+    def add(key, tokens, visual_tokens):
+        bucket_id = bucket_key(tokens, visual_tokens, bucket_ratio)
+        bucket = buckets.get(bucket_id)
+        if bucket is not None:
+            keys, longest, visual = bucket
+            full = ((len(keys) + 1) * max(longest, tokens) > max_tokens
+                    or (max_visual_tokens is not None and visual + visual_tokens > max_visual_tokens)
+                    or (max_batch_size is not None and len(keys) >= max_batch_size))
+            if not full:
+                keys.append(key)
+                bucket[1] = max(longest, tokens)
+                bucket[2] = visual + visual_tokens
+                return None
+        buckets[bucket_id] = [[key], tokens, visual_tokens]
+        return bucket[0] if bucket is not None else None
+
+    # Samples leave the shuffle buffer in random order
+    buffer = []
+    for entry in entries:
+        buffer.append(entry)
+        if len(buffer) < shuffle_buffer:
+            continue
+        position = rng.randrange(len(buffer))
+        buffer[position], buffer[-1] = buffer[-1], buffer[position]
+        batch = add(*buffer.pop())
+        if batch:
+            yield batch
+
+    rng.shuffle(buffer)
+    for entry in buffer:
+        batch = add(*entry)
+        if batch:
+            yield batch
+    # The partly filled buckets, in random order
+    remaining = [bucket[0] for bucket in buckets.values()]
+    rng.shuffle(remaining)
+    yield from remaining
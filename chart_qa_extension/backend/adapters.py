@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+Multi-adapter LoRA serving for the Chart QA backend
+Keeps several adapters resident and unmerged on one base model and routes each batch row through its own adapter
+"""
+
+import logging
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def parse_adapter_spec(spec):
+    """Parse "name=path,name=path" into an ordered name -> path mapping"""
+    adapters = OrderedDict()
+    for entry in filter(None, (part.strip() for part in spec.split(','))):
+        name, sep, path = entry.partition('=')
+        if not sep or not name.strip() or not path.strip():
+            raise ValueError(f"Invalid adapter entry '{entry}', expected name=path")
+        adapters[name.strip()] = path.strip()
+    return adapters
+
+
+def load_adapters(base_model, adapters):
+    """Wrap base_model with every adapter loaded unmerged and return the PeftModel"""
+    # peft is imported on first use so that parsing a spec does not need it
+    from peft import PeftModel
+
+    names = list(adapters)
+    logger.info(f"Loading LoRA adapter '{names[0]}' from {adapters[names[0]]}...")
+    peft_model = PeftModel.from_pretrained(base_model, adapters[names[0]], adapter_name=names[0])
+    for name in names[1:]:
+        logger.info(f"Loading LoRA adapter '{name}' from {adapters[name]}...")
+        peft_model.load_adapter(adapters[name], adapter_name=name)
+    peft_model.eval()
+    return peft_model
+
+
+class AdapterRouter:
+    """Passes per-row adapter names to every LoRA layer so one forward serves mixed adapters"""
+
+    def __init__(self, model, adapter_names):
+        self.model = model
+        self.adapter_names = list(adapter_names)
+        self._handles = []
+
+    def select(self, rows):
+        """Keep only the given rows, mirroring a batch that dropped finished rows"""
+        self.adapter_names = [self.adapter_names[row] for row in rows]
+
+    def _pre_hook(self, module, args, kwargs):
+        # PEFT's layers split the batch by adapter when adapter_names is given
+        kwargs['adapter_names'] = self.adapter_names
+        return args, kwargs
+
+    def __enter__(self):
+        from peft.tuners.lora import LoraLayer
+        from peft.utils import ModulesToSaveWrapper
+
+        for module in self.model.modules():
+            if isinstance(module, (LoraLayer, ModulesToSaveWrapper)):
+                self._handles.append(module.register_forward_pre_hook(self._pre_hook, with_kwargs=True))
+        return self
+
+    def __exit__(self, *exc_info):
+        for handle in self._handles:
+            handle.remove()
+        self._handles = []
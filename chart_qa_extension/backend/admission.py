@@ -0,0 +1,173 @@
+#!/usr/bin/env python3
+"""
+Memory-aware admission control for the Chart QA backend
+A batch needs memory for the KV cache of every row (shared prefix, padded prompt
+and generation budget), for the prefill activations and for the vision tower's
+attention over the image patches, all of which grow with the visual tokens of
+its images. Batches are costed from those sizes against a memory budget: a
+request that does not fit next to the batch being formed waits for the next
+one, and a request too large to fit even alone is downscaled to fewer visual
+tokens before it is queued.
+"""
+
+import logging
+import threading
+from contextlib import contextmanager
+
+logger = logging.getLogger(__name__)
+
+# Hidden-size vectors per token alive during a layer's forward (residual, normed
+# input, attention output, projections), and MLP intermediates (gate, up, product)
+HIDDEN_COPIES = 4
+MLP_COPIES = 3
+
+# Vision patches per visual token (2x2 patch merge)
+PATCHES_PER_TOKEN = 4
+
+# Attention scores and logits are float32
+SCORE_BYTES = 4
+
+
+def to_mb(nbytes):
+    return round(nbytes / 1024 / 1024, 1)
+
+
+class MemoryCostModel:
+    """Estimated peak bytes of a batch, with per-token sizes from a Qwen2-VL config
+
+    Layers run one at a time, so only one layer's activations are counted; the
+    KV cache of every layer stays alive through decode. Without flash attention
+    the score matrices are materialized, which for the vision tower means
+    heads x patches^2 over all images of a batch.
+    """
+
+    def __init__(self, config, dtype_bytes=2, prefix_tokens=0, flash_attention=False):
+        text = config.get_text_config() if hasattr(config, 'get_text_config') else config
+        heads = text.num_attention_heads
+        head_dim = getattr(text, 'head_dim', None) or text.hidden_size // heads
+        kv_heads = getattr(text, 'num_key_value_heads', None) or heads
+        self.prefix_tokens = prefix_tokens
+        self.kv_bytes_per_token = 2 * text.num_hidden_layers * kv_heads * head_dim * dtype_bytes
+        self.prefill_bytes_per_token = (HIDDEN_COPIES * text.hidden_size
+                                        + MLP_COPIES * text.intermediate_size) * dtype_bytes
+        self.logit_bytes = text.vocab_size * SCORE_BYTES
+        self.score_heads = 0 if flash_attention else heads
+
+        # Qwen2-VL names the vision width embed_dim, Qwen2.5-VL hidden_size
+        vision = config.vision_config
+        embed_dim = getattr(vision, 'embed_dim', None) or vision.hidden_size
+        mlp_dim = getattr(vision, 'intermediate_size', None) or int(embed_dim * getattr(vision, 'mlp_ratio', 4))
+        self.vision_bytes_per_patch = (HIDDEN_COPIES * embed_dim + MLP_COPIES * mlp_dim) * dtype_bytes
+        self.vision_score_heads = 0 if flash_attention else vision.num_heads
+
+    @classmethod
+    def from_model(cls, model, prefix_tokens=0):
+        """Cost model of a loaded model, in the dtype of its activations"""
+        dtype_bytes = model.get_input_embeddings().weight.element_size()
+        flash_attention = getattr(model.config, '_attn_implementation', None) == 'flash_attention_2'
+        return cls(model.config, dtype_bytes, prefix_tokens, flash_attention)
+
+    def batch_bytes(self, rows, visual_tokens=0, pad_to=None):
+        """Peak bytes of one generation over rows of (prompt_tokens, max_new_tokens)
+
+        prompt_tokens count everything after the cached prefix, image tokens
+        included; visual_tokens are those of the images the vision tower encodes
+        for the batch (cached images cost nothing there); pad_to is the padded
+        prompt length when it exceeds the longest prompt.
+        """
+        if not rows:
+            return 0
+        count = len(rows)
+        length = max(pad_to or 0, max(prompt for prompt, _ in rows))
+        context = self.prefix_tokens + length
+        kv = count * (context + max(new for _, new in rows)) * self.kv_bytes_per_token
+        prefill = count * (length * (self.prefill_bytes_per_token + self.score_heads * context * SCORE_BYTES)
+                           + self.logit_bytes)
+        patches = PATCHES_PER_TOKEN * visual_tokens
+        vision = patches * self.vision_bytes_per_patch + self.vision_score_heads * patches ** 2 * SCORE_BYTES
+        # The vision tower runs before prefill, so only the larger of the two adds to the cache
+        return kv + max(prefill, vision)
+
+    def largest_image(self, budget, rows=1, text_tokens=0, max_new_tokens=0, limit=None):
+        """Most visual tokens a request of rows rows about one image can use within budget, 0 if none fit"""
+        def cost(visual_tokens):
+            return self.batch_bytes([(text_tokens + visual_tokens, max_new_tokens)] * rows, visual_tokens)
+
+        low, high = 0, limit if limit is not None else 1
+        if limit is None:
+            while cost(high) <= budget:
+                high *= 2
+        if cost(high) <= budget:
+            return high
+        # Cost grows with visual tokens, so bisect for the last size that fits
+        while high - low > 1:
+            middle = (low + high) // 2
+            if cost(middle) <= budget:
+                low = middle
+            else:
+                high = middle
+        return low
+
+
+class AdmissionController:
+    """Admits batches whose estimated peak memory fits a budget, and tracks the bytes in use
+
+    estimate(items) returns the peak bytes of running items as one batch. The
+    budget is per batch: every generation (answers, streams and suggestions)
+    runs on the scheduler's single model worker, one batch at a time, and each
+    forked worker process has a budget of its own.
+    """
+
+    def __init__(self, budget_bytes, estimate):
+        self.budget = int(budget_bytes)
+        self.estimate = estimate
+        self.in_use = 0
+        self._lock = threading.Lock()
+
+        # Simple counters for /status; in_use is the estimate of the running batch
+        self.peak = 0
+        self.last_batch = 0
+        self.batches_over_budget = 0
+        self.downscaled = 0
+
+    def fits(self, items):
+        """Whether items can run together as one batch within the budget"""
+        return self.estimate(items) <= self.budget
+
+    def note_downscaled(self):
+        """Count a request whose image was shrunk to fit the budget"""
+        with self._lock:
+            self.downscaled += 1
+
+    @contextmanager
+    def running(self, items):
+        """Hold the estimated bytes of a batch while it runs"""
+        cost = self.estimate(items)
+        if cost > self.budget:
+            # A single request that does not fit still runs, alone
+            logger.warning(f"Batch of {len(items)} needs an estimated {to_mb(cost)} MB, "
+                           f"over the {to_mb(self.budget)} MB memory budget")
+        with self._lock:
+            if cost > self.budget:
+                self.batches_over_budget += 1
+            self.in_use += cost
+            self.peak = max(self.peak, self.in_use)
+            self.last_batch = cost
+        try:
+            yield cost
+        finally:
+            with self._lock:
+                self.in_use -= cost
+
+    def stats(self):
+        """Budget usage for the status endpoint"""
+        return {
+            'enabled': True,
+            'budget_mb': to_mb(self.budget),
+            'in_use_mb': to_mb(self.in_use),
+            'utilization': round(self.in_use / self.budget, 3) if self.budget else None,
+            'peak_mb': to_mb(self.peak),
+            'last_batch_mb': to_mb(self.last_batch),
+            'batches_over_budget': self.batches_over_budget,
+            'downscaled': self.downscaled,
+        }
@@ -0,0 +1,166 @@
+#!/usr/bin/env python3
+"""
+Content-addressed answer cache for the Chart QA backend
+Keys are a hash of the decoded (resized) pixels plus a normalized question
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+def normalize_question(question):
+    """Lowercase, collapse whitespace and drop trailing punctuation"""
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.rstrip("?.! ")
+
+
+def hash_image(image):
+    """Hash the pixels of a PIL image together with its mode and size"""
+    digest = hashlib.sha256()
+    digest.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+    digest.update(image.tobytes())
+    return digest.hexdigest()
+
+
+class AnswerCache:
+    """Thread-safe LRU cache with TTL, a byte-size cap and an optional on-disk tier"""
+
+    def __init__(self, max_entries=1024, max_bytes=16 * 1024 * 1024, ttl_seconds=3600, disk_dir=None):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.disk_dir = disk_dir
+
+        self._entries = OrderedDict()  # key -> (answer, created_at, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+        if self.disk_dir:
+            os.makedirs(self.disk_dir, exist_ok=True)
+
+    @staticmethod
+    def make_key(image_hash, question, *parts):
+        """Combine an image hash, a normalized question and any extra key parts"""
+        digest = hashlib.sha256(image_hash.encode())
+        for part in (normalize_question(question),) + parts:
+            digest.update(b"\0" + str(part).encode())
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Return the cached answer for key, or None"""
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                answer, created_at, _ = entry
+                if now - created_at <= self.ttl_seconds:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    return answer
+                self._remove(key)
+
+        # Fall back to the disk tier and promote hits into memory
+        answer, created_at = self._disk_get(key, now)
+        with self._lock:
+            if answer is None:
+                self.misses += 1
+                return None
+            self.disk_hits += 1
+            self._insert(key, answer, created_at)
+        return answer
+
+    def put(self, key, answer):
+        """Store an answer in memory and, if enabled, on disk"""
+        created_at = time.time()
+        with self._lock:
+            self._insert(key, answer, created_at)
+        self._disk_put(key, answer, created_at)
+
+    def clear(self):
+        """Drop every in-memory entry"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Cache counters for the status endpoint"""
+        with self._lock:
+            lookups = self.hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'ttl_seconds': self.ttl_seconds,
+                'disk_dir': self.disk_dir,
+                'hits': self.hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round((self.hits + self.disk_hits) / lookups, 4) if lookups else 0.0,
+            }
+
+    def _insert(self, key, answer, created_at):
+        """Insert under the lock and evict least recently used entries over the caps"""
+        if key in self._entries:
+            self._remove(key)
+        size = len(key) + len(answer.encode())
+        if size > self.max_bytes:
+            return
+        self._entries[key] = (answer, created_at, size)
+        self._bytes += size
+        while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+            oldest = next(iter(self._entries))
+            self._remove(oldest)
+            self.evictions += 1
+
+    def _remove(self, key):
+        _, _, size = self._entries.pop(key)
+        self._bytes -= size
+
+    def _disk_path(self, key):
+        return os.path.join(self.disk_dir, key[:2], f"{key}.json")
+
+    def _disk_get(self, key, now):
+        if not self.disk_dir:
+            return None, None
+        path = self._disk_path(key)
+        try:
+            with open(path) as f:
+                record = json.load(f)
+        except (OSError, ValueError):
+            return None, None
+        if now - record['created_at'] > self.ttl_seconds:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            return None, None
+        return record['answer'], record['created_at']
+
+    def _disk_put(self, key, answer, created_at):
+        if not self.disk_dir:
+            return
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            # Write then rename so readers never see a partial file
+            tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'w') as f:
+                json.dump({'answer': answer, 'created_at': created_at}, f)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not write answer cache entry to disk: {str(e)}")
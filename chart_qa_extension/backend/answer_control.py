@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+"""
+Answer-aware generation control for the Chart QA backend
+ChartQA answers are a number, a label or yes/no. The question type sets a token
+budget, and generation of a row stops as soon as its text holds a complete short
+answer followed by a terminator, instead of decoding an explanation nobody reads.
+"""
+
+import re
+
+# Token budgets per question type; the server's max_new_tokens caps all of them
+BUDGETS = {
+    'yes_no': 4,
+    'number': 16,
+    'label': 24,
+    'open': None,
+}
+
+YES_NO_QUESTION = re.compile(
+    r'^\s*(is|are|was|were|does|do|did|has|have|had|can|could|will|would|should)\b', re.IGNORECASE)
+NUMBER_QUESTION = re.compile(
+    r'\b(how (many|much)|what (is|was|are|were) the (value|number|amount|total|sum|difference|average|mean|'
+    r'median|ratio|percentage|share|rate|gap|maximum|minimum|highest value|lowest value)|what percent(age)?|'
+    r'sum of|difference between|average of|ratio of|by how much)\b', re.IGNORECASE)
+LABEL_QUESTION = re.compile(
+    r'^\s*(which|who|where|when|what ((is|was) the )?(year|month|day|country|color|colour|category|label|name|title))\b',
+    re.IGNORECASE)
+
+# A short answer counts as complete once something that cannot extend it follows:
+# a line break, or sentence punctuation followed by a space
+NUMBER_ANSWER = re.compile(r'^\s*([-+]?[$€£]?\d[\d,]*(?:\.\d+)?\s*%?)(?:\s*\n|[.,;:]\s)')
+YES_NO_ANSWER = re.compile(r'^\s*(yes|no)(?=[\s,.!;:])', re.IGNORECASE)
+LINE_ANSWER = re.compile(r'^\s*([^\n]+?)\s*\n')
+
+
+def question_type(question):
+    """yes_no, number, label or open"""
+    if YES_NO_QUESTION.search(question):
+        return 'yes_no'
+    if NUMBER_QUESTION.search(question):
+        return 'number'
+    if LABEL_QUESTION.search(question):
+        return 'label'
+    return 'open'
+
+
+def complete_answer(text, kind):
+    """The short answer at the start of text if it is already complete, else None"""
+    if kind == 'open':
+        return None
+    if kind == 'yes_no':
+        match = YES_NO_ANSWER.match(text)
+        if match:
+            return match.group(1)
+    if kind in ('number', 'yes_no'):
+        match = NUMBER_ANSWER.match(text)
+        if match:
+            return match.group(1).strip()
+    # Anything on a first line of its own is the answer, whatever its shape
+    match = LINE_ANSWER.match(text)
+    return match.group(1) if match else None
+
+
+class AnswerControl:
+    """Token budget, stop test and final trimming for one question"""
+
+    def __init__(self, question, max_new_tokens):
+        self.kind = question_type(question)
+        budget = BUDGETS[self.kind]
+        self.max_new_tokens = min(budget, max_new_tokens) if budget else max_new_tokens
+
+    def is_complete(self, text):
+        return complete_answer(text, self.kind) is not None
+
+    def finalize(self, text):
+        """The answer without whatever was generated after it"""
+        answer = complete_answer(text, self.kind)
+        return answer if answer is not None else text.strip()
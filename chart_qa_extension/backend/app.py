@@ -5,17 +5,31 @@ Serves the fine-tuned Qwen2-VL model for image analysis
 """
 
 import os
-import sys
-import base64
-import io
-import torch
-from flask import Flask, request, jsonify
+from flask import Flask, Response, request, jsonify
 from flask_cors import CORS
-from PIL import Image
 import logging
-from transformers import Qwen2VLForConditionalGeneration, AutoProcessor, TextStreamer
-from peft import PeftModel
 import traceback
+import threading
+import json
+import time
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from functools import partial
+from batching import BatchScheduler, QueueFullError
+from answer_cache import AnswerCache, hash_image
+from vision_cache import VisionFeatureCache
+from adapters import parse_adapter_spec
+from streaming import TokenStream, format_sse
+from stub_model import StubModel, StubProcessor
+from resolution import ResolutionPolicy, smart_resize, PRESETS, TOKEN_PIXELS
+from metrics import MetricsRegistry, timed, TOKEN_BUCKETS, PIXEL_BUCKETS, RATE_BUCKETS
+from suggestions import question_prompt, parse_questions
+from answer_control import AnswerControl
+from workers import Dispatcher, WorkerPool, create_dispatcher_app
+from readiness import Readiness, LOADING, WARMING, READY, FAILED
+from warmup import QUESTION_ALLOWANCE, WARMUP_QUESTION, bucket_length, parse_buckets, warmup_charts
+from admission import AdmissionController, MemoryCostModel, to_mb
+# torch, transformers, peft and PIL are imported where the model is loaded and
+# run, so importing this module (the dispatcher, the stub model) needs only Flask
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -23,205 +37,1586 @@ logger = logging.getLogger(__name__)
 
 app = Flask(__name__)
 CORS(app)  # Enable CORS for Chrome extension
+app.config['MAX_CONTENT_LENGTH'] = int(float(os.environ.get('CHARTQA_MAX_UPLOAD_MB', '32')) * 1024 * 1024)
+
+# Model configuration
+MODEL_ID = "Qwen/Qwen2-VL-2B-Instruct"
+LORA_PATH = os.environ.get('CHARTQA_LORA_PATH', "/Users/gauravatavale/Documents/AI_research/chartQA_finetuning/lora_model_1k")
+# Pre-merged model written by bake_model.py, loaded instead of base + LoRA when set
+MODEL_PATH = os.environ.get('CHARTQA_MODEL_PATH') or None
+
+# Multi-adapter serving: "name=path,name=path" keeps every adapter unmerged on one
+# base model and each request picks one by name (falls back to DEFAULT_ADAPTER)
+ADAPTERS = parse_adapter_spec(os.environ.get('CHARTQA_ADAPTERS', ''))
+DEFAULT_ADAPTER = os.environ.get('CHARTQA_DEFAULT_ADAPTER') or next(iter(ADAPTERS), 'default')
+
+# Deterministic stand-in model for benchmarking without Qwen2-VL (see stub_model.py)
+STUB_MODEL = os.environ.get('CHARTQA_STUB_MODEL', '0') == '1'
+STUB_PREFILL_MS = float(os.environ.get('CHARTQA_STUB_PREFILL_MS', '50'))
+STUB_IMAGE_MS = float(os.environ.get('CHARTQA_STUB_IMAGE_MS', '20'))
+STUB_TOKEN_MS = float(os.environ.get('CHARTQA_STUB_TOKEN_MS', '10'))
+
+# Runtime configuration: device override, CPU threads and quantization
+# (QUANTIZE is auto, int8 or none; auto means int8 on CPU only)
+DEVICE = os.environ.get('CHARTQA_DEVICE') or None
+NUM_THREADS = int(os.environ.get('CHARTQA_NUM_THREADS', '0')) or None
+NUM_INTEROP_THREADS = int(os.environ.get('CHARTQA_NUM_INTEROP_THREADS', '0')) or None
+QUANTIZE = os.environ.get('CHARTQA_QUANTIZE', 'auto')
+
+# Micro-batching configuration
+MAX_BATCH_SIZE = int(os.environ.get('CHARTQA_MAX_BATCH_SIZE', '8'))
+MAX_BATCH_WAIT_MS = float(os.environ.get('CHARTQA_MAX_BATCH_WAIT_MS', '10'))
+
+# Preprocessing pool: threads that render prompts, tokenize and build vision inputs for
+# queued requests while the model runs the current batch (0 = do it on the model worker),
+# and how many prepared requests may wait for the model (0 = twice the batch size)
+PREPROCESS_WORKERS = int(os.environ.get('CHARTQA_PREPROCESS_WORKERS', '2'))
+PREPARED_BUFFER = int(os.environ.get('CHARTQA_PREPARED_BUFFER', '0'))
+
+# Backpressure configuration: requests beyond the queue limit get a fast 429
+MAX_QUEUE_SIZE = int(os.environ.get('CHARTQA_MAX_QUEUE_SIZE', '64'))
+REQUEST_TIMEOUT_SECONDS = float(os.environ.get('CHARTQA_REQUEST_TIMEOUT_SECONDS', '60'))
+STARTUP_RETRY_AFTER = 5  # seconds clients are told to wait while the model loads
+
+# Memory-aware admission: batches are costed (KV cache plus activations) against a
+# budget in MB, and requests that do not fit wait for a later batch or, if too large
+# alone, are downscaled. auto budgets MEMORY_HEADROOM of the memory left free once
+# the model is warm; 0 turns admission off
+MEMORY_BUDGET_MB = os.environ.get('CHARTQA_MEMORY_BUDGET_MB', 'auto')
+MEMORY_HEADROOM = float(os.environ.get('CHARTQA_MEMORY_HEADROOM', '0.8'))
+
+# Multi-process serving: forked model workers share the weights loaded once in the
+# supervisor; 0 or 1 serves from this process. Worker threads default to an even
+# share of the cores
+WORKERS = int(os.environ.get('CHARTQA_WORKERS', '0'))
+WORKER_THREADS = int(os.environ.get('CHARTQA_WORKER_THREADS', '0')) or None
+
+# Startup warmup and compiled inference: synthetic charts run through the batch
+# path once per shape bucket before the server reports ready. With compile on,
+# prompts are padded to the buckets so the compiled graphs are reused
+WARMUP = os.environ.get('CHARTQA_WARMUP', '1') == '1'
+COMPILE = os.environ.get('CHARTQA_COMPILE', '0') == '1'
+COMPILE_MODE = os.environ.get('CHARTQA_COMPILE_MODE') or None
+SHAPE_BUCKETS = parse_buckets(os.environ.get('CHARTQA_SHAPE_BUCKETS', ''))
+
+# Production server configuration (waitress)
+PRODUCTION = os.environ.get('CHARTQA_PRODUCTION', '0') == '1'
+SERVER_THREADS = int(os.environ.get('CHARTQA_SERVER_THREADS', '32'))
+SERVER_CONNECTION_LIMIT = int(os.environ.get('CHARTQA_SERVER_CONNECTION_LIMIT', '256'))
+
+# Answer cache configuration (set CHARTQA_CACHE_DIR to enable the disk tier)
+CACHE_MAX_ENTRIES = int(os.environ.get('CHARTQA_CACHE_MAX_ENTRIES', '4096'))
+CACHE_MAX_MB = float(os.environ.get('CHARTQA_CACHE_MAX_MB', '32'))
+CACHE_TTL_SECONDS = float(os.environ.get('CHARTQA_CACHE_TTL_SECONDS', '86400'))
+CACHE_DIR = os.environ.get('CHARTQA_CACHE_DIR') or None
+
+# Vision feature cache configuration (image embeddings kept on the model device)
+VISION_CACHE_MAX_ENTRIES = int(os.environ.get('CHARTQA_VISION_CACHE_MAX_ENTRIES', '64'))
+VISION_CACHE_MAX_MB = float(os.environ.get('CHARTQA_VISION_CACHE_MAX_MB', '512'))
+
+# Visual-token budget: default preset (fast, balanced, accurate or auto) and optional
+# server-wide pixel bounds used instead of the default preset's
+RESOLUTION = os.environ.get('CHARTQA_RESOLUTION', 'accurate')
+MIN_PIXELS = int(os.environ.get('CHARTQA_MIN_PIXELS', '0')) or None
+MAX_PIXELS = int(os.environ.get('CHARTQA_MAX_PIXELS', '0')) or None
+
+SYSTEM_MESSAGE = "You are a helpful assistant who can analyze the given images in detail and answer the question appropriately."
+VISION_START_TOKEN = "<|vision_start|>"
+VISION_END_TOKEN = "<|vision_end|>"
+
+# Generation settings: max_new_tokens caps the per-question-type budgets of
+# answer_control.py; greedy decoding (the default) makes answers reproducible
+MAX_NEW_TOKENS = 64  # Reduced from 128 to save memory
+DECODING = os.environ.get('CHARTQA_DECODING', 'greedy')
+TEMPERATURE = 1.0    # Reduced from 1.5, used with CHARTQA_DECODING=sample
+
+# Question suggestions (/suggest): default and largest number of questions, and
+# the generation budget per requested question
+SUGGEST_COUNT = int(os.environ.get('CHARTQA_SUGGEST_COUNT', '5'))
+MAX_SUGGEST_COUNT = int(os.environ.get('CHARTQA_MAX_SUGGEST_COUNT', '16'))
+QUESTION_TOKENS = 32
+
+# Speculative decoding: off, prompt_lookup (drafts copied from the prompt and answer
+# text) or draft_model (a small text-only model sharing the tokenizer, CHARTQA_DRAFT_MODEL)
+SPECULATIVE = os.environ.get('CHARTQA_SPECULATIVE', 'off')
+DRAFT_MODEL = os.environ.get('CHARTQA_DRAFT_MODEL') or None
+DRAFT_TOKENS = int(os.environ.get('CHARTQA_DRAFT_TOKENS', '6'))
+
+# Streaming configuration (seconds without a new event before a stream is abandoned)
+STREAM_TIMEOUT_SECONDS = float(os.environ.get('CHARTQA_STREAM_TIMEOUT_SECONDS', '120'))
 
 # Global variables for model
 model = None
+peft_model = None  # set only when several adapters are served
+adapters = {}  # adapter name -> path it was loaded from
 processor = None
 device = None
+scheduler = None
+admission = None  # AdmissionController when a memory budget is set
+memory_model = None  # MemoryCostModel behind it
+quantization = None
+model_bytes = None
+model_path = None  # baked model directory, when one is served
+prefix_caches = {}  # adapter name -> PrefixCache
+prefix_text = None
+sampling = None
+eos_token_ids = None
+drafter = None
+active_streams = {}  # request_id -> TokenStream
+readiness = Readiness()  # startup state reported on /health and /status
+warmup_seconds = {}  # shape bucket -> seconds its warmup batches took
+answer_cache = AnswerCache(
+    max_entries=CACHE_MAX_ENTRIES,
+    max_bytes=int(CACHE_MAX_MB * 1024 * 1024),
+    ttl_seconds=CACHE_TTL_SECONDS,
+    disk_dir=CACHE_DIR,
+)
+vision_cache = VisionFeatureCache(
+    max_entries=VISION_CACHE_MAX_ENTRIES,
+    max_bytes=int(VISION_CACHE_MAX_MB * 1024 * 1024),
+)
+resolution_policy = ResolutionPolicy(RESOLUTION, MIN_PIXELS, MAX_PIXELS)
+
+# Metrics exposed in Prometheus text format on /metrics
+metrics = MetricsRegistry()
+stage_seconds = metrics.histogram('stage_seconds', 'Seconds a request spent in each processing stage')
+image_pixels = metrics.histogram('image_pixels', 'Pixels of each decoded, resized input image', PIXEL_BUCKETS)
+visual_tokens = metrics.histogram('visual_tokens', 'Visual tokens per image after patch merging', TOKEN_BUCKETS)
+prompt_tokens = metrics.histogram('prompt_tokens', 'Prompt tokens per request, image tokens included', TOKEN_BUCKETS)
+generated_tokens = metrics.histogram('generated_tokens', 'Tokens generated per request', TOKEN_BUCKETS)
+generation_rate = metrics.histogram('generation_tokens_per_second', 'Generated tokens per second of prefill plus decode', RATE_BUCKETS)
+answers_total = metrics.counter('answers_total', 'Answers returned, by source (model or cache)')
+draft_tokens_total = metrics.counter('draft_tokens_total', 'Speculative draft tokens, by result (accepted or rejected)')
+http_requests_total = metrics.counter('http_requests_total', 'HTTP requests by endpoint and status code')
+metrics.gauge('queue_depth', 'Requests waiting for the model worker', lambda: scheduler.queue_depth() if scheduler else None)
+metrics.gauge('memory_budget_bytes', 'Memory budget of admission control and the bytes in use', lambda: {
+    (('kind', 'budget'),): admission.budget,
+    (('kind', 'in_use'),): admission.in_use,
+} if admission else None)
+metrics.gauge('active_streams', 'Open streaming responses', lambda: len(active_streams))
+
+def memory_gauge():
+    """Resident, peak resident and model weight bytes for the memory_bytes gauge"""
+    from runtime import process_memory
+    
+    memory = process_memory()
+    return {
+        (('kind', 'rss'),): (memory['rss_mb'] or 0) * 1024 * 1024,
+        (('kind', 'peak_rss'),): memory['peak_rss_mb'] * 1024 * 1024,
+        (('kind', 'model'),): model_bytes,
+    }
+
+metrics.gauge('memory_bytes', 'Resident, peak resident and model weight memory', memory_gauge)
+metrics.gauge('cache_hit_rate', 'Hit rate of the answer and vision feature caches', lambda: {
+    (('cache', 'answer'),): answer_cache.stats()['hit_rate'],
+    (('cache', 'vision'),): vision_cache.stats()['hit_rate'],
+})
+
+def load_model(start_worker=True):
+    """Load the fine-tuned model and processor
 
-def load_model():
-    """Load the fine-tuned model and processor"""
-    global model, processor, device
+    With start_worker=False only the weights are loaded, for a supervisor that
+    forks the model workers (see run_workers).
+    """
+    global model, peft_model, adapters, processor, device, sampling, eos_token_ids, quantization, model_bytes, drafter
+    global model_path
     
     try:
-        logger.info("Loading model...")
+        if STUB_MODEL:
+            readiness.advance(LOADING, 'stub model', 0.1)
+            load_stub_model()
+            return start_model_worker() if start_worker else True
+        
+        from adapters import load_adapters
+        from model_loader import is_baked_model, load_baked_model, load_processor, load_base_model, merge_lora
+        from runtime import select_device, default_dtype, configure_threads, quantize_int8, model_memory_bytes
+        from speculative import DraftModelDrafter, PromptLookupDrafter, load_draft_model
+        from warmup import compile_decoder
         
-        # Model configuration
-        model_id = "Qwen/Qwen2-VL-2B-Instruct"
-        lora_path = "/Users/gauravatavale/Documents/AI_research/chartQA_finetuning/lora_model_1k"
+        logger.info("Loading model...")
         
         # Check hardware availability
-        device = "cuda" if torch.cuda.is_available() else "mps"
+        readiness.advance(LOADING, 'device', 0.02)
+        device = select_device(DEVICE)
         logger.info(f"Using device: {device}")
+        torch_dtype = default_dtype(device)
+        # A supervisor that forks workers loads single-threaded (see run_workers)
+        if device == "cpu" and start_worker:
+            configure_threads(NUM_THREADS, NUM_INTEROP_THREADS)
         
-        # Load processor
-        logger.info("Loading processor...")
-        processor = AutoProcessor.from_pretrained(
-            model_id,
-            trust_remote_code=True,
-        )
+        if ADAPTERS:
+            if DEFAULT_ADAPTER not in ADAPTERS:
+                raise ValueError(f"Default adapter '{DEFAULT_ADAPTER}' is not in CHARTQA_ADAPTERS")
+            if MODEL_PATH:
+                logger.warning("CHARTQA_MODEL_PATH is ignored when CHARTQA_ADAPTERS is set")
+            
+            # Every adapter stays resident and unmerged next to the shared base weights
+            logger.info("Loading processor...")
+            readiness.advance(LOADING, 'processor', 0.05)
+            processor = load_processor(MODEL_ID)
+            readiness.advance(LOADING, 'weights', 0.1)
+            peft_model = load_adapters(load_base_model(MODEL_ID, device, torch_dtype), ADAPTERS)
+            peft_model.set_adapter(DEFAULT_ADAPTER)
+            model = peft_model.get_base_model()
+            adapters = dict(ADAPTERS)
+        elif is_baked_model(MODEL_PATH):
+            # Fast path: weights are already merged, just map them in
+            logger.info(f"Loading baked model from {MODEL_PATH}...")
+            readiness.advance(LOADING, 'processor', 0.05)
+            processor = load_processor(MODEL_PATH)
+            readiness.advance(LOADING, 'weights', 0.1)
+            model = load_baked_model(MODEL_PATH, device, torch_dtype)
+            adapters = {DEFAULT_ADAPTER: MODEL_PATH}
+            model_path = MODEL_PATH
+        else:
+            if MODEL_PATH:
+                logger.warning(f"{MODEL_PATH} is not a baked model, merging the LoRA adapter instead")
+            
+            # Load processor
+            logger.info("Loading processor...")
+            readiness.advance(LOADING, 'processor', 0.05)
+            processor = load_processor(MODEL_ID)
+            
+            # Load base model and merge LoRA
+            readiness.advance(LOADING, 'weights', 0.1)
+            model = merge_lora(MODEL_ID, LORA_PATH, device, torch_dtype)
+            model = model.to(device)
+            adapters = {DEFAULT_ADAPTER: LORA_PATH}
         
-        # Load base model
-        logger.info("Loading base model...")
-        base_model = Qwen2VLForConditionalGeneration.from_pretrained(
-            model_id,
-            device_map=None,
-            torch_dtype=torch.bfloat16 if device == "cuda" else torch.float32,
-        ).to(device)
+        # Left padding so every row of a batch ends at the generation prompt
+        processor.tokenizer.padding_side = 'left'
+        model.eval()
         
-        # Load and merge LoRA
-        logger.info("Loading LoRA adapter...")
-        model_with_lora = PeftModel.from_pretrained(base_model, lora_path)
-        model = model_with_lora.merge_and_unload()
+        # int8 dynamic quantization of the base linear layers for CPU serving
+        # (unmerged LoRA weights stay in floating point)
+        if QUANTIZE == 'int8' or (QUANTIZE == 'auto' and device == "cpu"):
+            if device != "cpu":
+                raise ValueError("int8 dynamic quantization is only supported on CPU")
+            logger.info("Quantizing linear layers to int8...")
+            readiness.advance(LOADING, 'quantization', 0.7)
+            model = quantize_int8(model)
+            quantization = 'int8'
         
-        model = model.to(device)
-        model.eval()
+        model_bytes = model_memory_bytes(model)
+        logger.info(f"Model weights: {model_bytes / 1024 / 1024:.0f} MB")
+        
+        # Graphs are compiled on first use, so during warmup rather than here
+        if COMPILE:
+            logger.info(f"Compiling the decoder (mode {COMPILE_MODE or 'default'}, buckets {SHAPE_BUCKETS})...")
+            compile_decoder(model, COMPILE_MODE)
+        
+        # Greedy by default; sampling uses the model's own top-k/top-p defaults, as generate() did
+        generation_config = model.generation_config
+        if DECODING == 'greedy':
+            sampling = {'do_sample': False}
+        elif DECODING == 'sample':
+            sampling = {
+                'do_sample': True,
+                'temperature': TEMPERATURE,
+                'top_k': generation_config.top_k,
+                'top_p': generation_config.top_p,
+            }
+        else:
+            raise ValueError(f"Unknown CHARTQA_DECODING '{DECODING}' (use greedy or sample)")
+        eos = generation_config.eos_token_id
+        eos_token_ids = set(eos if isinstance(eos, (list, tuple)) else [eos])
+        eos_token_ids.add(processor.tokenizer.eos_token_id)
+        
+        # Optional speculative decoding; every draft is verified by the served model
+        if SPECULATIVE == 'prompt_lookup':
+            drafter = PromptLookupDrafter(DRAFT_TOKENS)
+        elif SPECULATIVE == 'draft_model':
+            if not DRAFT_MODEL:
+                raise ValueError("CHARTQA_SPECULATIVE=draft_model needs CHARTQA_DRAFT_MODEL")
+            logger.info(f"Loading draft model {DRAFT_MODEL}...")
+            readiness.advance(LOADING, 'draft model', 0.8)
+            vocab_size = model.get_input_embeddings().num_embeddings
+            drafter = DraftModelDrafter(load_draft_model(DRAFT_MODEL, device, torch_dtype, vocab_size), DRAFT_TOKENS)
+        elif SPECULATIVE != 'off':
+            raise ValueError(f"Unknown CHARTQA_SPECULATIVE '{SPECULATIVE}' (use off, prompt_lookup, draft_model)")
+        if drafter is not None:
+            logger.info(f"Speculative decoding: {drafter.name}, up to {DRAFT_TOKENS} draft tokens per step")
         
         logger.info("Model loaded successfully!")
-        return True
+        readiness.advance(LOADING, 'loaded', 0.85)
+        return start_model_worker() if start_worker else True
         
     except Exception as e:
         logger.error(f"Error loading model: {str(e)}")
         logger.error(traceback.format_exc())
+        readiness.fail(e)
         return False
 
-def analyze_image(image_data, question):
-    """Analyze image with the loaded model"""
-    global model, processor, device
+def load_model_in_background():
+    """Load the model on a background thread so the server can listen meanwhile"""
+    return readiness.run_in_background(load_model)
+
+def start_model_worker():
+    """Build the prefix caches and start the micro-batching worker that owns all generate calls"""
+    global scheduler, admission
     
     try:
-        # Convert base64 to PIL Image
-        image_bytes = base64.b64decode(image_data)
-        image = Image.open(io.BytesIO(image_bytes))
-        
-        # Convert to RGB if necessary
-        if image.mode != 'RGB':
-            image = image.convert('RGB')
-        
-        # Resize image if it's too large to prevent memory issues
-        max_size = 1024  # Maximum width or height
-        if image.width > max_size or image.height > max_size:
-            # Calculate new size maintaining aspect ratio
-            ratio = min(max_size / image.width, max_size / image.height)
-            new_width = int(image.width * ratio)
-            new_height = int(image.height * ratio)
-            image = image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-            logger.info(f"Resized image from {image.width}x{image.height} to {new_width}x{new_height}")
-        
-        # Prepare conversation format
-        system_message = "You are a helpful assistant who can analyze the given images in detail and answer the question appropriately."
-        
-        msg = [
-            {
-                "role": "user",
-                "content": [
-                    {"type": "text", "text": system_message},
-                    {"type": "image", "image": image},
-                    {"type": "text", "text": question}
-                ]
-            }
-        ]
-        
-        # Apply chat template
-        text = processor.apply_chat_template(
-            msg,
-            tokenize=False,
-            add_generation_prompt=True
-        )
+        if scheduler is not None:
+            return True
         
-        # Process inputs
-        inputs = processor(
-            image,
-            text,
-            add_special_tokens=False,
-            return_tensors="pt",
-        ).to(device)
-        
-        # Generate response with memory optimization
-        with torch.no_grad():
-            outputs = model.generate(
-                **inputs,
-                max_new_tokens=64,  # Reduced from 128 to save memory
-                use_cache=True,
-                temperature=1.0,    # Reduced from 1.5
-                do_sample=True,
-                pad_token_id=processor.tokenizer.eos_token_id,
-                num_beams=1,        # Use greedy decoding to save memory
-                early_stopping=True
+        readiness.advance(WARMING, 'prefix cache', 0.9)
+        if STUB_MODEL:
+            scheduler = BatchScheduler(partial(model.run_batch, is_cancelled=is_cancelled),
+                                       MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, MAX_QUEUE_SIZE)
+        else:
+            build_prefix_cache()
+            if WARMUP or COMPILE:
+                warm_up()
+            # Measured after warmup, so the budget is what is left once the model is warm
+            admission = build_admission()
+            scheduler = BatchScheduler(
+                run_batch, MAX_BATCH_SIZE, MAX_BATCH_WAIT_MS, MAX_QUEUE_SIZE,
+                prepare=prepare_item if PREPROCESS_WORKERS > 0 else None,
+                prepare_workers=PREPROCESS_WORKERS or 1,
+                max_prepared=PREPARED_BUFFER or None,
+                admission=admission,
             )
+        scheduler.start()
+        readiness.advance(READY)
+        return True
         
-        # Decode response
-        response_text = processor.decode(outputs[0], skip_special_tokens=True)
+    except Exception as e:
+        logger.error(f"Error starting the model worker: {str(e)}")
+        logger.error(traceback.format_exc())
+        readiness.fail(e)
+        return False
+
+def load_stub_model():
+    """Serve the deterministic stand-in model instead of Qwen2-VL"""
+    global model, adapters, processor, device
+    
+    logger.warning("CHARTQA_STUB_MODEL is set: serving simulated answers, not the real model")
+    model = StubModel(STUB_PREFILL_MS, STUB_IMAGE_MS, STUB_TOKEN_MS, MAX_NEW_TOKENS)
+    processor = StubProcessor()
+    device = "cpu"
+    adapters = {DEFAULT_ADAPTER: 'stub'}
+
+def build_prompt(question):
+    """Render the chat template for a single image + question"""
+    msg = [
+        {
+            "role": "user",
+            "content": [
+                {"type": "text", "text": SYSTEM_MESSAGE},
+                {"type": "image"},
+                {"type": "text", "text": question}
+            ]
+        }
+    ]
+    
+    return processor.apply_chat_template(
+        msg,
+        tokenize=False,
+        add_generation_prompt=True
+    )
+
+def expand_image_tokens(text, grid_thw):
+    """Expand the image placeholder into one pad token per merged vision patch"""
+    image_token = getattr(processor, 'image_token', '<|image_pad|>')
+    num_tokens = int(grid_thw.prod()) // processor.image_processor.merge_size ** 2
+    return text.replace(image_token, image_token * num_tokens, 1)
+
+def resolve_adapter(name):
+    """Return the adapter a request asked for, or the default one"""
+    name = name or DEFAULT_ADAPTER
+    if name not in adapters:
+        raise ValueError(f"Unknown adapter '{name}' (available: {', '.join(adapters)})")
+    return name
+
+def activate_adapter(name):
+    """Make name the adapter used by whole-model forwards (no-op with a merged model)"""
+    if peft_model is not None:
+        peft_model.set_adapter(name)
+
+def grid_for_image(image):
+    """The (t, h, w) patch grid the image processor will produce for an image"""
+    import torch
+    
+    image_processor = processor.image_processor
+    height, width = smart_resize(
+        image.height, image.width,
+        image_processor.min_pixels, image_processor.max_pixels,
+        factor=image_processor.patch_size * image_processor.merge_size,
+    )
+    return torch.tensor([1, height // image_processor.patch_size, width // image_processor.patch_size])
+
+def preprocess_image(image):
+    """CPU-side vision inputs of one image: (pixel_values, grid_thw)"""
+    image_inputs = processor.image_processor(images=[image], return_tensors="pt")
+    return image_inputs['pixel_values'], image_inputs['image_grid_thw'][0]
+
+def encode_images(vision_inputs):
+    """Run the vision tower once over a list of (pixel_values, grid_thw), returning (embeds, grid_thw) per image"""
+    import torch
+    
+    visual_dtype = next(model.visual.parameters()).dtype
+    pixel_values = torch.cat([pixels for pixels, _ in vision_inputs]).to(device, dtype=visual_dtype)
+    grid_thw = torch.stack([grid for _, grid in vision_inputs]).to(device)
+    
+    with torch.no_grad():
+        image_embeds = model.visual(pixel_values, grid_thw=grid_thw)
+    
+    # Split the concatenated embeddings back into one chunk per image
+    merge_length = processor.image_processor.merge_size ** 2
+    counts = (grid_thw.prod(-1) // merge_length).tolist()
+    return list(zip(image_embeds.split(counts), grid_thw))
+
+def get_image_features(batch):
+    """Look up the vision features of every image in a batch, encoding only the misses"""
+    features = {}
+    missing = {}  # adapter -> {key: item}
+    for item in batch:
+        key = feature_key(item)
+        if key in features or key in missing.get(item['adapter'], {}):
+            continue
+        cached = vision_cache.get(key)
+        if cached is not None:
+            features[key] = cached
+        else:
+            missing.setdefault(item['adapter'], {})[key] = item
+    
+    # Patch rows do not map to requests, so each adapter encodes its own images
+    for adapter, items in missing.items():
+        activate_adapter(adapter)
+        # Pixels were normally prepared ahead; an image evicted from the cache since then is done here
+        vision_inputs = [item.get('vision_inputs') or preprocess_image(item['image']) for item in items.values()]
+        for key, (embeds, grid_thw) in zip(items, encode_images(vision_inputs)):
+            vision_cache.put(key, embeds, grid_thw)
+            features[key] = (embeds, grid_thw)
+    
+    return [features[feature_key(item)] for item in batch]
+
+def feature_key(item):
+    """Vision cache key of a request (the vision tower carries LoRA weights too, so it is per adapter)"""
+    return f"{item['adapter']}:{item['image_hash']}"
+
+def prepare_item(item):
+    """CPU work of one request, run ahead of the model worker: suffix token ids and vision inputs"""
+    started_at = time.perf_counter()
+    
+    # The vision tower only needs pixels for images it has not cached
+    if feature_key(item) not in vision_cache:
+        item['vision_inputs'] = preprocess_image(item['image'])
+    
+    # Suggestion prompts are only known once the questions have been generated
+    if item.get('kind') == 'suggest':
+        item['timings']['prepare'] = time.perf_counter() - started_at
+        return
+    
+    text = expand_image_tokens(build_prompt(item['question']), grid_for_image(item['image']))
+    if not text.startswith(prefix_text):
+        raise ValueError("Prompt does not start with the cached prefix")
+    item['suffix_ids'] = processor.tokenizer(text[len(prefix_text):], add_special_tokens=False)['input_ids']
+    item['control'] = AnswerControl(item['question'], MAX_NEW_TOKENS)
+    
+    item['timings']['prepare'] = time.perf_counter() - started_at
+
+def build_prefix_cache():
+    """Precompute the KV cache of the prompt header shared by every request, per adapter"""
+    global prefix_caches, prefix_text
+    
+    from prefix_cache import PrefixCache
+    
+    # Everything before the image is identical for every question
+    prefix_text = build_prompt("").split(VISION_START_TOKEN)[0]
+    prefix_ids = processor.tokenizer(
+        prefix_text,
+        add_special_tokens=False,
+        return_tensors="pt",
+    )['input_ids'].to(device)
+    
+    prefix_caches = {}
+    for name in adapters:
+        activate_adapter(name)
+        prefix_caches[name] = PrefixCache(model, prefix_ids)
+    activate_adapter(DEFAULT_ADAPTER)
+    
+    nbytes = sum(cache.nbytes() for cache in prefix_caches.values())
+    logger.info(f"Prefix cache ready: {prefix_ids.shape[1]} tokens x {len(prefix_caches)} adapter(s), "
+                f"{nbytes / 1024 / 1024:.1f} MB")
+
+def warm_up():
+    """Run synthetic charts through the batch path once per shape bucket, alone and batched"""
+    max_visual_tokens = max(MAX_PIXELS or 0, PRESETS['accurate']['max_pixels']) // TOKEN_PIXELS
+    charts = warmup_charts(SHAPE_BUCKETS, max_visual_tokens)
+    # One row and two rows: batched shapes past two rows follow the same graphs
+    batch_sizes = sorted({1, min(2, MAX_BATCH_SIZE)})
+    
+    for done, (bucket, image) in enumerate(charts):
+        readiness.advance(WARMING, f'{bucket}-token bucket', 0.9 + 0.1 * done / len(charts))
+        started_at = time.perf_counter()
+        for batch_size in batch_sizes:
+            batch = [{
+                'image': image,
+                'image_hash': hash_image(image),
+                'question': WARMUP_QUESTION,
+                'adapter': DEFAULT_ADAPTER,
+                'cancel': threading.Event(),
+                'timings': {},
+                'counts': {},
+                'submitted_at': time.perf_counter(),
+            } for _ in range(batch_size)]
+            for item in batch:
+                prepare_item(item)
+            run_batch(batch)
+        warmup_seconds[bucket] = round(time.perf_counter() - started_at, 2)
+        logger.info(f"Warmed up the {bucket}-token bucket in {warmup_seconds[bucket]:.1f}s")
+    
+    # Synthetic charts should not take cache room from real ones
+    vision_cache.clear()
+
+def build_admission():
+    """Admission controller over the configured memory budget, None when admission is off"""
+    global memory_model
+    
+    if MEMORY_BUDGET_MB == 'auto':
+        from runtime import available_memory_bytes
         
-        # Extract only the assistant's response
-        if "assistant" in response_text.lower():
-            # Find the assistant's response after the prompt
-            parts = response_text.split("assistant")
-            if len(parts) > 1:
-                response_text = parts[-1].strip()
+        available = available_memory_bytes(device)
+        if available is None:
+            logger.warning(f"Free memory on {device} is unknown, memory admission control is off")
+            return None
+        # The vision feature cache fills up after startup, and forked workers share the memory
+        budget = (available * MEMORY_HEADROOM - vision_cache.max_bytes) / max(1, WORKERS)
+    else:
+        budget = float(MEMORY_BUDGET_MB) * 1024 * 1024
+        if budget <= 0:
+            return None
+    
+    memory_model = MemoryCostModel.from_model(model, prefix_caches[DEFAULT_ADAPTER].length)
+    smallest = memory_model.batch_bytes([(QUESTION_ALLOWANCE + 4, MAX_NEW_TOKENS)], 4)
+    if budget < smallest:
+        raise ValueError(f"Memory budget of {to_mb(budget)} MB is below the {to_mb(smallest)} MB "
+                         f"the smallest request needs")
+    
+    largest = memory_model.batch_bytes([(QUESTION_ALLOWANCE + PRESETS['accurate']['max_pixels'] // TOKEN_PIXELS,
+                                         MAX_NEW_TOKENS)], PRESETS['accurate']['max_pixels'] // TOKEN_PIXELS)
+    logger.info(f"Memory budget: {to_mb(budget)} MB, an accurate-preset request needs about {to_mb(largest)} MB")
+    return AdmissionController(budget, batch_memory)
+
+def prompt_length(item):
+    """Prompt tokens after the cached prefix: exact once prepared, else visual tokens plus an allowance"""
+    if 'suffix_ids' in item:
+        return len(item['suffix_ids'])
+    return item['counts']['visual_tokens'] + QUESTION_ALLOWANCE
+
+def encoded_tokens(items):
+    """Visual tokens the vision tower has to encode for items, each uncached image once"""
+    missing = {feature_key(item): item['counts']['visual_tokens'] for item in items if feature_key(item) not in vision_cache}
+    return sum(missing.values())
+
+def suggest_memory(item):
+    """Estimated peak bytes of a suggestion request: question generation, then one row per question"""
+    length = prompt_length(item)
+    questions = memory_model.batch_bytes([(length, QUESTION_TOKENS * item['count'])], encoded_tokens([item]))
+    answers = memory_model.batch_bytes([(length + QUESTION_TOKENS, MAX_NEW_TOKENS)] * item['count'])
+    return max(questions, answers)
+
+def batch_memory(items):
+    """Estimated peak bytes of items run as one scheduler batch"""
+    # Suggestion requests run one after another, then the answers run as one generation
+    costs = [suggest_memory(item) for item in items if item.get('kind') == 'suggest']
+    answers = [item for item in items if item.get('kind') != 'suggest']
+    if answers:
+        lengths = [prompt_length(item) for item in answers]
+        rows = [(length, item['control'].max_new_tokens if 'control' in item else MAX_NEW_TOKENS)
+                for length, item in zip(lengths, answers)]
+        pad_to = bucket_length(max(lengths), SHAPE_BUCKETS) if COMPILE else None
+        costs.append(memory_model.batch_bytes(rows, encoded_tokens(answers), pad_to))
+    return max(costs, default=0)
+
+def record_request(timings, counts, source):
+    """Feed one finished request into the metrics"""
+    answers_total.inc(source=source)
+    for stage, seconds in timings.items():
+        stage_seconds.observe(seconds, stage=stage)
+    if 'image_pixels' in counts:
+        image_pixels.observe(counts['image_pixels'])
+    if 'visual_tokens' in counts:
+        visual_tokens.observe(counts['visual_tokens'])
+    if 'prompt_tokens' in counts:
+        prompt_tokens.observe(counts['prompt_tokens'])
+    if 'generated_tokens' in counts:
+        generated_tokens.observe(counts['generated_tokens'])
+        generation_seconds = timings.get('prefill', 0.0) + timings.get('decode', 0.0)
+        if generation_seconds > 0:
+            generation_rate.observe(counts['generated_tokens'] / generation_seconds)
+    if 'draft_tokens' in counts:
+        draft_tokens_total.inc(counts['accepted_tokens'], result='accepted')
+        draft_tokens_total.inc(counts['draft_tokens'] - counts['accepted_tokens'], result='rejected')
+
+def timing_breakdown(timings, counts):
+    """Per-request stage timings (ms) and sizes for responses that ask for them"""
+    return {
+        'timings_ms': {stage: round(seconds * 1000, 2) for stage, seconds in timings.items()},
+        'counts': counts,
+    }
+
+def wants_timings():
+    """Whether the client asked for a timing breakdown (?timings=1 or X-Timings: 1)"""
+    return request.args.get('timings') == '1' or request.headers.get('X-Timings') == '1'
+
+def speculation_stats():
+    """Speculative decoding mode and draft acceptance so far"""
+    accepted = draft_tokens_total.values.get((('result', 'accepted'),), 0)
+    drafted = accepted + draft_tokens_total.values.get((('result', 'rejected'),), 0)
+    return {
+        'mode': drafter.name if drafter is not None else 'off',
+        'draft_model': DRAFT_MODEL if SPECULATIVE == 'draft_model' else None,
+        'max_draft_tokens': DRAFT_TOKENS if drafter is not None else None,
+        'draft_tokens': drafted,
+        'accepted_tokens': accepted,
+        'acceptance_rate': round(accepted / drafted, 4) if drafted else None,
+    }
+
+def current_load():
+    """Fraction of the inference queue in use, 0 when idle"""
+    if scheduler is None:
+        return 0.0
+    capacity = MAX_QUEUE_SIZE or MAX_BATCH_SIZE * 4
+    return min(1.0, scheduler.queue_depth() / capacity)
+
+def fit_image(image, resolution, timings, counts, rows=1, text_tokens=QUESTION_ALLOWANCE):
+    """Resize an image to its visual-token budget and note the budget in counts
+
+    rows is the number of answers the request generates about the image; a
+    request that would not fit the memory budget even alone is downscaled.
+    """
+    # Done before hashing, so cached answers and features are per resolution
+    with timed(timings, 'image_resize'):
+        resized, info = resolution_policy.apply(image, resolution, current_load())
+        if admission is not None:
+            largest = memory_model.largest_image(admission.budget, rows, text_tokens, MAX_NEW_TOKENS,
+                                                 info['visual_tokens'])
+            if largest < info['visual_tokens']:
+                # Resize from the original, not the already resized image
+                spec = dict(resolution or {}, min_pixels=None, max_pixels=max(largest, 4) * TOKEN_PIXELS)
+                requested = info['visual_tokens']
+                resized, info = resolution_policy.apply(image, spec, current_load())
+                info['downscaled_from'] = requested
+                admission.note_downscaled()
+        image = resized
+    counts['image_pixels'] = image.width * image.height
+    counts['visual_tokens'] = info.pop('visual_tokens')
+    counts['resolution'] = info
+    return image
+
+def answer_metadata(timings, counts, breakdown):
+    """Visual-token budget, plus the timing breakdown when asked for, of one answer"""
+    metadata = {'visual_tokens': counts['visual_tokens'], 'resolution': counts['resolution']}
+    if breakdown:
+        metadata.update(timing_breakdown(timings, counts))
+    return metadata
+
+def is_cancelled(item):
+    """Whether the caller of a queued or running request has given up"""
+    stream = item.get('stream')
+    if stream is not None:
+        return stream.cancelled
+    return item['cancel'].is_set()
+
+def padded_length(token_lists):
+    """Length suffixes are padded to: the next shape bucket for a compiled model, else the longest"""
+    longest = max(len(tokens) for tokens in token_lists)
+    return bucket_length(longest, SHAPE_BUCKETS) if COMPILE else longest
+
+def pad_left(token_lists):
+    """Left pad token id lists into (input_ids, attention_mask) on the model device"""
+    import torch
+    
+    length = padded_length(token_lists)
+    input_ids = torch.full((len(token_lists), length), processor.tokenizer.pad_token_id, dtype=torch.long)
+    attention_mask = torch.zeros((len(token_lists), length), dtype=torch.long)
+    for row, tokens in enumerate(token_lists):
+        input_ids[row, length - len(tokens):] = torch.tensor(tokens, dtype=torch.long)
+        attention_mask[row, length - len(tokens):] = 1
+    return input_ids.to(device), attention_mask.to(device)
+
+def build_image_prefix(adapter, image_embeds, grid_thw):
+    """KV cache of the prompt up to and including one image, for several questions about it"""
+    import torch
+    
+    from decoding import forward, get_rope_index
+    from prefix_cache import PrefixCache
+    
+    text = expand_image_tokens(build_prompt(""), grid_thw)
+    image_text = text[len(prefix_text):text.index(VISION_END_TOKEN) + len(VISION_END_TOKEN)]
+    image_ids = processor.tokenizer(image_text, add_special_tokens=False, return_tensors="pt")['input_ids'].to(device)
+    
+    prefix_cache = prefix_caches[adapter]
+    input_ids = torch.cat([prefix_cache.input_ids, image_ids], dim=1)
+    attention_mask = torch.ones_like(input_ids)
+    position_ids, _ = get_rope_index(model, input_ids, grid_thw.view(1, -1), attention_mask)
+    
+    with torch.no_grad():
+        inputs_embeds = model.get_input_embeddings()(image_ids)
+        image_mask = (image_ids == model.config.image_token_id).unsqueeze(-1)
+        inputs_embeds = inputs_embeds.masked_scatter(image_mask.expand_as(inputs_embeds), image_embeds.to(inputs_embeds.dtype))
+        _, key_values = forward(
+            model,
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            position_ids=position_ids[:, :, prefix_cache.length:],
+            past_key_values=prefix_cache.expand(1),
+        )
+    return PrefixCache.from_key_values(input_ids, key_values)
+
+def generate_from_image_prefix(image_prefix, grid_thw, questions, max_new_tokens, timings, counts,
+                               controls=None, on_answer=None, cancelled=None):
+    """Answer several questions about one image in a single batch that reuses its prefix cache
+
+    With one AnswerControl per question, rows get their own budget and stop once
+    their answer is complete. on_answer(row, answer) is called as soon as each
+    row finishes.
+    """
+    import torch
+    
+    from decoding import generate_tokens
+    
+    # The prompt after the image is the only part that differs between questions
+    suffixes = []
+    for question in questions:
+        text = expand_image_tokens(build_prompt(question), grid_thw)
+        suffix_text = text.split(VISION_END_TOKEN, 1)[1]
+        suffixes.append(processor.tokenizer(suffix_text, add_special_tokens=False)['input_ids'])
+    suffix_ids, suffix_mask = pad_left(suffixes)
+    prefix_ids = image_prefix.input_ids.expand(len(questions), -1)
+    
+    tokens = [[] for _ in questions]
+    
+    def answer_text(row, token_ids):
+        text = processor.tokenizer.decode(token_ids, skip_special_tokens=True)
+        return controls[row].finalize(text) if controls else text.strip()
+    
+    def on_token(row, token_id):
+        tokens[row].append(token_id)
+    
+    def stop(row):
+        return controls[row].is_complete(processor.tokenizer.decode(tokens[row], skip_special_tokens=True))
+    
+    def on_finish(row):
+        if on_answer is not None:
+            on_answer(row, answer_text(row, tokens[row]))
+    
+    with torch.no_grad():
+        inputs_embeds = model.get_input_embeddings()(suffix_ids)
+    draft_stats = {} if drafter is not None else None
+    sequences = generate_tokens(
+        model,
+        torch.cat([prefix_ids, suffix_ids], dim=1),
+        torch.cat([torch.ones_like(prefix_ids), suffix_mask], dim=1),
+        inputs_embeds,
+        grid_thw.view(1, -1).expand(len(questions), -1),
+        past_key_values=image_prefix.expand(len(questions)),
+        max_new_tokens=[control.max_new_tokens for control in controls] if controls else max_new_tokens,
+        eos_token_ids=eos_token_ids,
+        on_token=on_token,
+        cancelled=cancelled,
+        timings=timings,
+        on_finish=on_finish,
+        drafter=drafter,
+        draft_stats=draft_stats,
+        stop=stop if controls else None,
+        **sampling
+    )
+    if draft_stats:
+        counts['draft_tokens'] = counts.get('draft_tokens', 0) + sum(draft_stats['drafted'])
+        counts['accepted_tokens'] = counts.get('accepted_tokens', 0) + sum(draft_stats['accepted'])
+    return [answer_text(row, sequence) for row, sequence in enumerate(sequences)]
+
+def run_suggest(item):
+    """Generate questions about one image, then answer them all in one batch over a shared image prefix"""
+    stream = item.get('stream')
+    if stream is not None:
+        stream.start()
+    item['timings']['queue'] = time.perf_counter() - item['submitted_at']
+    timings = item['timings']
+    
+    with timed(timings, 'vision'):
+        (image_embeds, grid_thw), = get_image_features([item])
+    
+    # System prompt and image are identical for the question generation and
+    # every answer, so they are prefilled once
+    activate_adapter(item['adapter'])
+    with timed(timings, 'image_prefill'):
+        image_prefix = build_image_prefix(item['adapter'], image_embeds, grid_thw)
+    
+    def cancelled(row):
+        return is_cancelled(item)
+    
+    reply, = generate_from_image_prefix(
+        image_prefix, grid_thw, [question_prompt(item['count'], item.get('title'))],
+        QUESTION_TOKENS * item['count'], timings, item['counts'], cancelled=cancelled,
+    )
+    questions = parse_questions(reply, item['count'])
+    if stream is not None:
+        stream.emit('questions', {'questions': questions})
+    if is_cancelled(item):
+        return []
+    
+    def on_answer(row, answer):
+        if stream is not None:
+            stream.emit('answer', {'index': row, 'question': questions[row], 'answer': answer})
+    
+    answers = generate_from_image_prefix(
+        image_prefix, grid_thw, questions, MAX_NEW_TOKENS, timings, item['counts'],
+        controls=[AnswerControl(question, MAX_NEW_TOKENS) for question in questions],
+        on_answer=on_answer, cancelled=cancelled,
+    )
+    
+    item['counts'].update({
+        'prompt_tokens': image_prefix.length,
+        'questions': len(questions),
+        'batch_size': len(questions),
+    })
+    return [{'question': question, 'answer': answer} for question, answer in zip(questions, answers)]
+
+def run_batch(batch):
+    """Answer a batch of requests with one padded, prefix-cached generation"""
+    import torch
+    
+    from adapters import AdapterRouter
+    from decoding import generate_tokens
+    from prefix_cache import concat_prefix_caches
+    
+    # Requests cancelled or timed out while queued never reach the model
+    live = [index for index, item in enumerate(batch) if not is_cancelled(item)]
+    answers = [""] * len(batch)
+    
+    # A suggestion request is a batch of its own: its questions share one image prefix
+    for index in live:
+        if batch[index].get('kind') == 'suggest':
+            answers[index] = run_suggest(batch[index])
+    live = [index for index in live if batch[index].get('kind') != 'suggest']
+    if not live:
+        return answers
+    batch = [batch[index] for index in live]
+    batch_started_at = time.perf_counter()
+    batch_timings = {}
+    streams = [item.get('stream') for item in batch]
+    for stream in streams:
+        if stream is not None:
+            stream.start()
+    
+    # Requests are normally prepared by the preprocessing pool already
+    for item in batch:
+        if 'suffix_ids' not in item:
+            prepare_item(item)
+    
+    with timed(batch_timings, 'vision'):
+        features = get_image_features(batch)
+    
+    # Left pad the per-request suffixes so the padding sits between the shared
+    # prefix and each suffix
+    with timed(batch_timings, 'collate'):
+        suffix_ids, suffix_mask = pad_left([item['suffix_ids'] for item in batch])
+    row_prefix_caches = [prefix_caches[item['adapter']] for item in batch]
+    prefix_ids = row_prefix_caches[0].input_ids.expand(len(batch), -1)
+    input_ids = torch.cat([prefix_ids, suffix_ids], dim=1)
+    attention_mask = torch.cat([torch.ones_like(prefix_ids), suffix_mask], dim=1)
+    
+    with torch.no_grad(), timed(batch_timings, 'embed'):
+        # Splice the cached image embeddings into the suffix embeddings
+        inputs_embeds = model.get_input_embeddings()(suffix_ids)
+        image_embeds = torch.cat([embeds for embeds, _ in features]).to(inputs_embeds.dtype)
+        image_mask = (suffix_ids == model.config.image_token_id).unsqueeze(-1)
+        inputs_embeds = inputs_embeds.masked_scatter(image_mask.expand_as(inputs_embeds), image_embeds)
+        image_grid_thw = torch.stack([grid_thw for _, grid_thw in features])
+    
+    row_tokens = [[] for _ in batch]
+    
+    def on_token(row, token_id):
+        row_tokens[row].append(token_id)
+        if streams[row] is not None:
+            streams[row].put_token(token_id)
+    
+    def cancelled(row):
+        return is_cancelled(batch[row])
+    
+    def stop(row):
+        # End the row once its text holds a complete short answer
+        return batch[row]['control'].is_complete(processor.tokenizer.decode(row_tokens[row], skip_special_tokens=True))
+    
+    # Each row runs through its own adapter inside the one batched forward
+    router = AdapterRouter(model, [item['adapter'] for item in batch]) if peft_model is not None else None
+    draft_stats = {} if drafter is not None else None
+    
+    sequences = generate_tokens(
+        model,
+        input_ids,
+        attention_mask,
+        inputs_embeds,
+        image_grid_thw,
+        past_key_values=concat_prefix_caches(row_prefix_caches),
+        max_new_tokens=[item['control'].max_new_tokens for item in batch],
+        eos_token_ids=eos_token_ids,
+        on_token=on_token,
+        cancelled=cancelled,
+        router=router,
+        timings=batch_timings,
+        drafter=drafter,
+        draft_stats=draft_stats,
+        stop=stop,
+        **sampling
+    )
+    
+    # Decode only the newly generated tokens of each row, without anything after the answer
+    with timed(batch_timings, 'detokenize'):
+        for index, item, tokens in zip(live, batch, sequences):
+            answers[index] = item['control'].finalize(processor.tokenizer.decode(tokens, skip_special_tokens=True))
+    
+    # Every request of the batch waited for each batch-wide stage
+    prompt_lengths = attention_mask.sum(dim=1).tolist()
+    for row, item in enumerate(batch):
+        item['timings']['queue'] = batch_started_at - item['submitted_at']
+        item['timings'].update(batch_timings)
+        item['counts'].update({
+            'image_pixels': item['image'].width * item['image'].height,
+            'visual_tokens': int(features[row][0].shape[0]),
+            'prompt_tokens': int(prompt_lengths[row]),
+            'generated_tokens': len(sequences[row]),
+            'token_budget': item['control'].max_new_tokens,
+            'question_type': item['control'].kind,
+            'batch_size': len(batch),
+        })
+        if draft_stats:
+            item['counts']['draft_tokens'] = draft_stats['drafted'][row]
+            item['counts']['accepted_tokens'] = draft_stats['accepted'][row]
+    return answers
+
+def analyze_image(image, question, adapter=DEFAULT_ADAPTER, resolution=None, timings=None, counts=None):
+    """Analyze a decoded image with the loaded model
+
+    Stage timings (seconds) and request sizes are added to the optional timings
+    and counts dicts.
+    """
+    timings = {} if timings is None else timings
+    counts = {} if counts is None else counts
+    try:
+        image = fit_image(image, resolution, timings, counts)
         
-        return response_text.strip()
+        # Repeated image + question pairs skip the model entirely
+        with timed(timings, 'cache_lookup'):
+            image_hash = hash_image(image)
+            cache_key = AnswerCache.make_key(image_hash, question, adapter)
+            answer = answer_cache.get(cache_key)
+        if answer is not None:
+            logger.info("Answer cache hit")
+            counts['cached'] = True
+            return answer
         
+        # Wait for the batch containing this request
+        cancel = threading.Event()
+        future = scheduler.submit({
+            'image': image,
+            'image_hash': image_hash,
+            'question': question,
+            'adapter': adapter,
+            'cancel': cancel,
+            'timings': timings,
+            'counts': counts,
+            'submitted_at': time.perf_counter(),
+        })
+        try:
+            answer = future.result(timeout=REQUEST_TIMEOUT_SECONDS)
+        except FutureTimeoutError:
+            # Free the slot whether the request is still queued or already decoding
+            cancel.set()
+            future.cancel()
+            raise
+        answer_cache.put(cache_key, answer)
+        return answer
+        
+    except (QueueFullError, FutureTimeoutError):
+        raise
     except Exception as e:
         logger.error(f"Error analyzing image: {str(e)}")
         logger.error(traceback.format_exc())
         raise e
 
+def finish_stream(stream, cache_key, item, breakdown, future):
+    """Send the final event of a streamed request once its batch completes"""
+    error = future.exception()
+    if error is not None:
+        stream.fail(error)
+        return
+    
+    answer = future.result()
+    if not stream.cancelled:
+        answer_cache.put(cache_key, answer)
+    item['timings']['total'] = time.monotonic() - stream.created_at
+    record_request(item['timings'], item['counts'], 'model')
+    stream.finish(answer, cached=False, **answer_metadata(item['timings'], item['counts'], breakdown))
+
+def stream_image_analysis(image, question, adapter=DEFAULT_ADAPTER, resolution=None, timings=None, breakdown=False):
+    """Start a streamed analysis of a decoded image and return its TokenStream"""
+    stream = TokenStream(processor.tokenizer)
+    timings = {} if timings is None else timings
+    counts = {}
+    image = fit_image(image, resolution, timings, counts)
+    
+    # Cached answers are sent as a single final event
+    with timed(timings, 'cache_lookup'):
+        image_hash = hash_image(image)
+        cache_key = AnswerCache.make_key(image_hash, question, adapter)
+        answer = answer_cache.get(cache_key)
+    if answer is not None:
+        timings['total'] = time.monotonic() - stream.created_at
+        counts['cached'] = True
+        record_request(timings, counts, 'cache')
+        stream.finish(answer, cached=True, **answer_metadata(timings, counts, breakdown))
+        return stream
+    
+    item = {
+        'image': image,
+        'image_hash': image_hash,
+        'question': question,
+        'adapter': adapter,
+        'stream': stream,
+        'timings': timings,
+        'counts': counts,
+        'submitted_at': time.perf_counter(),
+    }
+    future = scheduler.submit(item)
+    future.add_done_callback(partial(finish_stream, stream, cache_key, item, breakdown))
+    return stream
+
+def submit_suggestions(image, adapter, resolution, title, count, timings, counts, stream=None):
+    """Queue a suggestion request, returning (cache_key, cached suggestions, item, future)
+
+    Only one of cached suggestions and (item, future) is set.
+    """
+    image = fit_image(image, resolution, timings, counts, rows=count, text_tokens=QUESTION_ALLOWANCE + QUESTION_TOKENS)
+    
+    # The whole set of suggestions is cached like an answer, keyed by title and count
+    with timed(timings, 'cache_lookup'):
+        image_hash = hash_image(image)
+        cache_key = AnswerCache.make_key(image_hash, f"suggest:{count}:{title or ''}", adapter)
+        cached = answer_cache.get(cache_key)
+    if cached is not None:
+        counts['cached'] = True
+        return cache_key, json.loads(cached), None, None
+    
+    item = {
+        'kind': 'suggest',
+        'image': image,
+        'image_hash': image_hash,
+        'title': title,
+        'count': count,
+        'adapter': adapter,
+        'cancel': threading.Event(),
+        'timings': timings,
+        'counts': counts,
+        'submitted_at': time.perf_counter(),
+    }
+    if stream is not None:
+        item['stream'] = stream
+    return cache_key, None, item, scheduler.submit(item)
+
+def cache_suggestions(cache_key, item, suggestions):
+    """Cache a suggestion set, and each answer so a follow-up /analyze of a suggested question hits"""
+    answer_cache.put(cache_key, json.dumps(suggestions))
+    for entry in suggestions:
+        answer_cache.put(AnswerCache.make_key(item['image_hash'], entry['question'], item['adapter']), entry['answer'])
+
+def suggest_questions(image, adapter=DEFAULT_ADAPTER, resolution=None, title=None, count=SUGGEST_COUNT,
+                      timings=None, counts=None):
+    """Suggest count questions about a decoded image and answer them"""
+    timings = {} if timings is None else timings
+    counts = {} if counts is None else counts
+    cache_key, suggestions, item, future = submit_suggestions(image, adapter, resolution, title, count, timings, counts)
+    if suggestions is not None:
+        return suggestions
+    
+    try:
+        suggestions = future.result(timeout=REQUEST_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        item['cancel'].set()
+        future.cancel()
+        raise
+    if suggestions:
+        cache_suggestions(cache_key, item, suggestions)
+    return suggestions
+
+def finish_suggestions(stream, cache_key, item, breakdown, future):
+    """Send the final event of a streamed suggestion request once it completes"""
+    error = future.exception()
+    if error is not None:
+        stream.fail(error)
+        return
+    
+    suggestions = future.result()
+    if suggestions and not stream.cancelled:
+        cache_suggestions(cache_key, item, suggestions)
+    item['timings']['total'] = time.monotonic() - stream.created_at
+    record_request(item['timings'], item['counts'], 'model')
+    stream.finish(suggestions=suggestions, cached=False, **answer_metadata(item['timings'], item['counts'], breakdown))
+
+def stream_suggestions(image, adapter=DEFAULT_ADAPTER, resolution=None, title=None, count=SUGGEST_COUNT,
+                       timings=None, breakdown=False):
+    """Start a streamed suggestion request and return its TokenStream"""
+    stream = TokenStream(processor.tokenizer)
+    timings = {} if timings is None else timings
+    counts = {}
+    cache_key, suggestions, item, future = submit_suggestions(
+        image, adapter, resolution, title, count, timings, counts, stream=stream,
+    )
+    if suggestions is not None:
+        # Cached suggestions are sent as a questions event and a single final event
+        stream.emit('questions', {'questions': [entry['question'] for entry in suggestions]})
+        timings['total'] = time.monotonic() - stream.created_at
+        record_request(timings, counts, 'cache')
+        stream.finish(suggestions=suggestions, cached=True, **answer_metadata(timings, counts, breakdown))
+        return stream
+    
+    future.add_done_callback(partial(finish_suggestions, stream, cache_key, item, breakdown))
+    return stream
+
+def read_analyze_request(timings=None, suggest=False):
+    """Read (image, question, options, error) from a JSON, multipart or raw image/* request body
+
+    With suggest=True the question is optional and options carry the title and
+    number of questions of a /suggest request instead.
+    """
+    from image_io import load_image
+    
+    content_type = request.mimetype or ''
+    
+    if content_type.startswith('image/'):
+        # Raw image body, question and options in headers or the query string
+        image_source = request.get_data(cache=False) or None
+        question = request.headers.get('X-Question') or request.args.get('question')
+        adapter = request.headers.get('X-Adapter') or request.args.get('adapter')
+        fields = dict(request.args)
+        if request.headers.get('X-Title'):
+            fields['title'] = request.headers['X-Title']
+    elif content_type == 'multipart/form-data':
+        upload = request.files.get('image')
+        image_source = upload.stream if upload else None
+        question = request.form.get('question')
+        adapter = request.form.get('adapter')
+        fields = request.form
+    else:
+        data = request.get_json(silent=True)
+        if not data:
+            return None, None, None, 'No data provided'
+        image_source = data.get('image')
+        question = data.get('question')
+        adapter = data.get('adapter')
+        fields = data
+    
+    if not image_source:
+        return None, None, None, 'No image data provided'
+    
+    if not question and not suggest:
+        return None, None, None, 'No question provided'
+    
+    try:
+        options = {
+            'adapter': resolve_adapter(adapter),
+            'resolution': resolution_policy.parse(
+                fields.get('resolution'),
+                fields.get('min_pixels'),
+                fields.get('max_pixels'),
+            ),
+        }
+        if suggest:
+            options['title'] = fields.get('title') or None
+            options['count'] = parse_suggest_count(fields.get('count'))
+    except ValueError as e:
+        return None, None, None, str(e)
+    
+    try:
+        image = load_image(image_source, timings=timings)
+    except (ValueError, OSError) as e:
+        return None, None, None, f'Invalid image: {str(e)}'
+    
+    return image, question, options, None
+
+def parse_suggest_count(count):
+    """Validate the number of questions a /suggest request asked for"""
+    if count in (None, ''):
+        return SUGGEST_COUNT
+    count = int(count)
+    if not 1 <= count <= MAX_SUGGEST_COUNT:
+        raise ValueError(f"count must be between 1 and {MAX_SUGGEST_COUNT}")
+    return count
+
 @app.route('/health', methods=['GET'])
 def health_check():
-    """Health check endpoint"""
+    """Health check endpoint: 200 once the model is ready, 503 with the startup state until then"""
+    startup = readiness.snapshot()
+    ready = startup['state'] == READY
     return jsonify({
-        'status': 'healthy',
-        'model_loaded': model is not None,
-        'device': device
-    })
+        'status': 'healthy' if ready else startup['state'],
+        'model_loaded': ready,
+        'device': device,
+        'startup': startup
+    }), 200 if ready else 503
+
+@app.route('/health/live', methods=['GET'])
+def liveness_check():
+    """Liveness endpoint: 200 whenever the process serves requests, even while the model loads"""
+    return jsonify({'status': 'alive', 'startup': readiness.snapshot()})
+
+def overloaded_response(message, status_code, retry_after):
+    """Error response that tells the client when to retry"""
+    return jsonify({
+        'error': message,
+        'success': False,
+        'retry_after': retry_after
+    }), status_code, {'Retry-After': str(retry_after)}
+
+def not_ready_response():
+    """Fast 503 for model requests that arrive before the model is ready"""
+    startup = readiness.snapshot()
+    if startup['state'] == FAILED:
+        return jsonify({
+            'error': f"Model failed to load: {startup['error']}",
+            'success': False,
+            'startup': startup
+        }), 503
+    return overloaded_response(f"Model is {startup['state']} ({startup['progress']:.0%}), retry later",
+                               503, STARTUP_RETRY_AFTER)
 
 @app.route('/analyze', methods=['POST'])
 def analyze():
     """Main analysis endpoint"""
     try:
-        data = request.get_json()
+        # Answer before reading the upload while the model is still loading
+        if not readiness.is_ready():
+            return not_ready_response()
         
-        if not data:
-            return jsonify({'error': 'No data provided'}), 400
+        started_at = time.perf_counter()
+        timings = {}
+        counts = {}
+        image, question, options, error = read_analyze_request(timings)
         
-        image_data = data.get('image')
-        question = data.get('question')
+        if error:
+            return jsonify({'error': error}), 400
+        
+        logger.info(f"Analyzing image with question: {question} (adapter {options['adapter']})")
         
-        if not image_data:
-            return jsonify({'error': 'No image data provided'}), 400
+        # Analyze the image
+        answer = analyze_image(image, question, timings=timings, counts=counts, **options)
+        timings['total'] = time.perf_counter() - started_at
+        record_request(timings, counts, 'cache' if counts.get('cached') else 'model')
+        
+        response = {
+            'success': True,
+            'answer': answer,
+            'question': question,
+            'adapter': options['adapter']
+        }
+        response.update(answer_metadata(timings, counts, wants_timings()))
+        return jsonify(response)
         
-        if not question:
-            return jsonify({'error': 'No question provided'}), 400
+    except QueueFullError as e:
+        logger.warning("Rejecting request: inference queue is full")
+        return overloaded_response(str(e), 429, e.retry_after)
+    except FutureTimeoutError:
+        logger.warning(f"Request timed out after {REQUEST_TIMEOUT_SECONDS:.0f}s")
+        return overloaded_response('Timed out waiting for the model', 503, scheduler.retry_after())
+    except Exception as e:
+        logger.error(f"Error in analyze endpoint: {str(e)}")
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 500
+
+@app.route('/analyze/stream', methods=['POST'])
+def analyze_stream():
+    """Streaming analysis endpoint (Server-Sent Events)"""
+    try:
+        # Answer before reading the upload while the model is still loading
+        if not readiness.is_ready():
+            return not_ready_response()
         
-        if model is None:
-            return jsonify({'error': 'Model not loaded'}), 500
+        timings = {}
+        image, question, options, error = read_analyze_request(timings)
         
-        logger.info(f"Analyzing image with question: {question}")
+        if error:
+            return jsonify({'error': error}), 400
         
-        # Analyze the image
-        answer = analyze_image(image_data, question)
+        logger.info(f"Streaming analysis with question: {question} (adapter {options['adapter']})")
+        stream = stream_image_analysis(image, question, timings=timings, breakdown=wants_timings(), **options)
         
+    except QueueFullError as e:
+        logger.warning("Rejecting stream: inference queue is full")
+        return overloaded_response(str(e), 429, e.retry_after)
+    except Exception as e:
+        logger.error(f"Error in analyze stream endpoint: {str(e)}")
         return jsonify({
+            'error': str(e),
+            'success': False
+        }), 500
+    
+    active_streams[stream.request_id] = stream
+    
+    def events():
+        try:
+            yield format_sse('start', {
+                'request_id': stream.request_id,
+                'question': question,
+                'adapter': options['adapter'],
+            })
+            for event, payload in stream.events(timeout=STREAM_TIMEOUT_SECONDS):
+                yield format_sse(event, payload)
+        finally:
+            # Runs when the client disconnects too: stop decoding for it
+            if stream.finished_at is None:
+                stream.cancel()
+            active_streams.pop(stream.request_id, None)
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/analyze/cancel', methods=['POST'])
+def analyze_cancel():
+    """Cancel a streamed analysis by request id"""
+    data = request.get_json(silent=True) or {}
+    stream = active_streams.get(data.get('request_id'))
+    if stream is None:
+        return jsonify({'error': 'Unknown request id', 'success': False}), 404
+    
+    stream.cancel()
+    return jsonify({'success': True, 'request_id': stream.request_id})
+
+@app.route('/suggest', methods=['POST'])
+def suggest():
+    """Suggest questions about a chart and answer them in one batched pass"""
+    try:
+        # Answer before reading the upload while the model is still loading
+        if not readiness.is_ready():
+            return not_ready_response()
+        
+        started_at = time.perf_counter()
+        timings = {}
+        counts = {}
+        image, _, options, error = read_analyze_request(timings, suggest=True)
+        
+        if error:
+            return jsonify({'error': error}), 400
+        
+        if STUB_MODEL:
+            return jsonify({'error': 'Suggestions need the real model', 'success': False}), 501
+        
+        logger.info(f"Suggesting {options['count']} questions (adapter {options['adapter']})")
+        suggestions = suggest_questions(image, timings=timings, counts=counts, **options)
+        timings['total'] = time.perf_counter() - started_at
+        record_request(timings, counts, 'cache' if counts.get('cached') else 'model')
+        
+        response = {
             'success': True,
-            'answer': answer,
-            'question': question
-        })
+            'suggestions': suggestions,
+            'title': options['title'],
+            'adapter': options['adapter']
+        }
+        response.update(answer_metadata(timings, counts, wants_timings()))
+        return jsonify(response)
         
+    except QueueFullError as e:
+        logger.warning("Rejecting suggestions: inference queue is full")
+        return overloaded_response(str(e), 429, e.retry_after)
+    except FutureTimeoutError:
+        logger.warning(f"Suggestions timed out after {REQUEST_TIMEOUT_SECONDS:.0f}s")
+        return overloaded_response('Timed out waiting for the model', 503, scheduler.retry_after())
     except Exception as e:
-        logger.error(f"Error in analyze endpoint: {str(e)}")
+        logger.error(f"Error in suggest endpoint: {str(e)}")
+        return jsonify({
+            'error': str(e),
+            'success': False
+        }), 500
+
+@app.route('/suggest/stream', methods=['POST'])
+def suggest_stream():
+    """Streaming suggestions endpoint: the questions, then each answer as it finishes (Server-Sent Events)"""
+    try:
+        # Answer before reading the upload while the model is still loading
+        if not readiness.is_ready():
+            return not_ready_response()
+        
+        timings = {}
+        image, _, options, error = read_analyze_request(timings, suggest=True)
+        
+        if error:
+            return jsonify({'error': error}), 400
+        
+        if STUB_MODEL:
+            return jsonify({'error': 'Suggestions need the real model', 'success': False}), 501
+        
+        logger.info(f"Streaming {options['count']} suggestions (adapter {options['adapter']})")
+        stream = stream_suggestions(image, timings=timings, breakdown=wants_timings(), **options)
+        
+    except QueueFullError as e:
+        logger.warning("Rejecting suggestion stream: inference queue is full")
+        return overloaded_response(str(e), 429, e.retry_after)
+    except Exception as e:
+        logger.error(f"Error in suggest stream endpoint: {str(e)}")
         return jsonify({
             'error': str(e),
             'success': False
         }), 500
+    
+    active_streams[stream.request_id] = stream
+    
+    def events():
+        try:
+            yield format_sse('start', {
+                'request_id': stream.request_id,
+                'title': options['title'],
+                'count': options['count'],
+                'adapter': options['adapter'],
+            })
+            for event, payload in stream.events(timeout=STREAM_TIMEOUT_SECONDS):
+                yield format_sse(event, payload)
+        finally:
+            # Runs when the client disconnects too: stop decoding for it
+            if stream.finished_at is None:
+                stream.cancel()
+            active_streams.pop(stream.request_id, None)
+    
+    return Response(events(), mimetype='text/event-stream', headers={
+        'Cache-Control': 'no-cache',
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/metrics', methods=['GET'])
+def prometheus_metrics():
+    """Metrics in Prometheus text format"""
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+@app.after_request
+def count_request(response):
+    """Count every response by endpoint and status code"""
+    http_requests_total.inc(endpoint=request.url_rule.rule if request.url_rule else 'unmatched',
+                            status=str(response.status_code))
+    return response
 
 @app.route('/status', methods=['GET'])
 def status():
     """Get model status"""
+    import torch
+    
+    from runtime import process_memory
+    
     return jsonify({
-        'model_loaded': model is not None,
+        'model_loaded': readiness.is_ready(),
         'processor_loaded': processor is not None,
+        'startup': readiness.snapshot(),
         'device': device,
-        'model_id': "Qwen/Qwen2-VL-2B-Instruct" if model else None
+        'quantization': quantization,
+        'speculative': speculation_stats(),
+        'stub_model': STUB_MODEL,
+        'compile': {
+            'enabled': COMPILE,
+            'mode': COMPILE_MODE,
+            'shape_buckets': SHAPE_BUCKETS,
+            'warmup_seconds': warmup_seconds,
+        },
+        'torch_threads': torch.get_num_threads(),
+        'memory': dict(process_memory(), model_mb=round(model_bytes / 1024 / 1024, 1) if model_bytes else None),
+        'model_id': MODEL_ID if model else None,
+        'model_path': model_path,
+        'adapters': {
+            'available': adapters,
+            'default': DEFAULT_ADAPTER,
+            'merged': peft_model is None,
+        },
+        'batching': scheduler.stats() if scheduler else None,
+        'admission': admission.stats() if admission else {'enabled': False},
+        'answer_cache': answer_cache.stats(),
+        'vision_cache': vision_cache.stats(),
+        'resolution': {
+            'default': resolution_policy.default,
+            'min_pixels': MIN_PIXELS,
+            'max_pixels': MAX_PIXELS,
+            'load': round(current_load(), 3),
+        },
+        'suggestions': {
+            'default_count': SUGGEST_COUNT,
+            'max_count': MAX_SUGGEST_COUNT,
+        },
+        'prefix_cache_tokens': next(iter(prefix_caches.values())).length if prefix_caches else None,
+        'active_streams': len(active_streams)
     })
 
+def run_server(host='0.0.0.0', port=5001, production=PRODUCTION, application=None):
+    """Serve the app with waitress in production mode, else with Flask's development server"""
+    application = application or app
+    if production:
+        from waitress import serve
+        
+        # waitress accepts and buffers connections on a non-blocking I/O loop and
+        # hands complete requests to a fixed thread pool; inference stays on the
+        # scheduler thread behind the bounded queue
+        logger.info(f"Serving with waitress ({SERVER_THREADS} threads, "
+                    f"{SERVER_CONNECTION_LIMIT} connections, queue limit {MAX_QUEUE_SIZE})")
+        serve(
+            application,
+            host=host,
+            port=port,
+            threads=SERVER_THREADS,
+            connection_limit=SERVER_CONNECTION_LIMIT,
+            channel_timeout=int(REQUEST_TIMEOUT_SECONDS) + 30,
+        )
+    else:
+        application.run(host=host, port=port, debug=False, threaded=True)
+
+def run_workers(num_workers=WORKERS, host='0.0.0.0', port=5001, production=PRODUCTION):
+    """Serve with num_workers forked model workers behind a dispatcher on port
+
+    The dispatcher is forked first so the port answers (with 503s) while this
+    process loads the weights; the workers fork afterwards and share them
+    copy-on-write. Worker i listens on 127.0.0.1:port + 1 + i.
+    """
+    worker_ports = [port + 1 + index for index in range(num_workers)]
+    # Split the cores between workers so their thread pools do not oversubscribe them
+    worker_threads = WORKER_THREADS or max(1, (os.cpu_count() or 1) // num_workers)
+    
+    def load_weights():
+        from runtime import configure_threads
+        
+        # No OpenMP thread pool may exist at fork time: children of a process whose
+        # pool has run can hang in it or fall back to one thread. Loading runs on one
+        # thread here, and each worker sizes its own pool first thing after the fork
+        configure_threads(1)
+        if not load_model(start_worker=False):
+            raise RuntimeError("Failed to load model")
+        if device != "cpu":
+            raise ValueError("Multi-process serving is only supported on CPU")
+        logger.info(f"Forking {num_workers} model workers with {worker_threads} threads each")
+    
+    def run_worker(index):
+        from runtime import configure_threads
+        
+        # First thing after the fork, before any torch op builds the thread pool
+        configure_threads(worker_threads, 1)
+        if not start_model_worker():
+            raise RuntimeError("Model worker failed to start")
+        run_server('127.0.0.1', worker_ports[index], production)
+    
+    def run_dispatcher():
+        dispatcher = Dispatcher(worker_ports, timeout=max(REQUEST_TIMEOUT_SECONDS, STREAM_TIMEOUT_SECONDS) + 30)
+        dispatcher.start()
+        logger.info(f"Dispatching to workers on ports {worker_ports[0]}-{worker_ports[-1]}")
+        run_server(host, port, production, application=create_dispatcher_app(dispatcher, app.config['MAX_CONTENT_LENGTH']))
+    
+    WorkerPool(num_workers, run_worker, run_dispatcher, prepare=load_weights).run()
+
 if __name__ == '__main__':
     logger.info("Starting Chart QA Backend Server...")
     
-    # Load model on startup
-    if load_model():
-        logger.info("Server ready!")
-        app.run(host='0.0.0.0', port=5001, debug=False)
+    # Listen right away; /health reports the startup state until the model is ready
+    if WORKERS > 1:
+        run_workers()
     else:
-        logger.error("Failed to load model. Exiting.")
-        sys.exit(1)
+        load_model_in_background()
+        run_server()
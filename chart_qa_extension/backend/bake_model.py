@@ -0,0 +1,53 @@
+#!/usr/bin/env python3
+"""
+One-time "bake" of the fine-tuned model
+Merges a LoRA adapter into Qwen2-VL and writes safetensors that the server can memory-map at startup
+"""
+
+import argparse
+import logging
+import sys
+
+import torch
+
+from model_loader import bake_model
+from runtime import default_dtype, select_device
+
+logging.basicConfig(level=logging.INFO)
+
+DTYPES = {
+    "bfloat16": torch.bfloat16,
+    "float16": torch.float16,
+    "float32": torch.float32,
+}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge a LoRA adapter into Qwen2-VL and save it as safetensors")
+    parser.add_argument("--base-model", default="Qwen/Qwen2-VL-2B-Instruct", help="Base model id or path")
+    parser.add_argument("--lora", required=True, help="LoRA adapter directory, e.g. lora_model_8k")
+    parser.add_argument("--output", required=True, help="Directory for the merged model")
+    parser.add_argument("--device", help="Device the server will run on (cuda, mps or cpu), for the default dtype; "
+                                          "defaults to the best one on this machine")
+    parser.add_argument("--dtype", choices=sorted(DTYPES),
+                        help="Weight dtype of the merged model. Defaults to the dtype the server loads on the target "
+                             "device (bfloat16 on CUDA, float32 elsewhere), so the weights are memory-mapped without "
+                             "a copy. bfloat16 halves the files, but a CPU server then upcasts and copies every "
+                             "tensor at startup, with twice the peak memory")
+    parser.add_argument("--max-shard-size", default="2GB", help="Largest safetensors shard")
+    args = parser.parse_args()
+
+    torch_dtype = DTYPES[args.dtype] if args.dtype else default_dtype(select_device(args.device))
+    print(f"🔥 Baking {args.base_model} + {args.lora} -> {args.output} ({str(torch_dtype).replace('torch.', '')})")
+    try:
+        bake_model(args.base_model, args.lora, args.output, torch_dtype, args.max_shard_size)
+    except Exception as e:
+        print(f"❌ Bake failed: {e}")
+        sys.exit(1)
+
+    print("✅ Done. Start the server with:")
+    print(f"   CHARTQA_MODEL_PATH={args.output} python start_server.py")
+
+
+if __name__ == "__main__":
+    main()
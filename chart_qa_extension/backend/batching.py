@@ -0,0 +1,227 @@
+#!/usr/bin/env python3
+"""
+Dynamic micro-batching for the Chart QA backend
+Collects concurrent requests into batches that share one model.generate call, with an
+optional preprocessing pool that prepares queued requests while the model is busy
+and an optional admission controller that keeps each batch within a memory budget
+"""
+
+import logging
+import math
+import queue
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import nullcontext
+
+logger = logging.getLogger(__name__)
+
+
+class QueueFullError(Exception):
+    """Raised when the inference queue is at capacity"""
+
+    def __init__(self, retry_after):
+        super().__init__("Inference queue is full, retry later")
+        self.retry_after = retry_after
+
+
+class BatchScheduler:
+    """Groups submitted items into batches and runs them on a single worker thread"""
+
+    def __init__(self, run_batch, max_batch_size=8, max_wait_ms=10.0, max_queue_size=0,
+                 prepare=None, prepare_workers=2, max_prepared=None, admission=None):
+        # run_batch takes a list of items and returns one result per item, in order
+        self.run_batch = run_batch
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self.max_queue_size = max(0, int(max_queue_size))  # 0 means unbounded
+
+        # prepare(item) does an item's CPU work on a thread pool; the item reaches
+        # the batch queue only once prepared, and at most max_prepared prepared
+        # items wait there so preprocessing cannot run far ahead of the model
+        self.prepare = prepare
+        self.prepare_workers = max(1, int(prepare_workers))
+        self.max_prepared = max(1, int(max_prepared or 2 * self.max_batch_size))
+        self._prepare_pool = None
+        self._prepared_slots = threading.Semaphore(self.max_prepared)
+        self._preparing = 0
+
+        # admission.fits(items) says whether items fit the memory budget as one
+        # batch; an item that does not fit opens the next batch instead
+        self.admission = admission
+        self._held = None
+
+        self._queue = queue.Queue()
+        self._submit_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+
+        # Simple counters for /status
+        self.batches_run = 0
+        self.items_run = 0
+        self.rejected = 0
+        self.deferred = 0
+        self.avg_batch_seconds = None  # exponential moving average
+        self.avg_prepare_seconds = None  # exponential moving average
+
+    def start(self):
+        """Start the worker thread"""
+        if self._running:
+            return
+        self._running = True
+        if self.prepare is not None:
+            self._prepare_pool = ThreadPoolExecutor(self.prepare_workers, thread_name_prefix="batch-prepare")
+        self._thread = threading.Thread(target=self._worker, name="batch-scheduler", daemon=True)
+        self._thread.start()
+        logger.info(f"Batch scheduler started (max_batch_size={self.max_batch_size}, "
+                    f"max_wait_ms={self.max_wait * 1000:.0f}, "
+                    f"prepare_workers={self.prepare_workers if self.prepare else 0})")
+
+    def stop(self):
+        """Stop the worker thread after the current batch"""
+        self._running = False
+        if self._prepare_pool is not None:
+            self._prepare_pool.shutdown(wait=False, cancel_futures=True)
+            self._prepare_pool = None
+        self._queue.put(None)
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+
+    def submit(self, item):
+        """Queue an item and return a Future that resolves to its own result"""
+        if not self._running:
+            raise RuntimeError("Batch scheduler is not running")
+        future = Future()
+        with self._submit_lock:
+            if self.max_queue_size and self.queue_depth() >= self.max_queue_size:
+                self.rejected += 1
+                raise QueueFullError(self.retry_after())
+            if self.prepare is None:
+                self._queue.put((item, future))
+            else:
+                self._preparing += 1
+                self._prepare_pool.submit(self._prepare_item, item, future)
+        return future
+
+    def retry_after(self):
+        """Estimated seconds until the current queue has drained"""
+        batch_seconds = self.avg_batch_seconds or 1.0
+        batches_ahead = self.queue_depth() / self.max_batch_size + 1
+        return max(1, math.ceil(batches_ahead * batch_seconds))
+
+    def queue_depth(self):
+        """Number of items waiting for a batch, in preprocessing or prepared"""
+        return self._preparing + self._queue.qsize() + (self._held is not None)
+
+    def stats(self):
+        """Scheduler counters for the status endpoint"""
+        return {
+            'max_batch_size': self.max_batch_size,
+            'max_wait_ms': self.max_wait * 1000,
+            'max_queue_size': self.max_queue_size,
+            'queue_depth': self.queue_depth(),
+            'preparing': self._preparing,
+            'prepare_workers': self.prepare_workers if self.prepare else 0,
+            'max_prepared': self.max_prepared if self.prepare else None,
+            'avg_prepare_ms': round(self.avg_prepare_seconds * 1000, 1) if self.avg_prepare_seconds else None,
+            'batches_run': self.batches_run,
+            'items_run': self.items_run,
+            'rejected': self.rejected,
+            'deferred': self.deferred,
+            'avg_batch_size': round(self.items_run / self.batches_run, 2) if self.batches_run else 0.0,
+            'avg_batch_ms': round(self.avg_batch_seconds * 1000, 1) if self.avg_batch_seconds else None,
+        }
+
+    def _prepare_item(self, item, future):
+        """Prepare one item on the pool, then hand it to the batch queue"""
+        try:
+            if future.cancelled():
+                return
+            # Bounded buffer: wait while enough prepared items are already waiting
+            self._prepared_slots.acquire()
+            started_at = time.monotonic()
+            try:
+                self.prepare(item)
+            except Exception as e:
+                self._prepared_slots.release()
+                logger.error(f"Preparing an item failed: {str(e)}")
+                if future.set_running_or_notify_cancel():
+                    future.set_exception(e)
+                return
+            elapsed = time.monotonic() - started_at
+            if self.avg_prepare_seconds is None:
+                self.avg_prepare_seconds = elapsed
+            else:
+                self.avg_prepare_seconds = 0.8 * self.avg_prepare_seconds + 0.2 * elapsed
+            self._queue.put((item, future))
+        finally:
+            with self._submit_lock:
+                self._preparing -= 1
+
+    def _take(self, entry):
+        """Free the prepared slot of an entry leaving the batch queue"""
+        if entry is not None and self.prepare is not None:
+            self._prepared_slots.release()
+        return entry
+
+    def _collect(self):
+        """Block for the first item, then gather more until the batch is full or the wait expires"""
+        if self._held is not None:
+            first, self._held = self._held, None
+        else:
+            first = self._take(self._queue.get())
+        if first is None:
+            return []
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                entry = self._take(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+            if entry is None:
+                self._running = False
+                break
+            if self.admission is not None and not self.admission.fits([item for item, _ in batch] + [entry[0]]):
+                # Over the memory budget: the item waits for the next batch, ahead of the queue
+                self._held = entry
+                self.deferred += 1
+                break
+            batch.append(entry)
+
+        return batch
+
+    def _worker(self):
+        """Run batches until stopped"""
+        while self._running:
+            batch = self._collect()
+            if not batch:
+                continue
+
+            # Skip callers that gave up while waiting
+            batch = [(item, future) for item, future in batch if future.set_running_or_notify_cancel()]
+            if not batch:
+                continue
+
+            items = [item for item, _ in batch]
+            started_at = time.monotonic()
+            try:
+                with self.admission.running(items) if self.admission is not None else nullcontext():
+                    results = self.run_batch(items)
+                for (_, future), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                logger.error(f"Batch of {len(items)} failed: {str(e)}")
+                for _, future in batch:
+                    future.set_exception(e)
+
+            elapsed = time.monotonic() - started_at
+            if self.avg_batch_seconds is None:
+                self.avg_batch_seconds = elapsed
+            else:
+                self.avg_batch_seconds = 0.8 * self.avg_batch_seconds + 0.2 * elapsed
+            self.batches_run += 1
+            self.items_run += len(items)
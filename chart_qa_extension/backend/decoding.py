@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+"""
+Batched decode loop for the Chart QA backend
+Drives Qwen2-VL with explicit M-RoPE positions so a prefilled prefix cache can be reused
+"""
+
+import time
+from contextlib import nullcontext
+
+import torch
+from transformers import DynamicCache
+
+
+def get_rope_index(model, input_ids, image_grid_thw, attention_mask):
+    """Compute Qwen2-VL M-RoPE position ids and per-row decode deltas"""
+    rope_index = getattr(model, 'get_rope_index', None) or model.model.get_rope_index
+    return rope_index(input_ids, image_grid_thw, None, attention_mask)
+
+
+def forward(model, num_logits=1, **kwargs):
+    """Run the decoder and project only the last num_logits positions to the vocabulary"""
+    outputs = model.model(use_cache=True, return_dict=True, **kwargs)
+    hidden_states = outputs.last_hidden_state[:, -num_logits:, :]
+    logits = model.lm_head(hidden_states).float()
+    return logits, outputs.past_key_values
+
+
+def token_probs(logits, temperature=1.0, top_k=None, top_p=None):
+    """Sampling distribution over the last dimension of logits after temperature, top-k and top-p"""
+    if temperature and temperature != 1.0:
+        logits = logits / temperature
+
+    if top_k:
+        kth_value = torch.topk(logits, min(top_k, logits.shape[-1]), dim=-1).values[:, -1:]
+        logits = logits.masked_fill(logits < kth_value, float('-inf'))
+
+    if top_p is not None and top_p < 1.0:
+        sorted_logits, sorted_indices = torch.sort(logits, descending=True, dim=-1)
+        cumulative = sorted_logits.softmax(dim=-1).cumsum(dim=-1)
+        # Drop tokens once the mass before them already exceeds top_p (always keep the first)
+        sorted_remove = cumulative - sorted_logits.softmax(dim=-1) > top_p
+        remove = sorted_remove.scatter(-1, sorted_indices, sorted_remove)
+        logits = logits.masked_fill(remove, float('-inf'))
+
+    return logits.softmax(dim=-1)
+
+
+def sample_next_tokens(logits, do_sample=True, temperature=1.0, top_k=None, top_p=None):
+    """Pick one token per row from (batch, vocab) logits"""
+    if not do_sample:
+        return logits.argmax(dim=-1)
+
+    probs = token_probs(logits, temperature, top_k, top_p)
+    return torch.multinomial(probs, num_samples=1).squeeze(-1)
+
+
+def verify_draft(logits, draft, do_sample=True, **sampling):
+    """Accepted prefix length of a draft and the token that follows it
+
+    logits has one row per draft token plus one: row j scores the token after
+    draft[:j]. A draft token is accepted with the probability the model gives it
+    (always, under greedy decoding, when it is the argmax); the first rejected
+    position is resampled with that token excluded. For a deterministic draft this
+    yields exactly the model's own distribution.
+    """
+    if not do_sample:
+        predicted = logits.argmax(dim=-1).tolist()
+        accepted = 0
+        while accepted < len(draft) and predicted[accepted] == draft[accepted]:
+            accepted += 1
+        return accepted, predicted[accepted]
+
+    probs = token_probs(logits, **sampling)
+    draws = torch.rand(len(draft)).tolist()
+    positions = torch.arange(len(draft), device=probs.device)
+    draft_probs = probs[positions, torch.tensor(draft, dtype=torch.long, device=probs.device)].tolist()
+    for position, (token, prob, draw) in enumerate(zip(draft, draft_probs, draws)):
+        if draw >= prob:
+            residual = probs[position].clone()
+            residual[token] = 0.0
+            return position, int(torch.multinomial(residual / residual.sum(), num_samples=1))
+    return len(draft), int(torch.multinomial(probs[len(draft)], num_samples=1))
+
+
+@torch.no_grad()
+def generate_tokens(
+    model,
+    input_ids,
+    attention_mask,
+    inputs_embeds,
+    image_grid_thw,
+    past_key_values=None,
+    max_new_tokens=64,
+    eos_token_ids=(),
+    on_token=None,
+    cancelled=None,
+    router=None,
+    timings=None,
+    on_finish=None,
+    drafter=None,
+    draft_stats=None,
+    stop=None,
+    **sampling
+):
+    """Generate up to max_new_tokens for every row and return the new token ids per row
+
+    max_new_tokens is one budget for every row or a list with one per row.
+    input_ids/attention_mask cover the whole prompt; past_key_values may already hold
+    a prefix of it, and inputs_embeds covers only the part after that prefix.
+    on_token(row, token_id) is called for every generated token and rows for which
+    cancelled(row) returns True stop decoding. An AdapterRouter sends each row
+    through its own LoRA adapter. When a timings dict is given, prefill and decode
+    seconds are added to 'prefill' and 'decode'. on_finish(row) is called as
+    soon as a row completes (EOS, its budget, or stop(row) returning True once
+    its answer is complete), not for cancelled rows.
+
+    With a drafter (see speculative.py) each step feeds a drafted continuation
+    and keeps the part the model verifies; draft_stats then receives per-row
+    'drafted' and 'accepted' token counts.
+    """
+    with router if router is not None else nullcontext():
+        return _generate(
+            model, input_ids, attention_mask, inputs_embeds, image_grid_thw, past_key_values,
+            max_new_tokens, eos_token_ids, on_token, cancelled, router, timings, on_finish,
+            drafter, draft_stats, stop, sampling,
+        )
+
+
+def _record_timings(timings, started_at, prefilled_at):
+    if timings is not None:
+        # Added to, so several generations of one request sum up
+        prefill = prefilled_at - started_at if prefilled_at is not None else 0.0
+        timings['prefill'] = timings.get('prefill', 0.0) + prefill
+        timings['decode'] = timings.get('decode', 0.0) + time.perf_counter() - (prefilled_at or started_at)
+
+
+def _generate(model, input_ids, attention_mask, inputs_embeds, image_grid_thw, past_key_values,
+              max_new_tokens, eos_token_ids, on_token, cancelled, router, timings, on_finish,
+              drafter, draft_stats, stop, sampling):
+    started_at = time.perf_counter()
+    prefilled_at = None
+    batch_size, seq_length = input_ids.shape
+    position_ids, rope_deltas = get_rope_index(model, input_ids, image_grid_thw, attention_mask)
+    position_ids = position_ids.to(input_ids.device)
+    rope_deltas = rope_deltas.to(input_ids.device).view(batch_size)
+
+    # Prefill only what the cache does not already cover
+    if past_key_values is None:
+        past_key_values = DynamicCache()
+    start = past_key_values.get_seq_length()
+
+    logits, past_key_values = forward(
+        model,
+        inputs_embeds=inputs_embeds,
+        attention_mask=attention_mask,
+        position_ids=position_ids[:, :, start:],
+        past_key_values=past_key_values,
+    )
+
+    eos_set = set(eos_token_ids)
+    if isinstance(max_new_tokens, int):
+        budgets = [max_new_tokens] * batch_size
+    else:
+        budgets = list(max_new_tokens)
+    if drafter is not None:
+        generated, prefilled_at = _speculate(
+            model, logits, past_key_values, input_ids, attention_mask, seq_length + rope_deltas,
+            budgets, eos_set, on_token, cancelled, router, on_finish, drafter, draft_stats, stop, sampling,
+        )
+        _record_timings(timings, started_at, prefilled_at)
+        return generated
+
+    active = list(range(batch_size))  # original row of each row still decoding
+    generated = [[] for _ in range(batch_size)]
+    cache_length = seq_length
+
+    for _ in range(max(budgets)):
+        next_tokens = sample_next_tokens(logits[:, -1, :], **sampling)
+
+        tokens = next_tokens.tolist()
+        if prefilled_at is None:
+            # tolist() waits for the device, so this is when the first tokens exist
+            prefilled_at = time.perf_counter()
+
+        keep = []
+        for index, (row, token) in enumerate(zip(active, tokens)):
+            if token in eos_set:
+                if on_finish is not None:
+                    on_finish(row)
+                continue
+            generated[row].append(token)
+            if on_token is not None:
+                on_token(row, token)
+            if cancelled is not None and cancelled(row):
+                continue
+            # The row has used up its budget or already holds a complete answer
+            if len(generated[row]) >= budgets[row] or (stop is not None and stop(row)):
+                if on_finish is not None:
+                    on_finish(row)
+                continue
+            keep.append(index)
+
+        if not keep:
+            break
+
+        # Drop finished and cancelled rows so they stop costing decode steps
+        if len(keep) < len(active):
+            keep_index = torch.tensor(keep, device=input_ids.device)
+            past_key_values.batch_select_indices(keep_index)
+            attention_mask = attention_mask[keep_index]
+            rope_deltas = rope_deltas[keep_index]
+            next_tokens = next_tokens[keep_index]
+            active = [active[index] for index in keep]
+            if router is not None:
+                router.select(keep)
+
+        # Decode positions continue from each row's last M-RoPE position
+        attention_mask = torch.cat([attention_mask, attention_mask.new_ones(len(active), 1)], dim=1)
+        step_positions = (cache_length + rope_deltas).view(1, -1, 1).expand(3, -1, -1)
+        logits, past_key_values = forward(
+            model,
+            input_ids=next_tokens.unsqueeze(-1),
+            attention_mask=attention_mask,
+            position_ids=step_positions,
+            past_key_values=past_key_values,
+        )
+        cache_length += 1
+
+    _record_timings(timings, started_at, prefilled_at)
+    return generated
+
+
+def _speculate(model, logits, past_key_values, input_ids, attention_mask, positions, budgets,
+               eos_set, on_token, cancelled, router, on_finish, drafter, draft_stats, stop, sampling):
+    """Decode loop that feeds each row's last token plus a draft and keeps what the model verifies
+
+    positions holds each row's next M-RoPE text position. Rows accept different
+    numbers of draft tokens, so every step appends the same number of cache slots
+    to each row and masks the rejected ones out for good.
+    """
+    device = input_ids.device
+    batch_size = input_ids.shape[0]
+    image_token_id = model.config.image_token_id
+    # Drafts come from the prompt text, without padding and image tokens
+    contexts = [
+        [token for token, keep in zip(ids, mask) if keep and token != image_token_id]
+        for ids, mask in zip(input_ids.tolist(), attention_mask.tolist())
+    ]
+
+    pending = [[token] for token in sample_next_tokens(logits[:, -1, :], **sampling).tolist()]
+    prefilled_at = time.perf_counter()
+    active = list(range(batch_size))
+    generated = [[] for _ in range(batch_size)]
+    drafted = [0] * batch_size
+    accepted = [0] * batch_size
+
+    while True:
+        # Emit the verified tokens of every row; the last one is fed next
+        keep = []
+        for index, row in enumerate(active):
+            ended = False
+            for token in pending[row]:
+                if token in eos_set:
+                    ended = True
+                    break
+                generated[row].append(token)
+                if on_token is not None:
+                    on_token(row, token)
+                if len(generated[row]) >= budgets[row]:
+                    break
+            if ended:
+                if on_finish is not None:
+                    on_finish(row)
+                continue
+            if cancelled is not None and cancelled(row):
+                continue
+            if len(generated[row]) >= budgets[row] or (stop is not None and stop(row)):
+                if on_finish is not None:
+                    on_finish(row)
+                continue
+            keep.append(index)
+        if not keep:
+            break
+
+        # Drop finished and cancelled rows so they stop costing decode steps
+        if len(keep) < len(active):
+            keep_index = torch.tensor(keep, device=device)
+            past_key_values.batch_select_indices(keep_index)
+            attention_mask = attention_mask[keep_index]
+            positions = positions[keep_index]
+            active = [active[index] for index in keep]
+            if router is not None:
+                router.select(keep)
+
+        # The verified token that follows a draft is extra, so drafts leave room for it
+        drafts = [
+            drafter.draft(contexts[row] + generated[row], budgets[row] - len(generated[row]) - 1)
+            for row in active
+        ]
+        width = max(len(draft) for draft in drafts)
+        chunk = torch.tensor(
+            [[generated[row][-1]] + draft + [0] * (width - len(draft)) for row, draft in zip(active, drafts)],
+            dtype=torch.long, device=device,
+        )
+        chunk_mask = torch.tensor(
+            [[1] * (1 + len(draft)) + [0] * (width - len(draft)) for draft in drafts],
+            dtype=attention_mask.dtype, device=device,
+        )
+        start = attention_mask.shape[1]
+        attention_mask = torch.cat([attention_mask, chunk_mask], dim=1)
+        chunk_positions = (positions.view(-1, 1) + torch.arange(width + 1, device=device)).unsqueeze(0).expand(3, -1, -1)
+        logits, past_key_values = forward(
+            model,
+            num_logits=width + 1,
+            input_ids=chunk,
+            attention_mask=attention_mask,
+            position_ids=chunk_positions,
+            past_key_values=past_key_values,
+        )
+
+        for index, (row, draft) in enumerate(zip(active, drafts)):
+            count, token = verify_draft(logits[index, :len(draft) + 1], draft, **sampling)
+            # Rejected draft tokens stay in the cache but are never attended to
+            attention_mask[index, start + 1 + count:] = 0
+            positions[index] += 1 + count
+            pending[row] = draft[:count] + [token]
+            drafted[row] += len(draft)
+            accepted[row] += count
+
+    if draft_stats is not None:
+        draft_stats.update(drafted=drafted, accepted=accepted)
+    return generated, prefilled_at
@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+"""
+Model loading for the Chart QA backend
+Merges a LoRA adapter into the base model, or loads a pre-merged ("baked") safetensors artifact
+"""
+
+import json
+import logging
+import os
+import time
+
+import torch
+from transformers import Qwen2VLForConditionalGeneration, AutoProcessor
+from peft import PeftModel
+
+logger = logging.getLogger(__name__)
+
+BAKE_MANIFEST = "chartqa_bake.json"
+
+
+def is_baked_model(path):
+    """Whether path holds a merged model written by bake_model.py"""
+    return bool(path) and os.path.isfile(os.path.join(path, BAKE_MANIFEST))
+
+
+def load_processor(path):
+    """Load the Qwen2-VL processor from a hub id or a local directory"""
+    return AutoProcessor.from_pretrained(path, trust_remote_code=True)
+
+
+def load_base_model(model_id, device="cpu", torch_dtype=torch.float32):
+    """Load the Qwen2-VL base model without any adapter"""
+    logger.info("Loading base model...")
+    return Qwen2VLForConditionalGeneration.from_pretrained(
+        model_id,
+        device_map=None,
+        torch_dtype=torch_dtype,
+        low_cpu_mem_usage=True,
+    ).to(device)
+
+
+def merge_lora(model_id, lora_path, device="cpu", torch_dtype=torch.float32):
+    """Load the base model, apply a LoRA adapter and merge it into the base weights"""
+    base_model = load_base_model(model_id, device, torch_dtype)
+
+    logger.info("Loading LoRA adapter...")
+    model_with_lora = PeftModel.from_pretrained(base_model, lora_path)
+    return model_with_lora.merge_and_unload()
+
+
+def baked_dtype(path):
+    """Weight dtype a baked model was written in, e.g. 'float32'"""
+    with open(os.path.join(path, BAKE_MANIFEST)) as f:
+        return json.load(f).get("torch_dtype")
+
+
+def load_baked_model(path, device, torch_dtype):
+    """Load a baked model straight from its memory-mapped safetensors files"""
+    started_at = time.monotonic()
+    # Only weights already in the requested dtype can be used in place
+    requested = str(torch_dtype).replace("torch.", "")
+    if baked_dtype(path) != requested:
+        logger.warning(f"{path} was baked in {baked_dtype(path)}, loading it as {requested} converts and copies "
+                       f"every tensor; re-bake with --dtype {requested} for a zero-copy load")
+    # With a device_map and low_cpu_mem_usage, weights are read from the mmapped
+    # safetensors shards directly into place, with no random init or extra copy
+    model = Qwen2VLForConditionalGeneration.from_pretrained(
+        path,
+        torch_dtype=torch_dtype,
+        device_map={"": device},
+        low_cpu_mem_usage=True,
+        use_safetensors=True,
+    )
+    logger.info(f"Loaded baked model from {path} in {time.monotonic() - started_at:.1f}s")
+    return model
+
+
+def bake_model(model_id, lora_path, output_dir, torch_dtype=torch.bfloat16, max_shard_size="2GB"):
+    """Merge a LoRA adapter once and write the result as safetensors plus the processor"""
+    started_at = time.monotonic()
+    model = merge_lora(model_id, lora_path, torch_dtype=torch_dtype)
+    model.eval()
+
+    os.makedirs(output_dir, exist_ok=True)
+    model.save_pretrained(output_dir, safe_serialization=True, max_shard_size=max_shard_size)
+    load_processor(model_id).save_pretrained(output_dir)
+
+    # The manifest marks the directory as a baked artifact and records its origin
+    with open(os.path.join(output_dir, BAKE_MANIFEST), "w") as f:
+        json.dump({
+            "base_model": model_id,
+            "lora_path": os.path.abspath(lora_path),
+            "torch_dtype": str(torch_dtype).replace("torch.", ""),
+            "baked_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        }, f, indent=2)
+
+    logger.info(f"Baked model written to {output_dir} in {time.monotonic() - started_at:.1f}s")
+    return output_dir
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Shared-prefix KV cache for the Chart QA backend
+Every prompt starts with the same chat-template header and system message, so its
+keys/values are computed once at startup and copied into each batch's cache
+"""
+
+import torch
+from transformers import DynamicCache
+
+
+def to_legacy_cache(past_key_values):
+    """Return a cache as a tuple of (key, value) tensors per layer"""
+    if hasattr(past_key_values, 'to_legacy_cache'):
+        return past_key_values.to_legacy_cache()
+    return tuple(past_key_values)
+
+
+def from_legacy_cache(key_values):
+    """Build a DynamicCache from a tuple of (key, value) tensors per layer"""
+    return DynamicCache.from_legacy_cache(key_values)
+
+
+def concat_prefix_caches(prefix_caches):
+    """Return a fresh batch cache whose row i holds prefix_caches[i]"""
+    if all(cache is prefix_caches[0] for cache in prefix_caches):
+        return prefix_caches[0].expand(len(prefix_caches))
+
+    # Rows use different adapters, so their prefix keys/values differ
+    layers = zip(*(cache.key_values for cache in prefix_caches))
+    return from_legacy_cache(tuple(
+        (
+            torch.cat([key for key, _ in layer]),
+            torch.cat([value for _, value in layer]),
+        )
+        for layer in layers
+    ))
+
+
+class PrefixCache:
+    """Precomputed KV cache for the constant prompt header shared by every request"""
+
+    def __init__(self, model, input_ids):
+        # input_ids has shape (1, prefix_length) and contains only text tokens,
+        # so its M-RoPE positions are the same plain range in all three sections
+        self.input_ids = input_ids
+        self.length = input_ids.shape[1]
+        position_ids = torch.arange(self.length, device=input_ids.device).view(1, 1, -1).expand(3, 1, -1)
+
+        with torch.no_grad():
+            outputs = model.model(
+                input_ids=input_ids,
+                position_ids=position_ids,
+                past_key_values=DynamicCache(),
+                use_cache=True,
+                return_dict=True,
+            )
+        self.key_values = to_legacy_cache(outputs.past_key_values)
+
+    @classmethod
+    def from_key_values(cls, input_ids, key_values):
+        """Wrap keys/values already computed for input_ids (e.g. a prefix that includes an image)"""
+        cache = cls.__new__(cls)
+        cache.input_ids = input_ids
+        cache.length = input_ids.shape[1]
+        cache.key_values = to_legacy_cache(key_values)
+        return cache
+
+    def expand(self, batch_size):
+        """Return a fresh cache holding the prefix once per row of a batch"""
+        return from_legacy_cache(tuple(
+            (
+                key.expand(batch_size, -1, -1, -1).contiguous(),
+                value.expand(batch_size, -1, -1, -1).contiguous(),
+            )
+            for key, value in self.key_values
+        ))
+
+    def nbytes(self):
+        """Memory held by the cached keys and values"""
+        return sum(
+            key.numel() * key.element_size() + value.numel() * value.element_size()
+            for key, value in self.key_values
+        )
@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Startup readiness for the Chart QA backend
+The server starts listening before the model is loaded and loads it on a
+background thread. Readiness tracks how far loading has got, so /health and
+/status can answer during a multi-minute load and requests get a fast 503
+instead of a refused connection.
+"""
+
+import logging
+import threading
+import time
+import traceback
+
+logger = logging.getLogger(__name__)
+
+STARTING = 'starting'
+LOADING = 'loading'
+WARMING = 'warming'
+READY = 'ready'
+FAILED = 'failed'
+
+
+class Readiness:
+    """Thread-safe startup state: starting -> loading -> warming -> ready, or failed"""
+
+    def __init__(self):
+        self.state = STARTING
+        self.stage = None
+        self.progress = 0.0
+        self.error = None
+        self.started_at = time.monotonic()
+        self.ready_at = None
+        self._lock = threading.Lock()
+
+    def advance(self, state, stage=None, progress=None):
+        """Move to state, naming the current stage and the fraction of startup done"""
+        with self._lock:
+            self.state = state
+            self.stage = stage
+            if progress is not None:
+                self.progress = max(self.progress, min(1.0, progress))
+            if state == READY:
+                self.progress = 1.0
+                self.ready_at = time.monotonic()
+        logger.info(f"Startup: {state}{f' ({stage})' if stage else ''}, {self.progress:.0%}")
+
+    def fail(self, error):
+        with self._lock:
+            self.state = FAILED
+            self.error = str(error)
+
+    def is_ready(self):
+        return self.state == READY
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                'state': self.state,
+                'stage': self.stage,
+                'progress': round(self.progress, 3),
+                'error': self.error,
+                'startup_seconds': round((self.ready_at or time.monotonic()) - self.started_at, 1),
+            }
+
+    def run_in_background(self, load):
+        """Run load() on a daemon thread; a False result or an exception marks startup failed"""
+        def run():
+            try:
+                if not load():
+                    self.fail(self.error or 'Model failed to load')
+            except Exception as e:
+                logger.error(f"Startup failed: {str(e)}")
+                logger.error(traceback.format_exc())
+                self.fail(e)
+
+        thread = threading.Thread(target=run, name="model-loader", daemon=True)
+        thread.start()
+        return thread
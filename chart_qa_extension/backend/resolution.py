@@ -0,0 +1,127 @@
+#!/usr/bin/env python3
+"""
+Visual-token budget for the Chart QA backend
+Qwen2-VL spends one visual token per 28x28 pixel block, so the image resolution
+sets the prefill cost. Images are resized to a pixel budget chosen per request
+from presets, explicit min/max pixels or an auto mode driven by chart complexity
+and server load.
+"""
+
+import math
+
+# 14px vision patches merged 2x2 into one visual token
+PATCH_FACTOR = 28
+TOKEN_PIXELS = PATCH_FACTOR * PATCH_FACTOR
+
+# accurate allows 37x37 tokens, the most a 1024px upload (image_io.MAX_IMAGE_SIZE) can produce
+PRESETS = {
+    'fast': {'min_pixels': 4 * TOKEN_PIXELS, 'max_pixels': 256 * TOKEN_PIXELS},
+    'balanced': {'min_pixels': 4 * TOKEN_PIXELS, 'max_pixels': 640 * TOKEN_PIXELS},
+    'accurate': {'min_pixels': 4 * TOKEN_PIXELS, 'max_pixels': 1369 * TOKEN_PIXELS},
+}
+PRESET_ORDER = ['fast', 'balanced', 'accurate']
+
+# Auto mode: edge density below SIMPLE_CHART is a sparse chart (few bars or lines),
+# above DETAILED_CHART a dense one (many labels, series or table cells)
+SIMPLE_CHART = 0.04
+DETAILED_CHART = 0.10
+# Auto mode: queue fill at which resolution drops one preset, and drops to fast
+BUSY_LOAD = 0.4
+OVERLOADED_LOAD = 0.75
+
+
+def smart_resize(height, width, min_pixels, max_pixels, factor=PATCH_FACTOR):
+    """Closest size with both sides multiples of factor and an area within [min_pixels, max_pixels]
+
+    Same rule as the Qwen2-VL image processor, so images resized here pass through it unchanged.
+    """
+    h_bar = max(factor, round(height / factor) * factor)
+    w_bar = max(factor, round(width / factor) * factor)
+    if h_bar * w_bar > max_pixels:
+        beta = math.sqrt((height * width) / max_pixels)
+        h_bar = max(factor, math.floor(height / beta / factor) * factor)
+        w_bar = max(factor, math.floor(width / beta / factor) * factor)
+    elif h_bar * w_bar < min_pixels:
+        beta = math.sqrt(min_pixels / (height * width))
+        h_bar = math.ceil(height * beta / factor) * factor
+        w_bar = math.ceil(width * beta / factor) * factor
+    return h_bar, w_bar
+
+
+def chart_complexity(image):
+    """Edge density of a small grayscale thumbnail, from 0 (blank) upwards"""
+    from PIL import Image, ImageFilter, ImageStat
+
+    thumbnail = image.convert('L').resize((128, 128), Image.Resampling.BILINEAR)
+    return ImageStat.Stat(thumbnail.filter(ImageFilter.FIND_EDGES)).mean[0] / 255.0
+
+
+class ResolutionPolicy:
+    """Chooses and applies the pixel budget of each request"""
+
+    def __init__(self, default='accurate', min_pixels=None, max_pixels=None):
+        self.default = self.parse(default)['resolution']
+        # Server-wide bounds for requests that pick neither a preset nor their own bounds
+        self.min_pixels = min_pixels
+        self.max_pixels = max_pixels
+
+    def parse(self, resolution=None, min_pixels=None, max_pixels=None):
+        """Validate the resolution options of a request (None means the server default)"""
+        if resolution is not None and resolution != 'auto' and resolution not in PRESETS:
+            raise ValueError(f"Unknown resolution '{resolution}' (use auto, {', '.join(PRESET_ORDER)})")
+        spec = {
+            'resolution': resolution,
+            'min_pixels': int(min_pixels) if min_pixels not in (None, '') else None,
+            'max_pixels': int(max_pixels) if max_pixels not in (None, '') else None,
+        }
+        for key in ('min_pixels', 'max_pixels'):
+            if spec[key] is not None and spec[key] < TOKEN_PIXELS:
+                raise ValueError(f"{key} must be at least {TOKEN_PIXELS}")
+        if spec['min_pixels'] and spec['max_pixels'] and spec['min_pixels'] > spec['max_pixels']:
+            raise ValueError("min_pixels must not exceed max_pixels")
+        return spec
+
+    def choose_preset(self, resolution, image, load):
+        """Resolve auto into a preset from chart complexity and load (0 = idle, 1 = queue full)"""
+        if resolution != 'auto':
+            return resolution
+
+        complexity = chart_complexity(image)
+        level = 0 if complexity < SIMPLE_CHART else 1 if complexity < DETAILED_CHART else 2
+        if load >= OVERLOADED_LOAD:
+            level = 0
+        elif load >= BUSY_LOAD:
+            level = max(0, level - 1)
+        return PRESET_ORDER[level]
+
+    def apply(self, image, spec=None, load=0.0):
+        """Resize image to its budget, returning (image, info) with the visual-token count"""
+        spec = spec or {}
+        resolution = spec.get('resolution') or self.default
+        preset = self.choose_preset(resolution, image, load)
+
+        # Explicit request bounds win, then the chosen preset, with the server-wide
+        # bounds standing in for the preset when the request did not choose one
+        min_pixels = PRESETS[preset]['min_pixels']
+        max_pixels = PRESETS[preset]['max_pixels']
+        if not spec.get('resolution'):
+            min_pixels = self.min_pixels or min_pixels
+            max_pixels = self.max_pixels or max_pixels
+        min_pixels = spec.get('min_pixels') or min_pixels
+        max_pixels = max(spec.get('max_pixels') or max_pixels, min_pixels)
+
+        height, width = smart_resize(image.height, image.width, min_pixels, max_pixels)
+        if (width, height) != image.size:
+            from PIL import Image
+
+            image = image.resize((width, height), Image.Resampling.BICUBIC)
+
+        return image, {
+            'resolution': resolution,
+            'preset': preset,
+            'min_pixels': min_pixels,
+            'max_pixels': max_pixels,
+            'width': width,
+            'height': height,
+            'visual_tokens': (width // PATCH_FACTOR) * (height // PATCH_FACTOR),
+        }
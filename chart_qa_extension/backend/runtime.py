@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Runtime helpers for the Chart QA backend
+Device selection, CPU thread control, int8 quantization and memory reporting
+"""
+
+import logging
+import os
+import resource
+
+import torch
+
+logger = logging.getLogger(__name__)
+
+
+def select_device(preferred=None):
+    """Pick cuda, then mps, then cpu, unless a device is requested explicitly"""
+    if preferred:
+        return preferred
+    if torch.cuda.is_available():
+        return "cuda"
+    if getattr(torch.backends, "mps", None) is not None and torch.backends.mps.is_available():
+        return "mps"
+    return "cpu"
+
+
+def default_dtype(device):
+    """bfloat16 on CUDA, float32 elsewhere"""
+    return torch.bfloat16 if device == "cuda" else torch.float32
+
+
+def configure_threads(num_threads=None, num_interop_threads=None):
+    """Set intra-op and inter-op thread counts (call before any model work)"""
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError as e:
+            # Only allowed once, before any inter-op parallel work has started
+            logger.warning(f"Could not set inter-op threads: {str(e)}")
+    logger.info(f"Torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+
+def quantize_int8(model, skip=(".lora_",)):
+    """Dynamically quantize nn.Linear layers to int8 weights in place (CPU only)
+
+    Layers whose name contains any of the skip substrings (unmerged LoRA
+    weights by default) stay in floating point.
+    """
+    names = {
+        name for name, module in model.named_modules()
+        if isinstance(module, torch.nn.Linear) and not any(part in name for part in skip)
+    }
+    return torch.ao.quantization.quantize_dynamic(model, names, dtype=torch.qint8, inplace=True)
+
+
+def model_memory_bytes(model):
+    """Bytes held by parameters, buffers and packed quantized weights"""
+    total = 0
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        total += tensor.numel() * tensor.element_size()
+    for module in model.modules():
+        # Dynamically quantized Linear layers keep their weights outside parameters()
+        if hasattr(module, "_packed_params") and callable(getattr(module, "weight", None)):
+            weight = module.weight()
+            total += weight.numel() * weight.element_size()
+    return total
+
+
+def process_memory():
+    """Current and peak resident set size of this process, in MB"""
+    current = None
+    try:
+        with open("/proc/self/statm") as f:
+            current = int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        pass
+
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak if os.uname().sysname == "Darwin" else peak * 1024
+
+    return {
+        'rss_mb': round(current / 1024 / 1024, 1) if current is not None else None,
+        'peak_rss_mb': round(peak / 1024 / 1024, 1),
+    }
+
+
+def available_memory_bytes(device):
+    """Memory still free for activations and KV caches on device, None when it cannot be told"""
+    if device.startswith("cuda"):
+        free, _ = torch.cuda.mem_get_info()
+        # Blocks the caching allocator holds but does not use are free to this process too
+        return free + torch.cuda.memory_reserved() - torch.cuda.memory_allocated()
+    if device == "mps":
+        try:
+            return torch.mps.recommended_max_memory() - torch.mps.driver_allocated_memory()
+        except AttributeError:
+            return None
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemAvailable:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+Draft proposers for speculative decoding in the Chart QA backend
+A drafter guesses the next few tokens of an answer cheaply; the decode loop
+checks the whole guess with one forward pass of the fine-tuned model and keeps
+the accepted part (see decoding.generate_tokens). Drafts are deterministic, so
+verification keeps the model's own output distribution.
+"""
+
+import torch
+from transformers import AutoModelForCausalLM
+
+
+class PromptLookupDrafter:
+    """Copies what followed the latest earlier occurrence of the context's last n-gram
+
+    Chart answers often repeat numbers and labels from the question, or text that
+    the answer itself already contains. Costs no model call.
+    """
+
+    name = 'prompt_lookup'
+
+    def __init__(self, num_tokens=6, max_ngram=3, min_ngram=1):
+        self.num_tokens = num_tokens
+        self.max_ngram = max_ngram
+        self.min_ngram = min_ngram
+
+    def draft(self, context, max_tokens=None):
+        """Up to max_tokens (default num_tokens) token ids that may follow context"""
+        limit = min(self.num_tokens, max_tokens if max_tokens is not None else self.num_tokens)
+        if limit <= 0:
+            return []
+        # Longer n-grams first: they predict the continuation more reliably
+        for n in range(min(self.max_ngram, len(context) - 1), self.min_ngram - 1, -1):
+            tail = context[-n:]
+            for start in range(len(context) - n - 1, -1, -1):
+                if context[start:start + n] == tail:
+                    return list(context[start + n:start + n + limit])
+        return []
+
+
+class DraftModelDrafter:
+    """Drafts greedily with a small text-only model that shares the tokenizer
+
+    The draft model never sees the image, only the last context_tokens text
+    tokens (the question and the answer so far).
+    """
+
+    name = 'draft_model'
+
+    def __init__(self, model, num_tokens=4, context_tokens=64):
+        self.model = model
+        self.num_tokens = num_tokens
+        self.context_tokens = context_tokens
+        self.device = next(model.parameters()).device
+
+    @torch.no_grad()
+    def draft(self, context, max_tokens=None):
+        limit = min(self.num_tokens, max_tokens if max_tokens is not None else self.num_tokens)
+        if limit <= 0 or not context:
+            return []
+        input_ids = torch.tensor([context[-self.context_tokens:]], dtype=torch.long, device=self.device)
+        past_key_values = None
+        tokens = []
+        for _ in range(limit):
+            outputs = self.model(input_ids=input_ids, past_key_values=past_key_values, use_cache=True)
+            past_key_values = outputs.past_key_values
+            token = int(outputs.logits[0, -1].argmax())
+            tokens.append(token)
+            input_ids = torch.tensor([[token]], dtype=torch.long, device=self.device)
+        return tokens
+
+
+def load_draft_model(model_id, device, torch_dtype, vocab_size=None):
+    """Load a small causal LM as draft model, checking that it shares the target's vocabulary"""
+    model = AutoModelForCausalLM.from_pretrained(
+        model_id,
+        torch_dtype=torch_dtype,
+        device_map={"": device},
+        low_cpu_mem_usage=True,
+    )
+    if vocab_size is not None and model.config.vocab_size != vocab_size:
+        raise ValueError(f"Draft model {model_id} has a vocabulary of {model.config.vocab_size} tokens, "
+                         f"the served model {vocab_size}: they must share the tokenizer")
+    model.eval()
+    return model
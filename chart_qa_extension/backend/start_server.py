@@ -5,26 +5,51 @@ Startup script for the Chart QA backend server
 
 import os
 import sys
+import argparse
+import importlib.util
 import subprocess
 import time
 
+# Import name -> package name for the requirements the server cannot start without
+REQUIRED_MODULES = {
+    'torch': 'torch',
+    'transformers': 'transformers',
+    'peft': 'peft',
+    'flask': 'flask',
+    'flask_cors': 'flask-cors',
+    'PIL': 'pillow',
+}
+
 def check_dependencies():
-    """Check if required dependencies are installed"""
-    try:
-        import torch
-        import transformers
-        import peft
-        import flask
-        import flask_cors
-        from PIL import Image
-        print("✅ All dependencies are installed")
-        return True
-    except ImportError as e:
-        print(f"❌ Missing dependency: {e}")
+    """Check if required dependencies are installed, without importing them"""
+    missing = [package for module, package in REQUIRED_MODULES.items() if importlib.util.find_spec(module) is None]
+    if missing:
+        print(f"❌ Missing dependencies: {', '.join(missing)}")
         print("Please install requirements: pip install -r requirements.txt")
         return False
+    print("✅ All dependencies are installed")
+    return True
 
 def main():
+    parser = argparse.ArgumentParser(description="Start the Chart QA backend server")
+    parser.add_argument("--production", action="store_true",
+                        help="Serve with waitress and a bounded inference queue instead of Flask's dev server")
+    parser.add_argument("--port", type=int, default=5001, help="Port to listen on")
+    parser.add_argument("--stub", action="store_true",
+                        help="Serve the deterministic stand-in model (for benchmarks, no Qwen2-VL download)")
+    parser.add_argument("--workers", type=int,
+                        help="Fork this many model workers that share one copy of the weights (CPU only)")
+    parser.add_argument("--worker-threads", type=int, help="Torch threads per worker (default: cores / workers)")
+    args = parser.parse_args()
+    production = args.production or os.environ.get('CHARTQA_PRODUCTION', '0') == '1'
+    if args.stub:
+        os.environ['CHARTQA_STUB_MODEL'] = '1'
+    if args.workers:
+        os.environ['CHARTQA_WORKERS'] = str(args.workers)
+    if args.worker_threads:
+        os.environ['CHARTQA_WORKER_THREADS'] = str(args.worker_threads)
+    stub = os.environ.get('CHARTQA_STUB_MODEL', '0') == '1'
+    
     print("🚀 Starting Chart QA Backend Server...")
     print("=" * 50)
     
@@ -32,29 +57,39 @@ def main():
     if not check_dependencies():
         sys.exit(1)
     
-    # Check if model files exist
-    model_path = "/Users/gauravatavale/Documents/AI_research/chartQA_finetuning/lora_model_8k"
-    if not os.path.exists(model_path):
+    # Check if model files exist (a baked model from bake_model.py, or the LoRA adapter)
+    model_path = (
+        os.environ.get('CHARTQA_MODEL_PATH')
+        or os.environ.get('CHARTQA_LORA_PATH')
+        or "/Users/gauravatavale/Documents/AI_research/chartQA_finetuning/lora_model_8k"
+    )
+    if stub:
+        print("⚠️  Using the stub model: answers are simulated")
+    elif not os.path.exists(model_path):
         print(f"❌ Model path not found: {model_path}")
         print("Please ensure your fine-tuned model is available at this location")
         sys.exit(1)
-    
-    print(f"✅ Model path found: {model_path}")
+    else:
+        print(f"✅ Model path found: {model_path}")
     
     # Start the Flask server
-    print("\n🌐 Starting Flask server on http://localhost:5001")
+    mode = "production (waitress)" if production else "development (Flask)"
+    print(f"\n🌐 Starting {mode} server on http://localhost:{args.port}")
     print("Press Ctrl+C to stop the server")
     print("=" * 50)
     
     try:
         # Import and run the app
-        from app import app, load_model
+        from app import WORKERS, load_model_in_background, run_server, run_workers
         
-        if load_model():
-            app.run(host='0.0.0.0', port=5001, debug=False)
+        # The port opens right away and answers 503 until the model is ready; with
+        # several workers the weights are loaded here and the workers fork from this process
+        print("⏳ Loading the model in the background, see /health for progress")
+        if WORKERS > 1:
+            run_workers(WORKERS, port=args.port, production=production)
         else:
-            print("❌ Failed to load model")
-            sys.exit(1)
+            load_model_in_background()
+            run_server(port=args.port, production=production)
             
     except KeyboardInterrupt:
         print("\n👋 Server stopped by user")
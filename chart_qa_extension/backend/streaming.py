@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Token streaming for the Chart QA backend
+Hands generated text from the model worker to one HTTP response as Server-Sent Events
+"""
+
+import json
+import queue
+import threading
+import time
+import uuid
+
+
+def format_sse(event, data):
+    """Format one Server-Sent Event"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+class TokenStream:
+    """Thread-safe channel of generated text for a single request, with cancellation"""
+
+    def __init__(self, tokenizer):
+        self.tokenizer = tokenizer
+        self.request_id = uuid.uuid4().hex
+        self.token_ids = []
+        self.text = ""
+
+        self._events = queue.Queue()
+        self._cancelled = threading.Event()
+
+        # Timings, all from time.monotonic()
+        self.created_at = time.monotonic()
+        self.started_at = None
+        self.first_token_at = None
+        self.finished_at = None
+
+    def start(self):
+        """Mark the moment the model worker picked this request up"""
+        if self.started_at is None:
+            self.started_at = time.monotonic()
+
+    def put_token(self, token_id):
+        """Append one generated token and emit any newly completed text"""
+        if self.first_token_at is None:
+            self.first_token_at = time.monotonic()
+        self.token_ids.append(token_id)
+
+        # Re-decode the whole answer so multi-token characters come out intact
+        text = self.tokenizer.decode(self.token_ids, skip_special_tokens=True)
+        if text.endswith("\ufffd"):
+            return
+        if len(text) > len(self.text):
+            self._events.put(('token', {'text': text[len(self.text):]}))
+        self.text = text
+
+    def emit(self, event, data):
+        """Send an application-specific event (e.g. one finished answer of /suggest)"""
+        self._events.put((event, data))
+
+    def finish(self, answer=None, **metadata):
+        """Emit the final answer (if the request has a single one) with timing metadata"""
+        self.finished_at = time.monotonic()
+        if answer is not None:
+            metadata['answer'] = answer
+        self._events.put(('done', dict(self.timings(), **metadata)))
+
+    def fail(self, error):
+        """Emit an error event"""
+        self.finished_at = time.monotonic()
+        self._events.put(('error', {'error': str(error)}))
+
+    def cancel(self):
+        """Ask the model worker to stop generating for this request"""
+        self._cancelled.set()
+        self._events.put(None)
+
+    @property
+    def cancelled(self):
+        return self._cancelled.is_set()
+
+    def timings(self):
+        """Queue, time-to-first-token and total latency in milliseconds"""
+        def elapsed(start, end):
+            return round((end - start) * 1000, 1) if start is not None and end is not None else None
+
+        return {
+            'request_id': self.request_id,
+            'queue_ms': elapsed(self.created_at, self.started_at),
+            'ttft_ms': elapsed(self.created_at, self.first_token_at),
+            'total_ms': elapsed(self.created_at, self.finished_at),
+            'generated_tokens': len(self.token_ids),
+        }
+
+    def events(self, timeout=None):
+        """Yield (event, data) pairs until the stream finishes, fails or is cancelled"""
+        while True:
+            try:
+                entry = self._events.get(timeout=timeout)
+            except queue.Empty:
+                self.cancel()
+                yield 'error', {'error': 'Timed out waiting for the model'}
+                return
+            if entry is None:
+                return
+            yield entry
+            if entry[0] in ('done', 'error'):
+                return
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Deterministic stand-in model for benchmarking the Chart QA backend
+Answers without loading Qwen2-VL: each batch sleeps for a simulated prefill and
+per-token decode time and streams a fixed answer derived from the image and question
+"""
+
+import hashlib
+import time
+
+VOCABULARY = [str(digit) for digit in range(10)] + [
+    "the", "chart", "shows", "value", "is", "highest", "lowest", "in", "for",
+    "percent", "million", "increase", "decrease", "between", "and", "year",
+]
+
+
+class StubTokenizer:
+    """Maps token ids to words of a fixed vocabulary"""
+
+    eos_token_id = len(VOCABULARY)
+
+    def decode(self, token_ids, skip_special_tokens=True):
+        return " ".join(VOCABULARY[token_id] for token_id in token_ids if token_id < len(VOCABULARY))
+
+
+class StubProcessor:
+    """Just enough of a processor for TokenStream and the request handlers"""
+
+    def __init__(self):
+        self.tokenizer = StubTokenizer()
+
+
+class StubModel:
+    """Simulates batched generation timing: prefill per batch and image, then one step per token"""
+
+    def __init__(self, prefill_ms=50.0, image_ms=20.0, token_ms=10.0, max_new_tokens=16):
+        self.prefill_ms = prefill_ms
+        self.image_ms = image_ms
+        self.token_ms = token_ms
+        self.max_new_tokens = max_new_tokens
+
+    def answer_tokens(self, item):
+        """Deterministic answer token ids for one request"""
+        digest = hashlib.sha256(f"{item['image_hash']}:{item['question']}".encode("utf-8")).digest()
+        length = 1 + digest[0] % self.max_new_tokens
+        return [digest[1 + index % 31] % len(VOCABULARY) for index in range(length)]
+
+    def run_batch(self, batch, is_cancelled):
+        """Answer a batch like app.run_batch does, with simulated compute time"""
+        answers = [""] * len(batch)
+        live = [index for index, item in enumerate(batch) if not is_cancelled(item)]
+        if not live:
+            return answers
+        for index in live:
+            if batch[index].get('stream') is not None:
+                batch[index]['stream'].start()
+
+        time.sleep((self.prefill_ms + self.image_ms * len(live)) / 1000.0)
+
+        # Decode steps run until the longest live answer is done, like the real loop
+        sequences = {index: self.answer_tokens(batch[index]) for index in live}
+        generated = {index: [] for index in live}
+        for step in range(max(len(tokens) for tokens in sequences.values())):
+            time.sleep(self.token_ms / 1000.0)
+            for index in list(sequences):
+                stream = batch[index].get('stream')
+                if is_cancelled(batch[index]) or step >= len(sequences[index]):
+                    del sequences[index]
+                    continue
+                token_id = sequences[index][step]
+                generated[index].append(token_id)
+                if stream is not None:
+                    stream.put_token(token_id)
+            if not sequences:
+                break
+
+        tokenizer = StubTokenizer()
+        for index in live:
+            answers[index] = tokenizer.decode(generated[index])
+        return answers
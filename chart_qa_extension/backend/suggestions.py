@@ -0,0 +1,60 @@
+#!/usr/bin/env python3
+"""
+Question suggestions for the Chart QA backend
+Builds the instruction that asks the model for questions about a chart and turns
+its reply into a clean list, topped up with generic chart questions when the
+model returns too few.
+"""
+
+import re
+
+# Used when the model suggests fewer questions than were asked for
+DEFAULT_QUESTIONS = [
+    "What is the title of the chart?",
+    "What is the highest value in the chart?",
+    "What is the lowest value in the chart?",
+    "Which category has the highest value?",
+    "Which category has the lowest value?",
+    "What is the difference between the highest and lowest values?",
+    "How many categories are shown?",
+    "What is the average of all values?",
+    "What trend does the chart show?",
+    "What is the sum of all values?",
+    "What does the x-axis represent?",
+    "What does the y-axis represent?",
+    "Which two categories have the closest values?",
+    "What is the ratio of the highest to the lowest value?",
+    "Is the value of the first category greater than the last?",
+    "What is the median value?",
+]
+
+# "1.", "2)", "-", "*", "Q1:" and similar list markers at the start of a line
+LIST_MARKER = re.compile(r'^\s*(?:[-*•]|q?\d+\s*[.):]|question\s*\d*\s*[.):])\s*', re.IGNORECASE)
+
+
+def question_prompt(count, title=None):
+    """Instruction asking the model for count questions about the chart"""
+    about = f'the chart titled "{title}"' if title else "this chart"
+    return (f"Suggest {count} different questions that can be answered by reading {about}. "
+            f"Write one question per line.")
+
+
+def parse_questions(text, count):
+    """Up to count distinct questions from the model's reply, topped up with DEFAULT_QUESTIONS"""
+    questions = []
+    seen = set()
+    for line in text.splitlines():
+        question = LIST_MARKER.sub('', line).strip().strip('"')
+        # A line without a question mark is prose around the list, not a question
+        if not question.endswith('?') or question.lower() in seen:
+            continue
+        seen.add(question.lower())
+        questions.append(question)
+
+    for question in DEFAULT_QUESTIONS:
+        if len(questions) >= count:
+            break
+        if question.lower() not in seen:
+            seen.add(question.lower())
+            questions.append(question)
+    return questions[:count]
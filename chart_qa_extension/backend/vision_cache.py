@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+"""
+Vision-encoder feature cache for the Chart QA backend
+Keeps the Qwen2-VL image embeddings of recent charts so follow-up questions skip the vision tower
+"""
+
+import threading
+from collections import OrderedDict
+
+
+class VisionFeatureCache:
+    """Thread-safe LRU of image hash -> (image embeddings, image_grid_thw), bounded by entries and bytes"""
+
+    def __init__(self, max_entries=64, max_bytes=512 * 1024 * 1024):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+
+        self._entries = OrderedDict()  # key -> (embeds, grid_thw, size)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """Return (embeds, grid_thw) for key, or None"""
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0], entry[1]
+
+    def __contains__(self, key):
+        """Whether key is cached, without touching its recency or the hit counters"""
+        with self._lock:
+            return key in self._entries
+
+    def put(self, key, embeds, grid_thw):
+        """Store the features of one image, evicting least recently used images over the caps"""
+        size = embeds.numel() * embeds.element_size()
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._entries:
+                self._bytes -= self._entries.pop(key)[2]
+            self._entries[key] = (embeds, grid_thw, size)
+            self._bytes += size
+            while len(self._entries) > self.max_entries or self._bytes > self.max_bytes:
+                _, (_, _, evicted_size) = self._entries.popitem(last=False)
+                self._bytes -= evicted_size
+                self.evictions += 1
+
+    def clear(self):
+        """Drop every cached image"""
+        with self._lock:
+            self._entries.clear()
+            self._bytes = 0
+
+    def stats(self):
+        """Cache counters for the status endpoint"""
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'bytes': self._bytes,
+                'max_entries': self.max_entries,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'hit_rate': round(self.hits / lookups, 4) if lookups else 0.0,
+            }
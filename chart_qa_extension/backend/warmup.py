@@ -0,0 +1,101 @@
+#!/usr/bin/env python3
+"""
+Startup warmup and shape buckets for the Chart QA backend
+The first request after boot pays for lazy kernel setup, allocator growth and
+processor initialisation, and with torch.compile for compiling the graphs its
+shapes need. Prompt lengths are padded up to a small set of buckets, so a
+warmup that runs one synthetic chart per bucket covers the shapes later
+requests use.
+"""
+
+import math
+import random
+
+# Prompt-suffix lengths (visual tokens plus question) that requests are padded to;
+# the upper three hold the largest image of the fast (256 tokens), balanced (640)
+# and accurate (1369) presets with room for the question
+DEFAULT_BUCKETS = (128, 320, 704, 1440)
+
+# Tokens of a bucket left for the question and the chat template around it
+QUESTION_ALLOWANCE = 64
+
+# A yes/no question keeps the warmup decode to a few tokens
+WARMUP_QUESTION = "Is the first bar taller than the last bar?"
+
+
+def parse_buckets(spec):
+    """Sorted bucket lengths from a comma-separated list, DEFAULT_BUCKETS when empty"""
+    if not spec:
+        return list(DEFAULT_BUCKETS)
+    buckets = sorted({int(part) for part in spec.split(',') if part.strip()})
+    if not buckets or buckets[0] <= 0:
+        raise ValueError(f"Invalid shape buckets '{spec}'")
+    return buckets
+
+
+def bucket_length(length, buckets):
+    """The smallest bucket that holds length, or length itself beyond the largest"""
+    for bucket in buckets:
+        if length <= bucket:
+            return bucket
+    return length
+
+
+def chart_size(visual_tokens, factor=28, aspect=4 / 3):
+    """(width, height), multiples of factor, of a landscape image with at most visual_tokens tokens"""
+    rows = max(1, int(math.sqrt(visual_tokens / aspect)))
+    columns = max(1, visual_tokens // rows)
+    return columns * factor, rows * factor
+
+
+def synthetic_chart(width, height, bars=6, seed=0):
+    """A simple bar chart with axes and labels, so the vision tower sees chart-like content"""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    image = Image.new('RGB', (width, height), 'white')
+    draw = ImageDraw.Draw(image)
+    left, bottom = width // 10, height - height // 8
+    draw.line([(left, height // 10), (left, bottom), (width - width // 20, bottom)], fill='black', width=2)
+    slot = (width - left - width // 20) // bars
+    for index in range(bars):
+        top = bottom - int((bottom - height // 10) * rng.uniform(0.2, 1.0))
+        x = left + index * slot + slot // 5
+        draw.rectangle([x, top, x + slot * 3 // 5, bottom], fill=(rng.randrange(40, 200), 90, 160))
+        draw.text((x, bottom + 4), f"C{index + 1}", fill='black')
+        draw.text((x, max(0, top - 12)), str(rng.randrange(10, 99)), fill='black')
+    return image
+
+
+def warmup_charts(buckets, max_visual_tokens, factor=28):
+    """(bucket, image) per reachable bucket, sized to fill it with at most max_visual_tokens tokens
+
+    A bucket larger than the biggest image plus its question is still reached by
+    that image when the bucket below is too small for it, so its chart is capped
+    at max_visual_tokens rather than skipped; buckets above that one are never used.
+    """
+    charts = []
+    previous = 0
+    for bucket in buckets:
+        if previous >= max_visual_tokens + QUESTION_ALLOWANCE:
+            break
+        visual_tokens = min(bucket - QUESTION_ALLOWANCE, max_visual_tokens)
+        if visual_tokens >= 4:
+            charts.append((bucket, synthetic_chart(*chart_size(visual_tokens, factor), seed=bucket)))
+        previous = bucket
+    return charts
+
+
+def compile_decoder(model, mode=None):
+    """torch.compile the language model forward used for prefill and decode, in place
+
+    The vision tower stays eager: its input size follows each image's patch
+    grid. Graphs are compiled with dynamic shapes so the KV cache can grow
+    during decode without a recompile per step; padding prompts to the buckets
+    keeps prefill within the shapes the warmup compiled.
+    """
+    import torch
+
+    decoder = model.model
+    decoder.forward = torch.compile(decoder.forward, mode=mode, dynamic=True)
+    return model
@@ -0,0 +1,361 @@
+#!/usr/bin/env python3
+"""
+Multi-process serving for the Chart QA backend
+The supervisor forks a dispatcher first, so the port answers while the model
+loads, then loads the model once and forks the model workers. Forked workers
+share the weights copy-on-write, so N workers cost one copy of the weights.
+The dispatcher process balances HTTP requests across the workers by in-flight
+count. POSIX only (os.fork), CPU only (CUDA does not survive a fork).
+
+Forking after torch has run parallel work is unsafe: the OpenMP and intra-op
+thread pools do not survive a fork, and children can hang in them or run on a
+single thread. prepare() must therefore do its torch work single-threaded
+(torch.set_num_threads(1)) and run_worker(index) must set its own thread
+counts before any torch op. A prepare() that needs parallel torch work
+cannot be used with this pool.
+"""
+
+import gc
+import http.client
+import json
+import logging
+import os
+import signal
+import threading
+import time
+
+from flask import Flask, Response, jsonify, request
+
+logger = logging.getLogger(__name__)
+
+# Per-connection headers that must not be copied between client and worker
+HOP_HEADERS = {'connection', 'keep-alive', 'transfer-encoding', 'te', 'upgrade',
+               'proxy-authorization', 'proxy-authenticate', 'trailer', 'host'}
+
+
+class Dispatcher:
+    """Picks the ready worker with the fewest in-flight requests"""
+
+    def __init__(self, ports, host='127.0.0.1', timeout=300.0, poll_seconds=0.5):
+        self.ports = list(ports)
+        self.host = host
+        self.timeout = timeout
+        self.poll_seconds = poll_seconds
+        self.in_flight = [0] * len(self.ports)
+        self.ready = [False] * len(self.ports)
+        self.dispatched = [0] * len(self.ports)
+        self.failed = 0
+        self._next = 0  # round-robin among equally loaded workers
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        """Start polling worker health"""
+        self._thread = threading.Thread(target=self._watch, name="dispatcher-health", daemon=True)
+        self._thread.start()
+
+    def acquire(self, exclude=()):
+        """Reserve the least-loaded ready worker, or return None when none is ready"""
+        with self._lock:
+            candidates = [index for index in range(len(self.ports)) if self.ready[index] and index not in exclude]
+            if not candidates:
+                return None
+            # Rotate the starting point so ties are spread evenly
+            candidates.sort(key=lambda index: (self.in_flight[index], (index - self._next) % len(self.ports)))
+            index = candidates[0]
+            self._next = (index + 1) % len(self.ports)
+            self.in_flight[index] += 1
+            self.dispatched[index] += 1
+            return index
+
+    def release(self, index):
+        with self._lock:
+            self.in_flight[index] -= 1
+
+    def mark_down(self, index):
+        """Stop sending to a worker until its health check passes again"""
+        with self._lock:
+            self.ready[index] = False
+            self.failed += 1
+
+    def connect(self, index, timeout=None):
+        return http.client.HTTPConnection(self.host, self.ports[index], timeout=timeout or self.timeout)
+
+    def fetch_json(self, index, path, timeout=5.0):
+        """GET a JSON document from one worker"""
+        connection = self.connect(index, timeout)
+        try:
+            connection.request('GET', path)
+            response = connection.getresponse()
+            return response.status, json.loads(response.read() or b'null')
+        finally:
+            connection.close()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'workers': len(self.ports),
+                'ready': sum(self.ready),
+                'in_flight': list(self.in_flight),
+                'dispatched': list(self.dispatched),
+                'failed': self.failed,
+            }
+
+    def _watch(self):
+        """Poll /health of every worker; workers restarted by the supervisor come back here"""
+        while True:
+            for index in range(len(self.ports)):
+                try:
+                    status, body = self.fetch_json(index, '/health', timeout=2.0)
+                    ready = status == 200 and bool(body and body.get('model_loaded'))
+                except (OSError, ValueError, http.client.HTTPException):
+                    ready = False
+                with self._lock:
+                    if ready != self.ready[index]:
+                        logger.info(f"Worker {index} on port {self.ports[index]} is {'ready' if ready else 'down'}")
+                    self.ready[index] = ready
+            time.sleep(self.poll_seconds)
+
+
+def label_metrics(text, worker):
+    """Add a worker label to every sample of a Prometheus text exposition"""
+    lines = []
+    for line in text.splitlines():
+        if not line or line.startswith('#'):
+            lines.append(line)
+        elif '{' in line.split(' ', 1)[0]:
+            lines.append(line.replace('{', f'{{worker="{worker}",', 1))
+        else:
+            name, value = line.split(' ', 1)
+            lines.append(f'{name}{{worker="{worker}"}} {value}')
+    return lines
+
+
+def merge_metrics(texts):
+    """Merge the expositions of several workers, keeping each metric's samples together"""
+    families = {}  # metric name -> [HELP/TYPE lines, samples]
+    current = None
+    for worker, text in texts:
+        for line in label_metrics(text, worker):
+            if line.startswith('# HELP ') or line.startswith('# TYPE '):
+                current = line.split(' ')[2]
+                family = families.setdefault(current, [[], []])
+                if len(family[0]) < 2:
+                    family[0].append(line)
+            elif line and current is not None:
+                families[current][1].append(line)
+    return '\n'.join(line for header, samples in families.values() for line in header + samples) + '\n'
+
+
+def create_dispatcher_app(dispatcher, max_content_length=None):
+    """Flask app that forwards every request to a model worker"""
+    proxy = Flask(__name__)
+    proxy.config['MAX_CONTENT_LENGTH'] = max_content_length
+
+    def no_worker():
+        return jsonify({
+            'error': 'No model worker is ready',
+            'success': False,
+            'retry_after': 1
+        }), 503, {'Retry-After': '1'}
+
+    @proxy.route('/health', methods=['GET'])
+    def health():
+        # Until a worker is ready the supervisor is still loading the model (or a worker restarting)
+        stats = dispatcher.stats()
+        return jsonify({
+            'status': 'healthy' if stats['ready'] else 'loading',
+            'model_loaded': stats['ready'] > 0,
+            'workers': stats,
+        }), 200 if stats['ready'] else 503
+
+    @proxy.route('/health/live', methods=['GET'])
+    def liveness():
+        return jsonify({'status': 'alive', 'workers': dispatcher.stats()})
+
+    @proxy.route('/status', methods=['GET'])
+    def status():
+        # Every worker's own status, plus the dispatcher's counters
+        workers = []
+        for index in range(len(dispatcher.ports)):
+            try:
+                workers.append(dispatcher.fetch_json(index, '/status')[1])
+            except (OSError, ValueError, http.client.HTTPException) as e:
+                workers.append({'error': str(e)})
+        return jsonify({'dispatcher': dispatcher.stats(), 'workers': workers})
+
+    @proxy.route('/metrics', methods=['GET'])
+    def metrics():
+        texts = []
+        for index in range(len(dispatcher.ports)):
+            connection = dispatcher.connect(index, 5.0)
+            try:
+                connection.request('GET', '/metrics')
+                texts.append((index, connection.getresponse().read().decode()))
+            except (OSError, http.client.HTTPException):
+                continue
+            finally:
+                connection.close()
+        return Response(merge_metrics(texts), mimetype='text/plain; version=0.0.4')
+
+    @proxy.route('/analyze/cancel', methods=['POST'])
+    def analyze_cancel():
+        # Streams live on whichever worker served them, so ask each in turn
+        body = request.get_data()
+        for index in range(len(dispatcher.ports)):
+            connection = dispatcher.connect(index, 5.0)
+            try:
+                connection.request('POST', '/analyze/cancel', body=body, headers={'Content-Type': 'application/json'})
+                response = connection.getresponse()
+                if response.status == 200:
+                    return Response(response.read(), status=200, mimetype='application/json')
+            except (OSError, http.client.HTTPException):
+                continue
+            finally:
+                connection.close()
+        return jsonify({'error': 'Unknown request id', 'success': False}), 404
+
+    @proxy.route('/', defaults={'path': ''}, methods=['GET', 'POST', 'OPTIONS'])
+    @proxy.route('/<path:path>', methods=['GET', 'POST', 'OPTIONS'])
+    def forward(path):
+        body = request.get_data()
+        headers = {name: value for name, value in request.headers if name.lower() not in HOP_HEADERS}
+        target = request.full_path if request.query_string else request.path
+
+        # A worker that refuses the connection is marked down and the next one tried
+        tried = set()
+        while True:
+            index = dispatcher.acquire(exclude=tried)
+            if index is None:
+                return no_worker()
+            connection = dispatcher.connect(index)
+            try:
+                connection.request(request.method, target, body=body, headers=headers)
+                response = connection.getresponse()
+                break
+            except (OSError, http.client.HTTPException) as e:
+                logger.warning(f"Worker {index} failed: {str(e)}")
+                connection.close()
+                dispatcher.release(index)
+                dispatcher.mark_down(index)
+                tried.add(index)
+
+        def stream():
+            # Relay chunks as they arrive so Server-Sent Events are not buffered
+            try:
+                while True:
+                    chunk = response.read1(65536)
+                    if not chunk:
+                        break
+                    yield chunk
+            finally:
+                connection.close()
+                dispatcher.release(index)
+
+        response_headers = [(name, value) for name, value in response.getheaders() if name.lower() not in HOP_HEADERS]
+        return Response(stream(), status=response.status, headers=response_headers)
+
+    return proxy
+
+
+class WorkerPool:
+    """Supervisor that forks the dispatcher and the model workers and restarts any that exit"""
+
+    def __init__(self, num_workers, run_worker, run_dispatcher, restart_delay=1.0, prepare=None):
+        # run_worker(index) and run_dispatcher() serve forever in the child process;
+        # prepare() runs here between forking the dispatcher and the workers (loads the model)
+        self.num_workers = num_workers
+        self.run_worker = run_worker
+        self.run_dispatcher = run_dispatcher
+        self.prepare = prepare
+        self.restart_delay = restart_delay
+        self.children = {}  # pid -> worker index, or None for the dispatcher
+        self._stopping = False
+        self._preparing = False
+
+    def run(self):
+        """Fork every child, then supervise until SIGINT/SIGTERM"""
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        self._spawn(None)
+        if self.prepare is not None:
+            self._preparing = True
+            try:
+                self.prepare()
+            except BaseException:
+                # Leave no dispatcher behind without workers
+                self._stopping = True
+                self._terminate()
+                self._reap()
+                raise
+            self._preparing = False
+
+        # Keep the garbage collector from touching (and so copying) objects
+        # created before the fork, the model's among them
+        gc.collect()
+        gc.freeze()
+        for index in range(self.num_workers):
+            self._spawn(index)
+
+        while not self._stopping:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            index = self.children.pop(pid, 'unknown')
+            if self._stopping or index == 'unknown':
+                continue
+            name = 'dispatcher' if index is None else f'worker {index}'
+            logger.error(f"The {name} (pid {pid}) exited with status {status}, restarting")
+            time.sleep(self.restart_delay)
+            self._spawn(index)
+
+        self._terminate()
+        self._reap()
+
+    def _reap(self):
+        """Wait for the children so none is left behind as a zombie"""
+        while self.children:
+            try:
+                self.children.pop(os.wait()[0], None)
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+
+    def _spawn(self, index):
+        pid = os.fork()
+        if pid:
+            self.children[pid] = index
+            return
+
+        # Child: serve until killed, never return into the supervisor loop
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        code = 0
+        try:
+            if index is None:
+                self.run_dispatcher()
+            else:
+                self.run_worker(index)
+        except Exception as e:
+            logger.error(f"{'Dispatcher' if index is None else f'Worker {index}'} failed: {str(e)}")
+            code = 1
+        finally:
+            os._exit(code)
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+        self._terminate()
+        if self._preparing:
+            # Interrupt a model load instead of finishing it first
+            raise SystemExit(0)
+
+    def _terminate(self):
+        for pid in list(self.children):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
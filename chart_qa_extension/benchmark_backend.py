@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+Load benchmark for the Chart QA backend
+Drives /analyze (or /analyze/stream for time-to-first-token) with a corpus of chart
+images, either at a fixed concurrency (closed loop) or at a fixed arrival rate
+(open loop, Poisson arrivals), and reports throughput, latency percentiles and
+error/timeout rates as JSON.
+
+Examples:
+    python benchmark_backend.py --concurrency 8 --requests 200
+    python benchmark_backend.py --rate 5 --duration 60 --stream --output results.json
+
+Start the server with `python backend/start_server.py --stub` to benchmark the
+serving stack on a CPU-only machine without the real model.
+"""
+
+import argparse
+import glob
+import io
+import json
+import math
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw
+
+QUESTIONS = [
+    "What is the highest value in the chart?",
+    "Which category has the lowest value?",
+    "What is the difference between the first and last bar?",
+    "How many bars are shown?",
+    "What is the title of the chart?",
+]
+
+
+def synthetic_charts(count, seed=0):
+    """Simple bar charts for when no image folder is given"""
+    rng = random.Random(seed)
+    images = []
+    for _ in range(count):
+        img = Image.new('RGB', (640, 480), color='white')
+        draw = ImageDraw.Draw(img)
+        bars = rng.randint(3, 8)
+        width = 560 // bars
+        for bar in range(bars):
+            height = rng.randint(40, 400)
+            left = 40 + bar * width
+            draw.rectangle([left + 8, 440 - height, left + width - 8, 440], fill=(60, 110, 200))
+        draw.line([40, 440, 600, 440], fill='black', width=2)
+        images.append(img)
+    return images
+
+
+def load_corpus(image_dir, count):
+    """Every image in image_dir, or synthetic charts when no folder is given"""
+    if image_dir:
+        paths = sorted(
+            path for path in glob.glob(os.path.join(image_dir, '*'))
+            if path.lower().endswith(('.png', '.jpg', '.jpeg', '.webp'))
+        )
+        images = [Image.open(path).convert('RGB') for path in paths]
+    else:
+        images = synthetic_charts(count)
+    if not images:
+        raise SystemExit(f"No images found in {image_dir}")
+    return images
+
+
+def encode_image(image, unique):
+    """PNG bytes of an image; unique requests change one pixel so caches never hit"""
+    if unique:
+        image = image.copy()
+        image.putpixel((0, 0), tuple(random.randrange(256) for _ in range(3)))
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return buffer.getvalue()
+
+
+def send_request(session, args, image, question, started_at=None):
+    """Send one request and return its measurements
+
+    started_at defaults to now; open-loop runs pass the scheduled arrival time so
+    that time spent waiting for a free client slot counts as latency too.
+    """
+    body = encode_image(image, args.unique)
+    url = f"{args.url}/analyze/stream" if args.stream else f"{args.url}/analyze"
+    headers = {'Content-Type': 'image/png', 'X-Question': question}
+    result = {'status': None, 'error': None, 'ttft_ms': None}
+    if started_at is None:
+        started_at = time.perf_counter()
+    try:
+        response = session.post(url, data=body, headers=headers, timeout=args.timeout, stream=args.stream)
+        result['status'] = response.status_code
+        if response.status_code != 200:
+            result['error'] = f"HTTP {response.status_code}"
+        elif args.stream:
+            # Read the Server-Sent Events until the final event
+            event = None
+            for line in response.iter_lines(decode_unicode=True):
+                if line.startswith('event:'):
+                    event = line[len('event:'):].strip()
+                elif line.startswith('data:'):
+                    if event == 'token' and result['ttft_ms'] is None:
+                        result['ttft_ms'] = (time.perf_counter() - started_at) * 1000
+                    elif event == 'done':
+                        if result['ttft_ms'] is None:
+                            # Cached answers arrive as a single final event
+                            result['ttft_ms'] = (time.perf_counter() - started_at) * 1000
+                        break
+                    elif event == 'error':
+                        result['error'] = 'stream error'
+                        break
+            else:
+                result['error'] = 'stream ended early'
+        response.close()
+    except requests.exceptions.Timeout:
+        result['error'] = 'timeout'
+    except requests.exceptions.RequestException as e:
+        result['error'] = type(e).__name__
+    result['latency_ms'] = (time.perf_counter() - started_at) * 1000
+    return result
+
+
+def percentiles(values):
+    """p50/p95/p99/mean/max of a list of milliseconds"""
+    if not values:
+        return None
+    ordered = sorted(values)
+
+    def rank(q):
+        # Nearest-rank percentile
+        return ordered[min(len(ordered), max(1, math.ceil(q / 100.0 * len(ordered)))) - 1]
+
+    return {
+        'p50': round(rank(50), 1),
+        'p95': round(rank(95), 1),
+        'p99': round(rank(99), 1),
+        'mean': round(sum(ordered) / len(ordered), 1),
+        'max': round(ordered[-1], 1),
+    }
+
+
+def run_benchmark(args, images):
+    """Issue the requests and collect one result per request"""
+    results = []
+    lock = threading.Lock()
+    counter = iter(range(10 ** 9))
+    deadline = time.perf_counter() + args.duration if args.duration else None
+
+    def next_index():
+        with lock:
+            index = next(counter)
+        if args.requests is not None and index >= args.requests:
+            return None
+        if deadline is not None and time.perf_counter() >= deadline:
+            return None
+        return index
+
+    local = threading.local()
+
+    def one(index, scheduled_at=None):
+        # One keep-alive session per client thread
+        if not hasattr(local, 'session'):
+            local.session = requests.Session()
+        image = images[index % len(images)]
+        question = QUESTIONS[index % len(QUESTIONS)]
+        result = send_request(local.session, args, image, question, scheduled_at)
+        with lock:
+            results.append(result)
+
+    started_at = time.perf_counter()
+    if args.rate:
+        # Open loop: arrivals follow a Poisson process regardless of how fast the server answers
+        with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+            next_arrival = time.perf_counter()
+            while True:
+                index = next_index()
+                if index is None:
+                    break
+                delay = next_arrival - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                pool.submit(one, index, next_arrival)
+                next_arrival += random.expovariate(args.rate)
+    else:
+        # Closed loop: each client sends its next request as soon as the last one returns
+        def client():
+            while True:
+                index = next_index()
+                if index is None:
+                    return
+                one(index)
+
+        threads = [threading.Thread(target=client) for _ in range(args.concurrency)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    return results, time.perf_counter() - started_at
+
+
+def summarize(args, results, elapsed):
+    """Machine-readable summary of a benchmark run"""
+    ok = [result for result in results if result['error'] is None]
+    statuses = {}
+    for result in results:
+        key = str(result['status']) if result['status'] is not None else result['error']
+        statuses[key] = statuses.get(key, 0) + 1
+    # Only client-side timeouts: a 503 may also mean the model is still loading, and stays in statuses
+    timeouts = sum(1 for result in results if result['error'] == 'timeout')
+    return {
+        'config': {
+            'url': args.url,
+            'endpoint': '/analyze/stream' if args.stream else '/analyze',
+            'mode': 'open' if args.rate else 'closed',
+            'concurrency': args.concurrency,
+            'rate': args.rate,
+            'requests': args.requests,
+            'duration': args.duration,
+            'unique_images': args.unique,
+            'timeout': args.timeout,
+        },
+        'requests': len(results),
+        'succeeded': len(ok),
+        'elapsed_s': round(elapsed, 2),
+        'throughput_rps': round(len(ok) / elapsed, 3) if elapsed else None,
+        'error_rate': round(1 - len(ok) / len(results), 4) if results else None,
+        'timeout_rate': round(timeouts / len(results), 4) if results else None,
+        'rejected_429': statuses.get('429', 0),
+        'statuses': statuses,
+        'latency_ms': percentiles([result['latency_ms'] for result in ok]),
+        'ttft_ms': percentiles([result['ttft_ms'] for result in ok if result['ttft_ms'] is not None]),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load benchmark for the Chart QA backend")
+    parser.add_argument('--url', default='http://localhost:5001')
+    parser.add_argument('--images', help='Folder of chart images (default: synthetic bar charts)')
+    parser.add_argument('--synthetic', type=int, default=16, help='Number of synthetic charts to generate')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='Concurrent clients (closed loop) or maximum in-flight requests (open loop)')
+    parser.add_argument('--rate', type=float, help='Arrival rate in requests/s (switches to open loop)')
+    parser.add_argument('--requests', type=int, help='Total number of requests')
+    parser.add_argument('--duration', type=float, help='Stop issuing requests after this many seconds')
+    parser.add_argument('--stream', action='store_true', help='Use /analyze/stream and measure time to first token')
+    parser.add_argument('--unique', action='store_true', help='Make every image unique so the caches never hit')
+    parser.add_argument('--timeout', type=float, default=120, help='Client timeout per request in seconds')
+    parser.add_argument('--warmup', type=int, default=2, help='Requests sent before measuring')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='Write the JSON results to this file')
+    args = parser.parse_args()
+
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+    random.seed(args.seed)
+
+    images = load_corpus(args.images, args.synthetic)
+    session = requests.Session()
+    for index in range(args.warmup):
+        send_request(session, args, images[index % len(images)], QUESTIONS[0])
+
+    results, elapsed = run_benchmark(args, images)
+    summary = summarize(args, results, elapsed)
+    try:
+        # Server-side view of the same run (batch sizes, cache hits, memory)
+        summary['server_status'] = session.get(f"{args.url}/status", timeout=10).json()
+    except (requests.exceptions.RequestException, ValueError):
+        summary['server_status'] = None
+
+    output = json.dumps(summary, indent=2)
+    print(output)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+
+
+if __name__ == '__main__':
+    main()
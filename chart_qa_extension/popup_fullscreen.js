@@ -517,7 +517,14 @@ async function checkBackendStatus() {
     if (response.ok) {
       showMessage('✅ Backend connected', 'success');
     } else {
-      showMessage('⚠️ Backend not responding', 'error');
+      // The server answers 503 with its startup state while the model loads
+      const health = await response.json().catch(() => null);
+      if (health && ['starting', 'loading', 'warming'].includes(health.status)) {
+        const progress = health.startup ? ` (${Math.round(health.startup.progress * 100)}%)` : '';
+        showMessage(`⏳ Model ${health.status}${progress}, please wait`, 'info');
+      } else {
+        showMessage('⚠️ Backend not responding', 'error');
+      }
     }
   } catch (error) {
     showMessage('❌ Backend not available. Please start the server.', 'error');
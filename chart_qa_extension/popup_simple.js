@@ -403,33 +403,41 @@ async function analyzeImage() {
     resultBox.innerHTML = '';
     
     // Compress image
-    const base64Data = await compressImage(currentScreenshot);
+    const imageBlob = await compressImage(currentScreenshot);
     
-    // Send to backend
-    const response = await fetch(`${API_BASE_URL}/analyze`, {
+    // Upload the JPEG as binary multipart data instead of base64 JSON
+    const formData = new FormData();
+    formData.append('image', imageBlob, 'screenshot.jpg');
+    formData.append('question', questionInput.value.trim());
+    
+    // Send to backend and stream the answer as it is generated
+    const response = await fetch(`${API_BASE_URL}/analyze/stream`, {
       method: 'POST',
-      headers: { 'Content-Type': 'application/json' },
-      body: JSON.stringify({
-        image: base64Data,
-        question: questionInput.value.trim()
-      })
+      body: formData
     });
     
     if (!response.ok) {
       throw new Error(`HTTP ${response.status}: ${response.statusText}`);
     }
     
-    const result = await response.json();
-    
     // Show result
     resultBox.innerHTML = `
       <div style="margin-bottom: 10px; font-weight: 600; color: #FFD700;">
         🤖 AI Analysis:
       </div>
-      <div style="line-height: 1.5;">
-        ${result.answer || result.error || 'No response received'}
-      </div>
+      <div id="answerText" style="line-height: 1.5;"></div>
     `;
+    const answerText = document.getElementById('answerText');
+    
+    const result = await readAnswerStream(response, (text) => {
+      loading.style.display = 'none';
+      answerText.textContent += text;
+    });
+    
+    if (result.error) {
+      throw new Error(result.error);
+    }
+    answerText.textContent = result.answer || 'No response received';
     
     showMessage('Analysis completed!', 'success');
     
@@ -450,6 +458,48 @@ async function analyzeImage() {
   }
 }
 
+// Read Server-Sent Events from /analyze/stream, calling onToken for each text chunk
+async function readAnswerStream(response, onToken) {
+  const reader = response.body.getReader();
+  const decoder = new TextDecoder();
+  let buffer = '';
+  
+  while (true) {
+    const { value, done } = await reader.read();
+    if (done) {
+      break;
+    }
+    buffer += decoder.decode(value, { stream: true });
+    
+    // Events are separated by a blank line
+    let boundary;
+    while ((boundary = buffer.indexOf('\n\n')) !== -1) {
+      const rawEvent = buffer.slice(0, boundary);
+      buffer = buffer.slice(boundary + 2);
+      
+      let eventName = 'message';
+      let data = '';
+      for (const line of rawEvent.split('\n')) {
+        if (line.startsWith('event: ')) {
+          eventName = line.slice(7);
+        } else if (line.startsWith('data: ')) {
+          data += line.slice(6);
+        }
+      }
+      
+      const payload = data ? JSON.parse(data) : {};
+      if (eventName === 'token') {
+        onToken(payload.text);
+      } else if (eventName === 'done' || eventName === 'error') {
+        reader.cancel();
+        return payload;
+      }
+    }
+  }
+  
+  return { error: 'Stream ended before the answer was complete' };
+}
+
 // Compress image
 function compressImage(dataUrl, maxWidth = 1024, quality = 0.8) {
   return new Promise((resolve) => {
@@ -469,9 +519,7 @@ function compressImage(dataUrl, maxWidth = 1024, quality = 0.8) {
       canvas.height = height;
       
       ctx.drawImage(img, 0, 0, width, height);
-      const compressedDataUrl = canvas.toDataURL('image/jpeg', quality);
-      const base64Data = compressedDataUrl.split(',')[1];
-      resolve(base64Data);
+      canvas.toBlob(resolve, 'image/jpeg', quality);
     };
     img.src = dataUrl;
   });
@@ -512,7 +560,14 @@ async function checkBackendStatus() {
     if (response.ok) {
       showMessage('✅ Backend connected', 'success');
     } else {
-      showMessage('⚠️ Backend not responding', 'error');
+      // The server answers 503 with its startup state while the model loads
+      const health = await response.json().catch(() => null);
+      if (health && ['starting', 'loading', 'warming'].includes(health.status)) {
+        const progress = health.startup ? ` (${Math.round(health.startup.progress * 100)}%)` : '';
+        showMessage(`⏳ Model ${health.status}${progress}, please wait`, 'info');
+      } else {
+        showMessage('⚠️ Backend not responding', 'error');
+      }
     }
   } catch (error) {
     showMessage('❌ Backend not available. Please start the server.', 'error');
@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+"""
+Length-bucketed, token-budget batches for fine-tuning on ChartQA
+Charts differ a lot in size, so a fixed number of samples per batch is mostly
+padding and its memory depends on whichever chart is largest. Here samples
+pass through a bounded shuffle buffer into buckets of similar sequence length
+and visual-token count, and a bucket becomes a batch when the next sample would
+push it over the token budget (padded tokens, i.e. rows x longest row). Memory
+is bounded by the shuffle buffer and the open buckets, whatever the dataset
+size.
+
+Batches come from preprocessed shards (chartqa_shards.py), whose lengths are
+known before any sample is read, or straight from a streamed split; the
+bucketing itself is in bucketing.py.
+
+A CPU check with a tiny model, bucketed against a fixed batch size (one run
+each, so that each reports its own peak memory):
+
+    python chartqa_loader.py --shards shards/chartqa_train --max-tokens 4096 --steps 20
+    python chartqa_loader.py --shards shards/chartqa_train --batch-size 2 --steps 20
+"""
+
+import argparse
+import random
+import time
+
+from torch.utils.data import IterableDataset, get_worker_info
+
+from bucketing import bucket_batches
+from chartqa_shards import ShardCollator, encode_sample, end_of_turn_ids, image_limits, make_item
+
+
+class ShardBatches(IterableDataset):
+    """Token-budget batches of a ChartQAShards dataset, repeated for epochs passes (forever when None)
+
+    Only the indices of a batch are bucketed; samples are read once their batch
+    is complete. DataLoader workers each take every num_workers-th shard.
+    """
+
+    def __init__(self, shards, max_tokens=4096, max_visual_tokens=None, max_batch_size=None, shuffle_buffer=1024,
+                 bucket_ratio=1.25, seed=0, epochs=None, pad_token_id=None):
+        self.shards = shards
+        self.budget = {"max_tokens": max_tokens, "max_visual_tokens": max_visual_tokens,
+                       "max_batch_size": max_batch_size, "shuffle_buffer": shuffle_buffer, "bucket_ratio": bucket_ratio}
+        self.seed = seed
+        self.epochs = epochs
+        if pad_token_id is None:
+            pad_token_id = shards.processor.tokenizer.pad_token_id
+        self.collate = ShardCollator(pad_token_id)
+
+    def __iter__(self):
+        worker = get_worker_info()
+        numbers = list(range(len(self.shards.manifest["shards"])))
+        if worker is not None:
+            numbers = numbers[worker.id::worker.num_workers]
+        lengths = self.shards.lengths
+        visual_tokens = self.shards.visual_tokens
+        starts = self.shards.starts
+
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            seed = self.seed + epoch * 1000 + (worker.id if worker is not None else 0)
+            # Shard order is shuffled per epoch, samples within reach of the shuffle buffer
+            random.Random(seed).shuffle(numbers)
+            entries = ((index, int(lengths[index]), int(visual_tokens[index]))
+                       for number in numbers for index in range(starts[number], starts[number + 1]))
+            for keys in bucket_batches(entries, seed=seed, **self.budget):
+                yield self.collate([self.shards[index] for index in keys])
+            epoch += 1
+
+
+class StreamingBatches(IterableDataset):
+    """Token-budget batches encoded on the fly from a streamed split, for runs without shards
+
+    Encoded samples wait in the shuffle buffer and buckets, so shuffle_buffer
+    bounds memory here; keep it in the hundreds.
+    """
+
+    def __init__(self, processor, dataset="HuggingFaceM4/ChartQA", split="train", limit=None, max_tokens=4096,
+                 max_visual_tokens=None, max_batch_size=None, shuffle_buffer=256, bucket_ratio=1.25, seed=0,
+                 epochs=None, max_pixels=None):
+        self.processor = processor
+        self.dataset = dataset
+        self.split = split
+        self.limit = limit
+        self.budget = {"max_tokens": max_tokens, "max_visual_tokens": max_visual_tokens,
+                       "max_batch_size": max_batch_size, "shuffle_buffer": shuffle_buffer, "bucket_ratio": bucket_ratio}
+        self.seed = seed
+        self.epochs = epochs
+        self.limits = image_limits(processor.image_processor, max_pixels)
+        self.collate = ShardCollator(processor.tokenizer.pad_token_id)
+
+    def entries(self):
+        from batch_inference import iter_dataset
+
+        end_of_turn = end_of_turn_ids(self.processor)
+        factor = self.limits[0]
+        worker = get_worker_info()
+        for index, image, question, label in iter_dataset(self.dataset, self.split):
+            if self.limit is not None and index >= self.limit:
+                return
+            if worker is not None and index % worker.num_workers != worker.id:
+                continue
+            pixels, input_ids, prompt_length = encode_sample(self.processor, image, question, label, self.limits,
+                                                             end_of_turn)
+            item = make_item(self.processor.image_processor, pixels, input_ids, prompt_length)
+            yield item, len(input_ids), pixels.shape[0] * pixels.shape[1] // factor ** 2
+
+    def __iter__(self):
+        epoch = 0
+        while self.epochs is None or epoch < self.epochs:
+            for items in bucket_batches(self.entries(), seed=self.seed + epoch, **self.budget):
+                yield self.collate(items)
+            epoch += 1
+
+
+def first_item(items):
+    """DataLoader collate_fn for datasets that already yield whole batches (use batch size 1)"""
+    return items[0]
+
+
+def fixed_batches(shards, batch_size, pad_token_id):
+    """Batches of batch_size samples in dataset order, the baseline bucketing is measured against"""
+    collate = ShardCollator(pad_token_id)
+    for start in range(0, len(shards) - batch_size + 1, batch_size):
+        yield collate([shards[index] for index in range(start, start + batch_size)])
+
+
+def train_steps(model, batches, steps, learning_rate=1e-4):
+    """Run steps optimizer steps on a model, returns throughput and padding figures"""
+    import torch
+
+    from evaluate_chartqa import peak_memory_mb
+
+    optimizer = torch.optim.AdamW([parameter for parameter in model.parameters() if parameter.requires_grad],
+                                  lr=learning_rate)
+    model.train()
+    done = tokens = padded = samples = 0
+    started_at = time.monotonic()
+    for batch in batches:
+        if done == steps:
+            break
+        loss = model(**batch).loss
+        loss.backward()
+        optimizer.step()
+        optimizer.zero_grad(set_to_none=True)
+        tokens += int(batch["attention_mask"].sum())
+        padded += batch["attention_mask"].numel()
+        samples += batch["input_ids"].shape[0]
+        done += 1
+    wall_seconds = time.monotonic() - started_at
+    return {
+        "steps": done,
+        "samples": samples,
+        "tokens_per_s": round(tokens / wall_seconds, 1),
+        "samples_per_s": round(samples / wall_seconds, 2),
+        "padding": round(1 - tokens / padded, 3) if padded else None,
+        "peak_memory_mb": round(peak_memory_mb("cpu"), 1),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Train a few steps on token-budget batches and report throughput")
+    parser.add_argument("--shards", required=True, help="Shards written by chartqa_shards.py")
+    parser.add_argument("--model", default="hf-internal-testing/tiny-random-Qwen2VLForConditionalGeneration",
+                        help="Qwen2-VL model to train (a tiny random one runs on CPU)")
+    parser.add_argument("--max-tokens", type=int, default=4096, help="Padded tokens per batch")
+    parser.add_argument("--max-visual-tokens", type=int, help="Image tokens per batch")
+    parser.add_argument("--shuffle-buffer", type=int, default=1024)
+    parser.add_argument("--steps", type=int, default=20)
+    parser.add_argument("--batch-size", type=int, help="Fixed batches of this many samples instead, for comparison")
+    args = parser.parse_args()
+
+    import json
+
+    import torch
+    from transformers import AutoProcessor, Qwen2VLForConditionalGeneration
+
+    from chartqa_shards import ChartQAShards
+
+    processor = AutoProcessor.from_pretrained(args.model)
+    shards = ChartQAShards(args.shards, processor)
+    pad_token_id = processor.tokenizer.pad_token_id
+
+    torch.manual_seed(0)
+    model = Qwen2VLForConditionalGeneration.from_pretrained(args.model, torch_dtype=torch.float32)
+
+    if args.batch_size:
+        batches = fixed_batches(shards, args.batch_size, pad_token_id)
+    else:
+        batches = iter(ShardBatches(shards, args.max_tokens, args.max_visual_tokens,
+                                    shuffle_buffer=args.shuffle_buffer, pad_token_id=pad_token_id))
+    result = train_steps(model, batches, args.steps)
+    result["batching"] = f"{args.batch_size} samples" if args.batch_size else f"{args.max_tokens} tokens"
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,362 @@
+#!/usr/bin/env python3
+"""
+Preprocessed, memory-mapped ChartQA shards for training and evaluation
+Streams a ChartQA split once and writes it as columnar shards of NumPy arrays:
+the chart resized to the size the Qwen2-VL processor would feed the model
+(uint8 pixels), the chat-template token ids with the image placeholders
+expanded, and where the answer starts (the label span). Readers memory-map
+the arrays and touch only the samples they index, so the dataset size costs
+disk, not RAM, and a re-run with the same options skips all preprocessing.
+
+    python chartqa_shards.py --split train --output-dir shards/chartqa_train --limit 8000
+    python chartqa_shards.py --split test --output-dir shards/chartqa_test
+
+Layout of an output directory:
+
+    config.json            what was asked for; a re-run with other options refuses
+    shard-00000/           one directory per --shard-size samples, renamed into place when complete
+        pixels.npy         uint8, every image's H*W*3 pixels back to back
+        pixel_offsets.npy  int64, start of each image in pixels.npy (samples + 1)
+        image_shapes.npy   int32, (H, W, 3) per sample
+        input_ids.npy      int32, every sample's prompt + answer token ids back to back
+        token_offsets.npy  int64, start of each sample in input_ids.npy (samples + 1)
+        prompt_lengths.npy int32, tokens before the answer; labels mask them out
+        records.jsonl      dataset index, question and label per sample
+    manifest.json          written last: shard names and sample counts
+"""
+
+import argparse
+import bisect
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+
+FORMAT_VERSION = 1
+IGNORE_INDEX = -100  # label value the loss skips
+
+
+def shard_name(number):
+    return f"shard-{number:05d}"
+
+
+def image_limits(image_processor, max_pixels=None):
+    """(factor, min_pixels, max_pixels) the processor resizes images with"""
+    size = getattr(image_processor, "size", None) or {}
+    min_pixels = getattr(image_processor, "min_pixels", None) or size.get("shortest_edge")
+    max_pixels = max_pixels or getattr(image_processor, "max_pixels", None) or size.get("longest_edge")
+    return image_processor.patch_size * image_processor.merge_size, min_pixels, max_pixels
+
+
+def resize_chart(image, factor, min_pixels, max_pixels):
+    """The chart as uint8 RGB at the size Qwen2-VL uses; the processor leaves such images as they are"""
+    from PIL import Image
+    from transformers.models.qwen2_vl.image_processing_qwen2_vl import smart_resize
+
+    image = image.convert("RGB")
+    height, width = smart_resize(image.height, image.width, factor=factor, min_pixels=min_pixels, max_pixels=max_pixels)
+    if (width, height) != image.size:
+        image = image.resize((width, height), Image.BICUBIC)
+    return np.asarray(image, dtype=np.uint8)
+
+
+def encode_sample(processor, image, question, label, limits, end_of_turn):
+    """(uint8 pixels, prompt + answer token ids, prompt length) of one ChartQA sample
+
+    The tokens are the conversation convert_to_conversation describes, rendered
+    with the chat template: the prompt up to the assistant turn, then the answer
+    closing that turn.
+    """
+    from SFT_Qwen2_load_inference import build_prompt
+
+    pixels = resize_chart(image, *limits)
+    prompt = build_prompt(processor, question)
+    prompt_ids = processor(images=[pixels], text=[prompt], add_special_tokens=False)["input_ids"][0]
+    answer = label[0] if isinstance(label, list) else label
+    answer_ids = processor.tokenizer(str(answer), add_special_tokens=False)["input_ids"] + end_of_turn
+    return pixels, list(prompt_ids) + answer_ids, len(prompt_ids)
+
+
+def end_of_turn_ids(processor):
+    """Token ids that close an assistant turn in the chat template"""
+    return processor.tokenizer("<|im_end|>\n", add_special_tokens=False)["input_ids"]
+
+
+class ShardWriter:
+    """Collects up to one shard of samples in memory, then writes it in one go"""
+
+    def __init__(self, path):
+        self.path = path
+        self.pixels = []
+        self.input_ids = []
+        self.prompt_lengths = []
+        self.records = []
+
+    def __len__(self):
+        return len(self.records)
+
+    def add(self, pixels, input_ids, prompt_length, record):
+        self.pixels.append(pixels)
+        self.input_ids.append(np.asarray(input_ids, dtype=np.int32))
+        self.prompt_lengths.append(prompt_length)
+        self.records.append(record)
+
+    def close(self):
+        """Write the shard to a temporary directory and rename it into place"""
+        tmp = self.path + ".tmp"
+        shutil.rmtree(tmp, ignore_errors=True)
+        os.makedirs(tmp)
+        np.save(os.path.join(tmp, "pixels.npy"), np.concatenate([pixels.reshape(-1) for pixels in self.pixels]))
+        np.save(os.path.join(tmp, "pixel_offsets.npy"), np.cumsum([0] + [pixels.size for pixels in self.pixels]))
+        np.save(os.path.join(tmp, "image_shapes.npy"), np.array([pixels.shape for pixels in self.pixels], dtype=np.int32))
+        np.save(os.path.join(tmp, "input_ids.npy"), np.concatenate(self.input_ids))
+        np.save(os.path.join(tmp, "token_offsets.npy"), np.cumsum([0] + [len(ids) for ids in self.input_ids]))
+        np.save(os.path.join(tmp, "prompt_lengths.npy"), np.array(self.prompt_lengths, dtype=np.int32))
+        with open(os.path.join(tmp, "records.jsonl"), "w", encoding="utf-8") as f:
+            for record in self.records:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+        os.replace(tmp, self.path)
+
+
+def write_shards(output_dir, dataset="HuggingFaceM4/ChartQA", split="train", limit=None, shard_size=256,
+                 max_pixels=None, model_id=None, processor=None):
+    """Preprocess a ChartQA split into output_dir, resuming after the last complete shard
+
+    Returns the manifest. When output_dir already holds a complete manifest for
+    the same options, nothing is read or processed.
+    """
+    from batch_inference import iter_dataset
+    from SFT_Qwen2_load_inference import model_id as base_model_id
+
+    model_id = model_id or base_model_id
+    config = {"format": FORMAT_VERSION, "dataset": dataset, "split": split, "limit": limit,
+              "shard_size": shard_size, "max_pixels": max_pixels, "model_id": model_id}
+    manifest_path = os.path.join(output_dir, "manifest.json")
+    config_path = os.path.join(output_dir, "config.json")
+
+    os.makedirs(output_dir, exist_ok=True)
+    if os.path.exists(config_path):
+        with open(config_path) as f:
+            existing = json.load(f)
+        if existing != config:
+            raise SystemExit(f"{output_dir} holds shards written with {existing}; use another --output-dir")
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as f:
+                return json.load(f)
+    else:
+        with open(config_path, "w") as f:
+            json.dump(config, f, indent=2, sort_keys=True)
+
+    # Complete shards are kept; streaming resumes after them
+    shards = []
+    while os.path.isdir(os.path.join(output_dir, shard_name(len(shards)))):
+        with open(os.path.join(output_dir, shard_name(len(shards)), "records.jsonl"), encoding="utf-8") as f:
+            shards.append({"name": shard_name(len(shards)), "samples": sum(1 for _ in f)})
+    done = sum(shard["samples"] for shard in shards)
+    if done:
+        print(f"Resuming after {done} samples in {len(shards)} complete shards")
+
+    if processor is None:
+        from transformers import AutoProcessor
+
+        processor = AutoProcessor.from_pretrained(model_id, trust_remote_code=True)
+    limits = image_limits(processor.image_processor, max_pixels)
+    end_of_turn = end_of_turn_ids(processor)
+
+    writer = ShardWriter(os.path.join(output_dir, shard_name(len(shards))))
+    resumed, started_at = done, time.monotonic()
+    for index, image, question, label in iter_dataset(dataset, split, start=done):
+        if limit is not None and index >= limit:
+            break
+        pixels, input_ids, prompt_length = encode_sample(processor, image, question, label, limits, end_of_turn)
+        writer.add(pixels, input_ids, prompt_length, {"index": index, "question": question, "label": label})
+
+        if len(writer) == shard_size:
+            writer.close()
+            shards.append({"name": shard_name(len(shards)), "samples": len(writer)})
+            writer = ShardWriter(os.path.join(output_dir, shard_name(len(shards))))
+            done += shard_size
+            print(f"{done} samples preprocessed ({(done - resumed) / (time.monotonic() - started_at):.1f}/s)", flush=True)
+    if len(writer):
+        writer.close()
+        shards.append({"name": shard_name(len(shards)), "samples": len(writer)})
+
+    manifest = dict(config, shards=shards, samples=sum(shard["samples"] for shard in shards))
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(manifest_path + ".tmp", manifest_path)
+    return manifest
+
+
+class ChartQAShards:
+    """Random access to preprocessed shards, reading only the samples asked for
+
+    Items are dicts of tensors ready for a Qwen2-VL forward pass: input_ids,
+    labels (IGNORE_INDEX over the prompt), pixel_values and image_grid_thw.
+    Shards are memory-mapped on first use in each process, so the dataset can be
+    handed to DataLoader workers.
+    """
+
+    def __init__(self, path, processor=None):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.processor = processor
+        self.starts = np.cumsum([0] + [shard["samples"] for shard in self.manifest["shards"]]).tolist()
+        self._shards = {}
+        self._lengths = None
+
+    def __len__(self):
+        return self.starts[-1]
+
+    def __getstate__(self):
+        # Memory maps are reopened in the receiving process instead of being copied
+        state = dict(self.__dict__)
+        state["_shards"] = {}
+        return state
+
+    @property
+    def image_processor(self):
+        if self.processor is None:
+            from transformers import AutoProcessor
+
+            self.processor = AutoProcessor.from_pretrained(self.manifest["model_id"], trust_remote_code=True)
+        return self.processor.image_processor
+
+    def _shard(self, number):
+        shard = self._shards.get(number)
+        if shard is None:
+            directory = os.path.join(self.path, self.manifest["shards"][number]["name"])
+            shard = {name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r")
+                     for name in ("pixels", "pixel_offsets", "image_shapes", "input_ids",
+                                  "token_offsets", "prompt_lengths")}
+            with open(os.path.join(directory, "records.jsonl"), encoding="utf-8") as f:
+                shard["records"] = [json.loads(line) for line in f]
+            self._shards[number] = shard
+        return shard
+
+    def _locate(self, index):
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        number = bisect.bisect_right(self.starts, index) - 1
+        return self._shard(number), index - self.starts[number]
+
+    @property
+    def lengths(self):
+        """Token count of every sample (prompt + answer), without reading any tokens"""
+        if self._lengths is None:
+            self._lengths = np.concatenate([np.diff(self._shard(number)["token_offsets"])
+                                            for number in range(len(self.manifest["shards"]))])
+        return self._lengths
+
+    def record(self, index):
+        """Dataset index, question and label of a sample"""
+        shard, row = self._locate(index)
+        return shard["records"][row]
+
+    def image(self, index):
+        """The resized chart as an (H, W, 3) uint8 array"""
+        shard, row = self._locate(index)
+        start, end = shard["pixel_offsets"][row], shard["pixel_offsets"][row + 1]
+        return np.asarray(shard["pixels"][start:end]).reshape(tuple(shard["image_shapes"][row]))
+
+    def tokens(self, index):
+        """(token ids, prompt length) of a sample"""
+        shard, row = self._locate(index)
+        start, end = shard["token_offsets"][row], shard["token_offsets"][row + 1]
+        return np.asarray(shard["input_ids"][start:end], dtype=np.int64), int(shard["prompt_lengths"][row])
+
+    def __getitem__(self, index):
+        return self._item(index, answer=True)
+
+    def prompt(self, index):
+        """A sample without its answer and labels, for generation"""
+        return self._item(index, answer=False)
+
+    def _item(self, index, answer):
+        input_ids, prompt_length = self.tokens(index)
+        return make_item(self.image_processor, self.image(index), input_ids, prompt_length, answer)
+
+    @property
+    def visual_tokens(self):
+        """Image tokens of every sample, from the stored image sizes"""
+        factor = self.image_processor.patch_size * self.image_processor.merge_size
+        return np.concatenate([np.prod(self._shard(number)["image_shapes"][:, :2], axis=1) // factor ** 2
+                               for number in range(len(self.manifest["shards"]))])
+
+
+def make_item(image_processor, pixels, input_ids, prompt_length, answer=True):
+    """Model inputs of one encoded sample; labels cover the answer only"""
+    import torch
+
+    image = image_processor(images=[pixels], return_tensors="pt")
+    input_ids = torch.as_tensor(input_ids if answer else input_ids[:prompt_length], dtype=torch.long)
+    item = {
+        "input_ids": input_ids,
+        "pixel_values": image["pixel_values"],
+        "image_grid_thw": image["image_grid_thw"],
+    }
+    if answer:
+        item["labels"] = input_ids.clone()
+        item["labels"][:prompt_length] = IGNORE_INDEX
+    return item
+
+
+class ShardCollator:
+    """Pads items of ChartQAShards into one batch
+
+    Right padding for training; left padding (padding_side="left") for
+    generation, so every row ends at the generation prompt.
+    """
+
+    def __init__(self, pad_token_id, padding_side="right"):
+        self.pad_token_id = pad_token_id
+        self.padding_side = padding_side
+
+    def __call__(self, items):
+        import torch
+        from transformers import BatchFeature
+
+        length = max(len(item["input_ids"]) for item in items)
+        input_ids = torch.full((len(items), length), self.pad_token_id, dtype=torch.long)
+        attention_mask = torch.zeros((len(items), length), dtype=torch.long)
+        labels = torch.full((len(items), length), IGNORE_INDEX, dtype=torch.long)
+        for row, item in enumerate(items):
+            size = len(item["input_ids"])
+            span = slice(length - size, length) if self.padding_side == "left" else slice(0, size)
+            input_ids[row, span] = item["input_ids"]
+            attention_mask[row, span] = 1
+            if "labels" in item:
+                labels[row, span] = item["labels"]
+
+        batch = {
+            "input_ids": input_ids,
+            "attention_mask": attention_mask,
+            "pixel_values": torch.cat([item["pixel_values"] for item in items]),
+            "image_grid_thw": torch.cat([item["image_grid_thw"] for item in items]),
+        }
+        if all("labels" in item for item in items):
+            batch["labels"] = labels
+        return BatchFeature(batch)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Preprocess ChartQA into memory-mapped shards")
+    parser.add_argument("--output-dir", required=True, help="Directory for the shards")
+    parser.add_argument("--dataset", default="HuggingFaceM4/ChartQA")
+    parser.add_argument("--split", default="train")
+    parser.add_argument("--limit", type=int, help="Only preprocess the first N samples of the split")
+    parser.add_argument("--shard-size", type=int, default=256, help="Samples per shard (bounds memory while writing)")
+    parser.add_argument("--max-pixels", type=int, help="Downscale charts above this many pixels (processor default otherwise)")
+    parser.add_argument("--model-id", help="Processor whose chat template and image size are used (the base model)")
+    args = parser.parse_args()
+
+    manifest = write_shards(args.output_dir, args.dataset, args.split, args.limit, args.shard_size,
+                            args.max_pixels, args.model_id)
+    print(f"{manifest['samples']} samples in {len(manifest['shards'])} shards under {args.output_dir}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+#!/usr/bin/env python3
+"""
+ChartQA evaluation for the fine-tuned Qwen2-VL adapters
+Runs the merged model over a ChartQA split with batched generation and reports
+relaxed accuracy (5% numeric tolerance, exact match otherwise) next to
+throughput, latency percentiles and peak memory.
+
+Work can be split across processes with --num-shards/--shard-index; --merge then
+combines the shard files into one deterministic result:
+
+    python evaluate_chartqa.py --lora lora_model_8k --num-shards 2 --shard-index 0 --output-dir eval_8k &
+    python evaluate_chartqa.py --lora lora_model_8k --num-shards 2 --shard-index 1 --output-dir eval_8k &
+    wait; python evaluate_chartqa.py --merge --output-dir eval_8k
+
+--shards reads the split from a directory written by chartqa_shards.py instead
+of streaming and preprocessing it again.
+"""
+
+import argparse
+import glob
+import itertools
+import json
+import math
+import os
+import resource
+import time
+from functools import partial
+
+RELAXED_TOLERANCE = 0.05
+
+
+def to_float(text):
+    """Parse a numeric answer ("1,234", "12.5%"), or None when it is not a number"""
+    text = text.strip().replace(",", "").rstrip(".")
+    try:
+        if text.endswith("%"):
+            return float(text[:-1]) / 100.0
+        return float(text)
+    except ValueError:
+        return None
+
+
+def relaxed_correct(prediction, target, tolerance=RELAXED_TOLERANCE):
+    """ChartQA relaxed accuracy: numbers within tolerance of the target, else case-insensitive exact match"""
+    prediction_float = to_float(prediction)
+    target_float = to_float(target)
+    if prediction_float is not None and target_float:
+        return abs(prediction_float - target_float) / abs(target_float) <= tolerance
+    return prediction.strip().lower() == target.strip().lower()
+
+
+def score(prediction, labels):
+    """A prediction is correct if it matches any of the reference labels"""
+    if isinstance(labels, str):
+        labels = [labels]
+    return any(relaxed_correct(prediction, str(label)) for label in labels)
+
+
+def percentile(values, q):
+    """Nearest-rank percentile of a list of numbers"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = min(len(ordered), max(1, math.ceil(q / 100.0 * len(ordered)))) - 1
+    return ordered[rank]
+
+
+def peak_memory_mb(device):
+    """Peak accelerator memory on CUDA, peak resident set size otherwise"""
+    import torch
+
+    if device == "cuda":
+        return torch.cuda.max_memory_allocated() / 1024 / 1024
+    # ru_maxrss is KB on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return (peak if os.uname().sysname == "Darwin" else peak * 1024) / 1024 / 1024
+
+
+def summarize(records, wall_seconds):
+    """Accuracy and latency figures for a list of scored records"""
+    latencies = [record["latency_ms"] for record in records]
+    correct = sum(record["correct"] for record in records)
+    return {
+        "samples": len(records),
+        "correct": correct,
+        "relaxed_accuracy": round(correct / len(records), 4) if records else None,
+        "throughput_samples_per_s": round(len(records) / wall_seconds, 3) if wall_seconds else None,
+        "latency_ms": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+        },
+    }
+
+
+def shard_path(output_dir, shard_index, num_shards, suffix):
+    return os.path.join(output_dir, f"shard-{shard_index:03d}-of-{num_shards:03d}.{suffix}")
+
+
+def evaluate_shard(args):
+    """Answer and score every num_shards-th sample starting at shard_index"""
+    from batch_inference import iter_dataset, prefetch_batches
+    from SFT_Qwen2_load_inference import load_model, load_draft_model, generate_answers, speculative_generate_answers
+
+    model, processor, device = load_model(lora_path=args.lora, model_path=args.model_path)
+    if args.decoding == "greedy":
+        generate_kwargs = {"do_sample": False}
+    else:
+        generate_kwargs = {"do_sample": True, "temperature": args.temperature, "min_p": args.min_p}
+
+    # Speculative decoding: drafts from the prompt text or a small draft model, verified by the model
+    speculative = {}
+    if args.prompt_lookup or args.draft_model:
+        draft_model = load_draft_model(args.draft_model, device) if args.draft_model else None
+        generate = partial(speculative_generate_answers, prompt_lookup_tokens=args.prompt_lookup,
+                           draft_model=draft_model, stats=speculative)
+    else:
+        generate = generate_answers
+
+    # Preprocessed shards skip image decoding, resizing and tokenization; their
+    # samples carry the shard position where the streamed ones carry the image
+    prepare = None
+    if args.shards:
+        from chartqa_shards import ChartQAShards, ShardCollator
+
+        shards = ChartQAShards(args.shards, processor)
+        collate = ShardCollator(processor.tokenizer.pad_token_id, padding_side="left")
+        samples = ((record["index"], position, record["question"], record["label"])
+                   for position, record in enumerate(map(shards.record, range(len(shards)))))
+        prepare = lambda batch: collate([shards.prompt(position) for _, position, _, _ in batch])
+        samples = (sample for sample in samples if sample[0] % args.num_shards == args.shard_index)
+    else:
+        # Samples of other shards are skipped before their image is decoded
+        samples = iter_dataset(args.dataset, args.split, num_shards=args.num_shards, shard_index=args.shard_index)
+
+    # Round-robin sharding keeps shards balanced and the merge order well defined
+    if args.limit is not None:
+        samples = itertools.takewhile(lambda sample: sample[0] < args.limit, samples)
+
+    records = []
+    started_at = time.monotonic()
+    for batch, inputs in prefetch_batches(samples, processor, args.batch_size, args.prefetch, prepare):
+        batch_started_at = time.monotonic()
+        # Rows stop once their short answer is complete, unless --full-answers
+        questions = None if args.full_answers else [question for _, _, question, _ in batch]
+        answers = generate(model, processor, inputs, device, args.max_new_tokens, questions=questions, **generate_kwargs)
+        # Every sample of a batch waits for the whole batch
+        latency_ms = round((time.monotonic() - batch_started_at) * 1000, 1)
+        for (index, _, question, labels), answer in zip(batch, answers):
+            records.append({
+                "index": index,
+                "question": question,
+                "labels": labels,
+                "answer": answer,
+                "correct": score(answer, labels),
+                "latency_ms": latency_ms,
+            })
+        print(f"shard {args.shard_index}: {len(records)} evaluated, "
+              f"accuracy {sum(r['correct'] for r in records) / len(records):.3f}", flush=True)
+    wall_seconds = time.monotonic() - started_at
+
+    summary = summarize(records, wall_seconds)
+    summary.update({
+        "shard_index": args.shard_index,
+        "num_shards": args.num_shards,
+        "wall_seconds": round(wall_seconds, 2),
+        "peak_memory_mb": round(peak_memory_mb(device), 1),
+        "device": device,
+        "speculative": speculative or None,
+        "config": {
+            "lora": None if args.model_path else args.lora,
+            "model_path": args.model_path,
+            "split": args.split,
+            "shards": args.shards,
+            "batch_size": args.batch_size,
+            "max_new_tokens": args.max_new_tokens,
+            "decoding": args.decoding,
+            "answer_stopping": not args.full_answers,
+            "prompt_lookup": args.prompt_lookup,
+            "draft_model": args.draft_model,
+            **({k: v for k, v in generate_kwargs.items() if k != "do_sample"}),
+        },
+    })
+
+    os.makedirs(args.output_dir, exist_ok=True)
+    with open(shard_path(args.output_dir, args.shard_index, args.num_shards, "jsonl"), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+    with open(shard_path(args.output_dir, args.shard_index, args.num_shards, "json"), "w") as f:
+        json.dump(summary, f, indent=2, sort_keys=True)
+    return summary
+
+
+def merge_shards(output_dir):
+    """Combine all shard files of output_dir into predictions.jsonl and summary.json"""
+    summaries = []
+    for path in sorted(glob.glob(os.path.join(output_dir, "shard-*-of-*.json"))):
+        with open(path) as f:
+            summaries.append(json.load(f))
+    if not summaries:
+        raise SystemExit(f"No shard results in {output_dir}")
+
+    num_shards = summaries[0]["num_shards"]
+    found = sorted(summary["shard_index"] for summary in summaries)
+    if found != list(range(num_shards)):
+        raise SystemExit(f"Expected shards 0..{num_shards - 1}, found {found}")
+
+    records = []
+    for summary in summaries:
+        with open(shard_path(output_dir, summary["shard_index"], num_shards, "jsonl"), encoding="utf-8") as f:
+            records.extend(json.loads(line) for line in f)
+    # Sample order, not shard completion order, decides the merged layout
+    records.sort(key=lambda record: record["index"])
+
+    # Shards run concurrently, so the slowest one bounds the combined wall time
+    wall_seconds = max(summary["wall_seconds"] for summary in summaries)
+    merged = summarize(records, wall_seconds)
+    speculative = [summary["speculative"] for summary in summaries if summary.get("speculative")]
+    if speculative:
+        tokens = sum(stats["tokens"] for stats in speculative)
+        forwards = sum(stats["forwards"] for stats in speculative)
+        merged["speculative"] = {"tokens": tokens, "forwards": forwards,
+                                 "tokens_per_forward": round(tokens / forwards, 3) if forwards else None}
+    merged.update({
+        "num_shards": num_shards,
+        "wall_seconds": wall_seconds,
+        "peak_memory_mb": max(summary["peak_memory_mb"] for summary in summaries),
+        "config": summaries[0]["config"],
+        "shards": [
+            {key: summary[key] for key in ("shard_index", "samples", "relaxed_accuracy",
+                                           "throughput_samples_per_s", "wall_seconds", "peak_memory_mb")}
+            for summary in summaries
+        ],
+    })
+
+    with open(os.path.join(output_dir, "predictions.jsonl"), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False, sort_keys=True) + "\n")
+    with open(os.path.join(output_dir, "summary.json"), "w") as f:
+        json.dump(merged, f, indent=2, sort_keys=True)
+    return merged
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Evaluate the fine-tuned model on ChartQA")
+    parser.add_argument("--output-dir", required=True, help="Directory for shard and merged results")
+    parser.add_argument("--merge", action="store_true", help="Merge the shard results of --output-dir and exit")
+    parser.add_argument("--lora", default="lora_model_8k", help="LoRA adapter merged into the base model")
+    parser.add_argument("--model-path", help="Baked model directory (skips the LoRA merge)")
+    parser.add_argument("--dataset", default="HuggingFaceM4/ChartQA")
+    parser.add_argument("--split", default="test")
+    parser.add_argument("--shards", help="Read the split from shards written by chartqa_shards.py instead of --dataset")
+    parser.add_argument("--limit", type=int, help="Only evaluate the first N samples of the split")
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--prefetch", type=int, default=4, help="Preprocessed batches buffered ahead of the model")
+    parser.add_argument("--max-new-tokens", type=int, default=64)
+    parser.add_argument("--decoding", choices=["greedy", "sample"], default="greedy")
+    parser.add_argument("--temperature", type=float, default=1.5, help="Sampling temperature (--decoding sample)")
+    parser.add_argument("--min-p", type=float, default=0.1, help="Sampling min_p (--decoding sample)")
+    parser.add_argument("--full-answers", action="store_true",
+                        help="Decode up to --max-new-tokens instead of stopping at a complete short answer")
+    parser.add_argument("--prompt-lookup", type=int,
+                        help="Speculative decoding with this many tokens drafted from the prompt text")
+    parser.add_argument("--draft-model", help="Speculative decoding with this small draft model (shares the tokenizer)")
+    parser.add_argument("--num-shards", type=int, default=1)
+    parser.add_argument("--shard-index", type=int, default=0)
+    args = parser.parse_args()
+
+    if args.merge:
+        summary = merge_shards(args.output_dir)
+    else:
+        if not 0 <= args.shard_index < args.num_shards:
+            parser.error("--shard-index must be in [0, --num-shards)")
+        summary = evaluate_shard(args)
+        if args.num_shards == 1:
+            summary = merge_shards(args.output_dir)
+
+    print(json.dumps({key: value for key, value in summary.items() if key != "shards"}, indent=2, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The offline scripts live at the repository root and the backend modules in
+# chart_qa_extension/backend; neither is an installed package
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path[:0] = [ROOT, os.path.join(ROOT, "chart_qa_extension", "backend")]
@@ -0,0 +1,79 @@
+from types import SimpleNamespace
+
+import pytest
+
+from admission import AdmissionController, MemoryCostModel
+
+
+def qwen2_vl_config():
+    text = SimpleNamespace(num_attention_heads=12, num_key_value_heads=2, hidden_size=1536,
+                           num_hidden_layers=28, intermediate_size=8960, vocab_size=151936)
+    vision = SimpleNamespace(embed_dim=1280, num_heads=16, mlp_ratio=4)
+    return SimpleNamespace(vision_config=vision, **vars(text))
+
+
+@pytest.fixture
+def cost_model():
+    return MemoryCostModel(qwen2_vl_config(), prefix_tokens=64)
+
+
+def image_cost(cost_model, visual_tokens, rows=1, text_tokens=20, max_new_tokens=32):
+    return cost_model.batch_bytes([(text_tokens + visual_tokens, max_new_tokens)] * rows, visual_tokens)
+
+
+def test_cost_grows_with_visual_tokens_and_rows(cost_model):
+    assert cost_model.batch_bytes([]) == 0
+    assert image_cost(cost_model, 512) < image_cost(cost_model, 1024)
+    assert image_cost(cost_model, 512) < image_cost(cost_model, 512, rows=2)
+
+
+@pytest.mark.parametrize("visual_tokens", [1, 300, 1000, 4096])
+@pytest.mark.parametrize("rows", [1, 3])
+def test_largest_image_is_the_last_size_that_fits(cost_model, visual_tokens, rows):
+    budget = image_cost(cost_model, visual_tokens, rows)
+    largest = cost_model.largest_image(budget, rows, 20, 32)
+    assert largest == visual_tokens
+    assert image_cost(cost_model, largest, rows) <= budget < image_cost(cost_model, largest + 1, rows)
+
+
+def test_largest_image_with_a_limit(cost_model):
+    budget = image_cost(cost_model, 1000)
+    # A limit that fits is returned as is, otherwise the search stays below it
+    assert cost_model.largest_image(budget, 1, 20, 32, limit=600) == 600
+    assert cost_model.largest_image(budget, 1, 20, 32, limit=5000) == 1000
+    assert cost_model.largest_image(budget - 1, 1, 20, 32, limit=5000) == 999
+
+
+def test_largest_image_is_zero_when_the_text_alone_does_not_fit(cost_model):
+    assert cost_model.largest_image(image_cost(cost_model, 0) - 1, 1, 20, 32) == 0
+    assert cost_model.largest_image(0, 1, 20, 32, limit=1000) == 0
+
+
+def test_vision_width_names_of_qwen2_5_vl():
+    config = qwen2_vl_config()
+    config.vision_config = SimpleNamespace(hidden_size=1280, intermediate_size=5120, num_heads=16)
+    assert MemoryCostModel(config).vision_bytes_per_patch == MemoryCostModel(qwen2_vl_config()).vision_bytes_per_patch
+
+
+def total_cost(items):
+    return sum(item['cost'] for item in items)
+
+
+def test_fits_compares_against_the_budget_only():
+    controller = AdmissionController(10, total_cost)
+    with controller.running([{'cost': 8}]):
+        # The running batch does not shrink the room of the next one
+        assert controller.in_use == 8
+        assert controller.fits([{'cost': 6}, {'cost': 4}])
+        assert not controller.fits([{'cost': 6}, {'cost': 5}])
+    assert controller.in_use == 0
+    assert controller.peak == 8
+
+
+def test_over_budget_batch_still_runs_and_is_counted():
+    controller = AdmissionController(10, total_cost)
+    with controller.running([{'cost': 15}]) as cost:
+        assert cost == 15
+    stats = controller.stats()
+    assert stats['batches_over_budget'] == 1
+    assert stats['in_use_mb'] == 0
@@ -0,0 +1,61 @@
+import pytest
+
+from answer_control import BUDGETS, AnswerControl, complete_answer, question_type
+
+
+@pytest.mark.parametrize("question, kind", [
+    ("Is the value of Japan above 50?", "yes_no"),
+    ("Does the red line ever drop below zero?", "yes_no"),
+    ("How many bars are above 20?", "number"),
+    ("What is the difference between the highest and lowest value?", "number"),
+    ("What percentage of people chose tea?", "number"),
+    ("Which country has the largest share?", "label"),
+    ("What year had the most sales?", "label"),
+    ("Describe the trend of the blue line.", "open"),
+])
+def test_question_type(question, kind):
+    assert question_type(question) == kind
+
+
+def test_budgets_follow_the_question_type_and_cap():
+    assert AnswerControl("Is it rising?", 64).max_new_tokens == BUDGETS["yes_no"]
+    assert AnswerControl("How many bars are there?", 64).max_new_tokens == BUDGETS["number"]
+    assert AnswerControl("How many bars are there?", 8).max_new_tokens == 8
+    assert AnswerControl("Describe the chart.", 64).max_new_tokens == 64
+
+
+@pytest.mark.parametrize("question, text, answer", [
+    ("Is the first bar taller?", "Yes, because it reaches 80 while the second stops at 60.", "Yes"),
+    ("Is the first bar taller?", "no. The second one is taller", "no"),
+    ("How many bars are there?", "7. There are seven bars in the chart.", "7"),
+    ("Which country has the largest share?", "Japan\nJapan has the largest share at 40%.", "Japan"),
+    ("Which country has the largest share?", "  United States  \nIt leads", "United States"),
+])
+def test_trailing_explanation_is_truncated(question, text, answer):
+    control = AnswerControl(question, 64)
+    assert control.is_complete(text)
+    assert control.finalize(text) == answer
+
+
+@pytest.mark.parametrize("text, answer", [
+    ("45%. Almost half of the respondents", "45%"),
+    ("12.5 %\nThe rest", "12.5 %"),
+    ("$1,200.50, which is the highest", "$1,200.50"),
+    ("-3.75; a decline", "-3.75"),
+    ("12 million\nThe bar for 2019", "12 million"),
+])
+def test_numbers_keep_their_units(text, answer):
+    assert AnswerControl("What is the value in 2019?", 64).finalize(text) == answer
+
+
+@pytest.mark.parametrize("partial", ["12", "12.", "12.5", "45", "12 ", "12 mil", "Yes"])
+def test_an_unfinished_number_is_not_complete(partial):
+    # Generation must go on until a decimal, percent sign or unit can no longer follow
+    assert complete_answer(partial, "number") is None
+
+
+def test_open_questions_are_never_cut():
+    text = "The sales rise steadily.\nThen they fall in 2020.\n"
+    control = AnswerControl("Describe the trend.", 64)
+    assert not control.is_complete(text)
+    assert control.finalize(text) == text.strip()
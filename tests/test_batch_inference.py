@@ -0,0 +1,82 @@
+import json
+import os
+import signal
+import subprocess
+import sys
+import textwrap
+
+import pytest
+
+from batch_inference import JsonlWriter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Writes answers one batch at a time and is killed before the writer is closed
+KILLED_RUN = textwrap.dedent("""
+    import os, signal, sys
+    sys.path.insert(0, {root!r})
+    from batch_inference import open_writer
+
+    writer = open_writer({output!r}, rows_per_file=4)
+    start = writer.completed
+    for index in range(start, {total}):
+        writer.write([{{"id": index, "question": "q", "answer": str(index), "label": None}}])
+        if index == {kill_at}:
+            os.kill(os.getpid(), signal.SIGKILL)
+    writer.close()
+""")
+
+
+def run_until_killed(output, total, kill_at):
+    script = KILLED_RUN.format(root=ROOT, output=output, total=total, kill_at=kill_at)
+    result = subprocess.run([sys.executable, "-c", script])
+    assert result.returncode == -signal.SIGKILL
+
+
+def read_ids(output):
+    if output.endswith(".jsonl"):
+        with open(output, encoding="utf-8") as f:
+            return [json.loads(line)["id"] for line in f]
+    import pyarrow.parquet as pq
+
+    return pq.read_table(output).column("id").to_pylist()
+
+
+def resume(output, total):
+    from batch_inference import open_writer
+
+    writer = open_writer(output, rows_per_file=4)
+    completed = writer.completed
+    for index in range(completed, total):
+        writer.write([{"id": index, "question": "q", "answer": str(index), "label": None}])
+    writer.close()
+    return completed
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="needs SIGKILL")
+def test_parquet_resume_after_kill(tmp_path):
+    pytest.importorskip("pyarrow")
+    output = str(tmp_path / "answers.parquet")
+    run_until_killed(output, total=20, kill_at=9)
+
+    # Answers 0-7 were flushed in two parts; 8 and 9 were still buffered
+    assert resume(output, total=20) == 8
+    assert read_ids(output) == list(range(20))
+
+
+@pytest.mark.skipif(not hasattr(signal, "SIGKILL"), reason="needs SIGKILL")
+def test_jsonl_resume_after_kill(tmp_path):
+    output = str(tmp_path / "answers.jsonl")
+    run_until_killed(output, total=20, kill_at=9)
+
+    assert resume(output, total=20) == 10
+    assert read_ids(output) == list(range(20))
+
+
+def test_jsonl_drops_a_partial_last_line(tmp_path):
+    output = tmp_path / "answers.jsonl"
+    output.write_text('{"id": 0}\n{"id": 1}\n{"id": 2', encoding="utf-8")
+    writer = JsonlWriter(str(output))
+    writer.close()
+    assert writer.completed == 2
+    assert output.read_text(encoding="utf-8") == '{"id": 0}\n{"id": 1}\n'
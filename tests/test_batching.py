@@ -0,0 +1,126 @@
+import threading
+import time
+from functools import partial
+
+import pytest
+
+from admission import AdmissionController
+from batching import BatchScheduler, QueueFullError
+from stub_model import StubModel, StubTokenizer
+
+
+def not_cancelled(item):
+    return False
+
+
+class GatedModel:
+    """StubModel batches that record their items and can be held at the start of a batch"""
+
+    def __init__(self):
+        self.stub = StubModel(prefill_ms=0, image_ms=0, token_ms=0)
+        self.batches = []
+        self.started = threading.Event()
+        self.gate = threading.Event()
+
+    def run_batch(self, batch):
+        self.batches.append([item['question'] for item in batch])
+        self.started.set()
+        assert self.gate.wait(5)
+        return partial(self.stub.run_batch, is_cancelled=not_cancelled)(batch)
+
+
+def request(question, cost=1):
+    return {'image_hash': 'chart', 'question': question, 'cost': cost}
+
+
+@pytest.fixture
+def model():
+    return GatedModel()
+
+
+def start(scheduler):
+    scheduler.start()
+    return scheduler
+
+
+def hold_worker(scheduler, model):
+    """Submit a first request and wait until the worker is busy with it"""
+    future = scheduler.submit(request('first'))
+    assert model.started.wait(5)
+    return future
+
+
+def test_results_come_back_in_submission_order(model):
+    model.gate.set()
+    scheduler = start(BatchScheduler(model.run_batch, max_batch_size=4, max_wait_ms=50))
+    try:
+        items = [request(f'q{index}') for index in range(6)]
+        futures = [scheduler.submit(item) for item in items]
+        answers = [future.result(5) for future in futures]
+    finally:
+        scheduler.stop()
+    assert answers == [StubTokenizer().decode(model.stub.answer_tokens(item)) for item in items]
+    assert all(len(batch) <= 4 for batch in model.batches)
+
+
+def test_held_item_opens_the_next_batch_ahead_of_later_items(model):
+    admission = AdmissionController(10, lambda items: sum(item['cost'] for item in items))
+    scheduler = start(BatchScheduler(model.run_batch, max_batch_size=8, max_wait_ms=0, admission=admission))
+    try:
+        futures = [hold_worker(scheduler, model)]
+        futures += [scheduler.submit(request(question, cost))
+                    for question, cost in [('a', 6), ('b', 6), ('c', 1), ('d', 12), ('e', 1)]]
+        model.gate.set()
+        for future in futures:
+            future.result(5)
+    finally:
+        scheduler.stop()
+    # b does not fit next to a and waits; d is over budget even alone and runs by itself
+    assert model.batches == [['first'], ['a'], ['b', 'c'], ['d'], ['e']]
+    assert scheduler.deferred == 3
+    assert admission.batches_over_budget == 1
+
+
+def test_full_queue_rejects_with_a_retry_after(model):
+    scheduler = start(BatchScheduler(model.run_batch, max_batch_size=2, max_wait_ms=0, max_queue_size=2))
+    try:
+        futures = [hold_worker(scheduler, model)]
+        futures += [scheduler.submit(request(f'q{index}')) for index in range(2)]
+        with pytest.raises(QueueFullError) as error:
+            scheduler.submit(request('one too many'))
+        assert error.value.retry_after >= 1
+        assert scheduler.stats()['rejected'] == 1
+        model.gate.set()
+        for future in futures:
+            future.result(5)
+    finally:
+        scheduler.stop()
+
+
+def test_prepared_items_are_bounded(model):
+    prepared = []
+    prepared_lock = threading.Lock()
+
+    def prepare(item):
+        with prepared_lock:
+            prepared.append(item['question'])
+
+    scheduler = start(BatchScheduler(model.run_batch, max_batch_size=8, max_wait_ms=0, prepare=prepare,
+                                     prepare_workers=4, max_prepared=2))
+    try:
+        futures = [hold_worker(scheduler, model)]
+        futures += [scheduler.submit(request(f'q{index}')) for index in range(6)]
+        # Two items are prepared while the worker is busy, the other preparations wait for a slot
+        deadline = time.monotonic() + 5
+        while len(prepared) < 3 and time.monotonic() < deadline:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        assert len(prepared) == 3
+        assert scheduler.queue_depth() == 6
+        model.gate.set()
+        for future in futures:
+            future.result(5)
+    finally:
+        scheduler.stop()
+    assert len(prepared) == 7
+    assert sum(len(batch) for batch in model.batches) == 7
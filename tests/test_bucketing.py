@@ -0,0 +1,54 @@
+import random
+
+import pytest
+
+from bucketing import bucket_batches
+
+
+def sample_entries(count=500, seed=1):
+    rng = random.Random(seed)
+    entries = []
+    for key in range(count):
+        visual_tokens = rng.choice([64, 256, 1024, 3000])
+        entries.append((key, visual_tokens + rng.randint(20, 200), visual_tokens))
+    # A few samples over the token budget on their own
+    entries += [(count + index, 5000 + index, 4800) for index in range(3)]
+    return entries
+
+
+def lengths(entries):
+    return {key: (tokens, visual_tokens) for key, tokens, visual_tokens in entries}
+
+
+@pytest.mark.parametrize("shuffle_buffer", [1, 16, 1024])
+def test_batches_stay_within_the_token_budget(shuffle_buffer):
+    entries = sample_entries()
+    sizes = lengths(entries)
+    for keys in bucket_batches(entries, max_tokens=4096, shuffle_buffer=shuffle_buffer):
+        padded = len(keys) * max(sizes[key][0] for key in keys)
+        # Only a sample too long for the budget by itself may exceed it, alone
+        assert padded <= 4096 or len(keys) == 1
+
+
+def test_visual_and_row_limits():
+    entries = sample_entries()
+    sizes = lengths(entries)
+    for keys in bucket_batches(entries, max_tokens=8192, max_visual_tokens=4096, max_batch_size=4):
+        assert len(keys) <= 4
+        assert sum(sizes[key][1] for key in keys) <= 4096 or len(keys) == 1
+
+
+def test_every_key_is_batched_exactly_once():
+    entries = sample_entries()
+    keys = [key for batch in bucket_batches(entries, max_tokens=4096, shuffle_buffer=32) for key in batch]
+    assert sorted(keys) == [key for key, _, _ in entries]
+
+
+def test_batches_are_deterministic_for_a_seed():
+    entries = sample_entries()
+
+    def plan(seed):
+        return list(bucket_batches(iter(entries), max_tokens=4096, shuffle_buffer=64, seed=seed))
+
+    assert plan(3) == plan(3)
+    assert plan(3) != plan(4)
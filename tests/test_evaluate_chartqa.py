@@ -0,0 +1,109 @@
+import json
+
+import pytest
+
+from evaluate_chartqa import merge_shards, percentile, relaxed_correct, score, shard_path, summarize, to_float
+
+
+@pytest.mark.parametrize("text, value", [
+    ("42", 42.0),
+    (" 1,234.5 ", 1234.5),
+    ("45%", 0.45),
+    ("12.", 12.0),
+    ("Japan", None),
+    ("", None),
+])
+def test_to_float(text, value):
+    assert to_float(text) == value
+
+
+@pytest.mark.parametrize("prediction, correct", [
+    ("105", True),
+    ("95", True),
+    ("105.01", False),
+    ("94.99", False),
+    ("100", True),
+])
+def test_five_percent_tolerance_boundary(prediction, correct):
+    assert relaxed_correct(prediction, "100") is correct
+
+
+def test_percent_answers_compare_as_fractions():
+    assert relaxed_correct("45%", "0.45")
+    assert relaxed_correct("0.45", "45%")
+    assert relaxed_correct("46%", "45%")
+    # 45 is a hundred times 0.45, not a percentage
+    assert not relaxed_correct("45", "0.45")
+
+
+def test_zero_target_needs_an_exact_match():
+    # No relative tolerance exists around zero, so, as in the reference metric, the strings must match
+    assert relaxed_correct("0", "0")
+    assert not relaxed_correct("0.0", "0")
+    assert not relaxed_correct("0.001", "0")
+
+
+def test_text_answers_ignore_case_and_surrounding_whitespace():
+    assert relaxed_correct("  japan ", "Japan")
+    assert relaxed_correct("UNITED STATES", "United States")
+    assert not relaxed_correct("Japan.", "Japan")
+    assert not relaxed_correct("South Korea", "Korea")
+
+
+def test_score_accepts_any_label():
+    assert score("Yes", ["No", "yes"])
+    assert score("10", "10.2")
+    assert not score("Maybe", ["Yes", "No"])
+
+
+def test_percentile_nearest_rank():
+    values = [5, 1, 4, 2, 3]
+    assert percentile(values, 50) == 3
+    assert percentile(values, 95) == 5
+    assert percentile(values, 0) == 1
+    assert percentile([], 50) is None
+
+
+def write_shard(output_dir, shard_index, num_shards, records, wall_seconds):
+    summary = summarize(records, wall_seconds)
+    summary.update({"shard_index": shard_index, "num_shards": num_shards, "wall_seconds": wall_seconds,
+                    "peak_memory_mb": 100.0 + shard_index, "device": "cpu", "speculative": None,
+                    "config": {"split": "test"}})
+    with open(shard_path(output_dir, shard_index, num_shards, "jsonl"), "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record) + "\n")
+    with open(shard_path(output_dir, shard_index, num_shards, "json"), "w") as f:
+        json.dump(summary, f)
+
+
+def record(index, correct):
+    return {"index": index, "question": f"q{index}", "labels": ["1"], "answer": "1" if correct else "2",
+            "correct": correct, "latency_ms": 10.0 * (index + 1)}
+
+
+def test_merge_orders_records_by_sample_index(tmp_path):
+    output_dir = str(tmp_path)
+    # Round-robin shards, written out of order and each in shuffled order
+    write_shard(output_dir, 2, 3, [record(5, False), record(2, True)], 3.0)
+    write_shard(output_dir, 0, 3, [record(3, True), record(0, True), record(6, True)], 2.0)
+    write_shard(output_dir, 1, 3, [record(4, False), record(1, True)], 4.0)
+
+    merged = merge_shards(output_dir)
+    with open(tmp_path / "predictions.jsonl", encoding="utf-8") as f:
+        assert [json.loads(line)["index"] for line in f] == list(range(7))
+    assert merged["samples"] == 7
+    assert merged["correct"] == 5
+    assert merged["wall_seconds"] == 4.0
+    assert merged["peak_memory_mb"] == 102.0
+    assert [shard["shard_index"] for shard in merged["shards"]] == [0, 1, 2]
+
+    # Merging again gives byte-identical output
+    first = (tmp_path / "predictions.jsonl").read_bytes(), (tmp_path / "summary.json").read_bytes()
+    merge_shards(output_dir)
+    assert ((tmp_path / "predictions.jsonl").read_bytes(), (tmp_path / "summary.json").read_bytes()) == first
+
+
+def test_merge_refuses_a_missing_shard(tmp_path):
+    write_shard(str(tmp_path), 0, 2, [record(0, True)], 1.0)
+    with pytest.raises(SystemExit):
+        merge_shards(str(tmp_path))
@@ -0,0 +1,35 @@
+import pytest
+
+pytest.importorskip("torch")
+pytest.importorskip("PIL")
+
+from resolution import PATCH_FACTOR, PRESETS, TOKEN_PIXELS  # noqa: E402
+from warmup import DEFAULT_BUCKETS, QUESTION_ALLOWANCE, bucket_length, warmup_charts  # noqa: E402
+
+
+def chart_tokens(image):
+    return (image.width // PATCH_FACTOR) * (image.height // PATCH_FACTOR)
+
+
+def test_every_default_bucket_gets_a_chart():
+    max_visual_tokens = PRESETS["accurate"]["max_pixels"] // TOKEN_PIXELS
+    charts = warmup_charts(DEFAULT_BUCKETS, max_visual_tokens)
+    assert [bucket for bucket, _ in charts] == list(DEFAULT_BUCKETS)
+    for bucket, image in charts:
+        tokens = chart_tokens(image)
+        assert tokens <= max_visual_tokens
+        # The chart and its question land in the bucket it warms
+        assert bucket_length(tokens, DEFAULT_BUCKETS) == bucket
+        assert tokens + QUESTION_ALLOWANCE <= bucket
+
+
+def test_largest_preset_image_falls_in_a_warmed_bucket():
+    max_visual_tokens = PRESETS["accurate"]["max_pixels"] // TOKEN_PIXELS
+    warmed = {bucket for bucket, _ in warmup_charts(DEFAULT_BUCKETS, max_visual_tokens)}
+    assert bucket_length(max_visual_tokens + QUESTION_ALLOWANCE, DEFAULT_BUCKETS) in warmed
+
+
+def test_buckets_beyond_the_largest_image_are_skipped():
+    max_visual_tokens = PRESETS["fast"]["max_pixels"] // TOKEN_PIXELS
+    charts = warmup_charts(DEFAULT_BUCKETS, max_visual_tokens)
+    assert [bucket for bucket, _ in charts] == [128, 320]